@@ -1,14 +1,28 @@
-from flask import Blueprint, jsonify, request, current_app
+from flask import Blueprint, Response, jsonify, request, current_app, stream_with_context
 import itertools
-from typing import List, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import json
-import ast
 import os
-from collections import defaultdict, OrderedDict
-from app.es import count_documents_containing_phrases, get_indices, es_init
+import time
+from collections import defaultdict
+import numpy as np
+from app.arrays import pack_arrays
+from app.bundle import open_current_bundle
+from app.cache import MemoryBackend, ResultCache, SqliteBackend, normalize_phrase
+from app.catalog import get_catalog
+from app.domains import DomainIndexes, TopDomainsCache
+from app.es import count_documents_for_each_phrase, count_documents_in_indices, count_total_occurrences_of_unigrams, es_init, InvalidTermError, export_documents_containing_phrases, sample_documents_containing_phrases
+from app.export import EXPORT_MAX_SLICES, EXPORT_PAGE_SIZE, CursorError
+from app.lengths import LengthDistributions
+from app.metrics import PROMETHEUS_MIMETYPE, Metrics
+from app.overlaps import OverlapLattice, entries_to_corpora, loads_overlaps_json, read_overlaps_json, read_overlaps_txt
+from app.prefork import ProcessLocal
+from app.responses import NDARRAY_MIMETYPE, PreparedResponse, ResponseCache, negotiate
+from app.topk import TopKStore
 from psycopg_pool import ConnectionPool
 import os.path
-from concurrent.futures import ThreadPoolExecutor, wait
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from functools import lru_cache
 
 
@@ -68,13 +82,94 @@ def read_top_domains(in_f):
     return domains_dic
 
 
-def create_api() -> Blueprint:
+# Maximum number of domains returned for a prefix, per corpus.
+DOMAIN_PREFIX_LIMIT = 1000
+
+
+def prefix_upper_bound(prefix: str) -> Optional[str]:
+    """
+    :return: The smallest string that is larger than every string starting with `prefix`, in
+        code point (and so UTF-8 byte) order, skipping the surrogates, which can't be encoded. None
+        if there is none (e.g. for a prefix of U+10FFFF characters).
+    """
+    prefix = prefix.rstrip('\U0010ffff')
+    if not prefix:
+        return None
+    last = ord(prefix[-1]) + 1
+    if 0xD800 <= last <= 0xDFFF:
+        last = 0xE000
+    return prefix[:-1] + chr(last)
+
+
+# Maximum number of points per corpus of a downsampled length distribution, and the default
+# when only a window is requested.
+LEN_DIST_MAX_POINTS = 10_000
+LEN_DIST_DEFAULT_POINTS = 1000
+
+# Default quantiles, and maximum number of quantiles and bins, of /api/len_dist_stats.
+LEN_DIST_DEFAULT_PERCENTILES = [0.1, 0.25, 0.5, 0.75, 0.9, 0.99]
+LEN_DIST_MAX_PERCENTILES = 100
+LEN_DIST_MAX_BINS = 10_000
+
+# Maximum (and default) number of domains returned per corpus by /api/top_domains.
+TOP_DOMAINS_MAX_COUNT = 1000
+
+# How long a domain prefix or top domains request waits for Postgres before returning the corpora it has.
+DOMAIN_PREFIX_DEADLINE = 10
+
+
+def timed(fn, *args):
+    """
+    :return: The result of `fn(*args)`, and how long it took in milliseconds.
+    """
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, round((time.perf_counter() - start) * 1000, 2)
+
+
+# How long each ES index has to count the documents of a phrase, and how long a request waits for
+# all the clusters before returning the counts it has.
+ES_COUNT_TIMEOUT = '10s'
+ES_COUNT_DEADLINE = 20
+
+# Limits of /api/text_count_batch. Batches of phrases are counted with one msearch each.
+TEXT_COUNT_BATCH_MAX_PHRASES = 10_000
+TEXT_COUNT_BATCH_MAX_SIZE = 500
+TEXT_COUNT_BATCH_CONCURRENCY = 4
+
+# Limits of /api/term_frequency, and the number of ES requests in flight per corpus.
+TERM_FREQUENCY_MAX_TERMS = 100
+TERM_FREQUENCY_CONCURRENCY = 8
+
+# Limits of /api/documents.
+DOCUMENTS_MAX_COUNT = 20
+DOCUMENTS_DEFAULT_COUNT = 5
+
+# Limits of /api/documents/export.
+EXPORT_MAX_PHRASES = 100
+EXPORT_MAX_PAGE_SIZE = 10_000
+
+
+def create_api(data_dir: Optional[str] = None, es_clients: Optional[Dict[str, Any]] = None,
+               connection_pool: Optional[Callable[[], Any]] = None) -> Blueprint:
     """
     Creates an instance of your API. If you'd like to toggle behavior based on
     command line flags or other inputs, add them as arguments to this function.
+
+    :param data_dir: Directory with the preprocessed artifacts, WIMBD_DATA_DIR by default.
+    :param es_clients: The ES clients of the `default` and the `dolma` clusters, created from the
+        configs in /secret by default.
+    :param connection_pool: Creates the pool of connections to the domain tables, in every process
+        using it. A `psycopg_pool.ConnectionPool` to POSTGRES_URL by default.
+
+    The benchmarks in `bench/api_load.py` pass in-process stand-ins for ES and Postgres.
     """
     api = Blueprint('api', __name__)
 
+    # Latencies of the requests and of their ES and Postgres queries, served by /api/metrics.
+    metrics = Metrics()
+    metrics.instrument(api)
+
     dataset_names = ['OpenWebText', 'C4', 'mC4-en', 'OSCAR', 'The Pile', 'RedPajama', 'S2ORC', 'peS2o', 'LAION-2B-en', 'The Stack',
                      'Dolma'
                      ]
@@ -125,61 +220,128 @@ def create_api() -> Blueprint:
     }
 
 
+    # The preprocessed artifacts are read from the bundle `current.bundle` in the data directory
+    # links to, written by `app/db/build_bundle.py`. Without one, they're loaded from the
+    # individual files in the data directory.
+    data_dir = data_dir or os.getenv('WIMBD_DATA_DIR', '/skiff_files/apps/wimdb')
+    bundle = open_current_bundle(data_dir)
+    if bundle is not None:
+        print(f'attached to bundle {bundle.path} (version {bundle.version})')
+
     ks = [1, 2, 3, 4, 5, 10, 100]
-    data_k_file_dict = defaultdict(dict)
-    for d in dataset_names:
-        for k in ks:
-            if d in dataset_files_map:
-                data_k_file_dict[d][k] = read_topk(f'/skiff_files/apps/wimdb/topk/top-{k}_{dataset_files_map[d]}.jsonl')
+    # The binary top-k files are written offline by `app/db/topk_to_bin.py`. They are memory-mapped
+    # the first time a corpus is requested, otherwise we fall back to parsing the JSONL files.
+    topk_bin_dir = os.path.join(data_dir, 'topk_bin')
+    if bundle is not None:
+        topk_store = TopKStore.from_bundle(bundle, dataset_files_map)
+    elif os.path.isdir(topk_bin_dir):
+        topk_store = TopKStore.from_binary_dir(topk_bin_dir, dataset_files_map)
+    else:
+        topk_store = TopKStore()
+        for d in dataset_names:
+            for k in ks:
+                if d in dataset_files_map:
+                    topk_store.add(d, k, read_topk(os.path.join(data_dir, 'topk', f'top-{k}_{dataset_files_map[d]}.jsonl')))
     print('top-k loaded')
+    for d, nbytes in topk_store.memory_usage().items():
+        print(f'top-k memory for {d}: {nbytes / 2 ** 20:.1f} MiB')
 
-    # Connecting to the DB containing domain information.
+    # Connecting to the DB containing domain information. The pool opens its connections (and starts
+    # its threads) right away, so it's created in every process that uses it: with the pre-fork
+    # server (see `app/prefork.py`), in every worker instead of in the master. The executors and ES
+    # clients below only start threads and open connections on first use, so they are fine to fork.
     uri = os.getenv("POSTGRES_URL")
-    pool = ConnectionPool(uri, min_size=4, max_size=8)
+    pool_size = 8
+    pool = ProcessLocal(connection_pool or (lambda: ConnectionPool(uri, min_size=4, max_size=pool_size)))
 
+    # Postgres queries of all requests run on this executor. It has one thread per pooled connection,
+    # so queries queue here rather than hold a thread while they wait for a connection.
+    db_executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='db')
 
-    length_dist = defaultdict(dict)
-    for corpus in dataset_files_map.keys():
-        lengths = read_json(f'/skiff_files/apps/wimdb/lengths_char_summary/chars_{dataset_files_map[corpus]}.json')
-        for size, dist in lengths.items():
-            length_dist[corpus][int(size)] = float(dist)
+    @contextmanager
+    def db_connection():
+        start = time.perf_counter()
+        with pool.get().connection() as conn:
+            metrics.observe('pg.pool_wait', time.perf_counter() - start)
+            yield conn
 
-    print(f'lengths loaded')
+    # The top domains of each corpus. Counts above TOP_DOMAINS_MAX_COUNT are capped.
+    top_domains_cache = TopDomainsCache(max_count=TOP_DOMAINS_MAX_COUNT)
 
-    stratified_len_dist = {}
-    for corpus in dataset_files_map.keys():
-        l = list(OrderedDict(sorted(length_dist[corpus].items())).values())
+    # Domain prefix indexes written offline by `app/db/build_domain_index.py`, memory-mapped on first use.
+    domain_indexes = DomainIndexes(os.path.join(data_dir, 'domains_index'), db_map, bundle)
 
-        # These values seems random, but they were selected to minimize the number of points in the plot,
-        # while also showing interesting trends, e.g. the spike around 9K characted in The Pile corpus.
-        jump_size = 3
-        init_all = 100
-        len_dist = l[:init_all] + l[init_all:8005:25] + l[8005:10000:jump_size] + l[10000::25]
-        x_range = list(range(1, len(l) + 1))
-        x_range = x_range[:init_all] + x_range[init_all:8005:25] + x_range[8005:10000:jump_size] + x_range[10000::25]
 
-        # Removing values lower than 1e-8 to reduce number of points to show.
-        large_dist, large_x = [], []
-        for x, y in zip(x_range, len_dist):
-            if y > 1e-7:
-                large_dist.append(y)
-                large_x.append(x)
+    if bundle is not None:
+        length_dists = LengthDistributions.from_bundle(bundle, dataset_files_map)
+    else:
+        # The parsed and stratified distributions are cached next to the JSON files by default.
+        length_dists = LengthDistributions.from_files(
+            os.path.join(data_dir, 'lengths_char_summary'),
+            os.getenv('LENGTHS_CACHE_DIR', os.path.join(data_dir, 'lengths_bin')),
+            dataset_files_map,
+        )
 
-        stratified_len_dist[corpus] = list(zip(large_x, large_dist))
+    print(f'lengths loaded')
 
-    print(f'stratified lengths loaded')
-    del length_dist
-    del lengths
+    # `overlaps.json` is written offline by `app/db/overlaps_to_json.py`.
+    if bundle is not None:
+        overlaps = loads_overlaps_json(bundle.section('overlaps'))
+    elif os.path.exists(os.path.join(data_dir, 'overlaps.json')):
+        overlaps = read_overlaps_json(os.path.join(data_dir, 'overlaps.json'))
+    else:
+        overlaps = read_overlaps_txt(os.path.join(data_dir, 'overlaps.txt'))
+    files_dataset_map = {v: k for k, v in dataset_files_map.items()}
+    overlap_lattice = OverlapLattice.from_entries(dataset_names, entries_to_corpora(overlaps, files_dataset_map))
+    del overlaps
 
-    overlaps = read_txt('/skiff_files/apps/wimdb/overlaps.txt')
-    overlaps = [ast.literal_eval(x) for x in overlaps]
-    overlaps = [(sorted(x), y) for (x, y) in overlaps]
-    overlaps = {tuple(dict.fromkeys(x)): y for (x, y) in overlaps}
+    print('overlaps loaded')
 
     print('loading ES indices')
 
-    es_default = es_init("/secret/es_config.yml")
-    es_dolma = es_init("/secret/es_dolma_config.yml")
+    if es_clients is None:
+        es_clients = {'default': es_init("/secret/es_config.yml"), 'dolma': es_init("/secret/es_dolma_config.yml")}
+    es_cluster_names = {d: 'dolma' if d == 'Dolma' else 'default' for d in dataset_es_map}
+    es_clusters = {d: es_clients[es_cluster_names[d]] for d in dataset_es_map}
+    # The indices of every cluster, loaded on first use in every process and then refreshed in the
+    # background, so that requests can check that an index exists without a cluster-state call.
+    # Loading them here would open an ES connection in the pre-fork master, shared by all its workers.
+    es_catalogs = {name: get_catalog(client) for name, client in es_clients.items()}
+    # Shared by all requests, so concurrent requests can't open an unbounded number of ES connections.
+    es_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='es')
+
+    # N-gram counts are cached per (index, phrase). Setting COUNT_CACHE_PATH adds a SQLite file
+    # that all the workers on the machine share, and that survives restarts.
+    count_cache_path = os.getenv("COUNT_CACHE_PATH")
+    count_cache = ResultCache(
+        MemoryBackend(max_entries=100_000, max_bytes=32 * 2 ** 20),
+        shared=SqliteBackend(count_cache_path) if count_cache_path else None,
+        default_ttl=float(os.getenv("COUNT_CACHE_TTL", 7 * 24 * 60 * 60)),
+        # Per-index TTLs in seconds, e.g. '{"docs_v1.5_2023-11-02": 86400}'.
+        ttls=json.loads(os.getenv("COUNT_CACHE_TTLS", "{}")),
+    )
+
+    # Responses of the endpoints over static data, serialized and compressed once per distinct request.
+    responses = ResponseCache(max_entries=1024, max_bytes=256 * 2 ** 20, metrics=metrics)
+    metrics.add_cache('responses', responses.info)
+    metrics.add_cache('counts', count_cache.info)
+
+    # Total term frequencies are cached per (index, term) like the counts, with the same TTLs.
+    term_frequency_cache = ResultCache(
+        MemoryBackend(max_entries=100_000, max_bytes=16 * 2 ** 20),
+        default_ttl=count_cache.default_ttl,
+        ttls=count_cache.ttls,
+    )
+    metrics.add_cache('term_frequencies', term_frequency_cache.info)
+    # Document samples are cached per (index, phrase and options), with the count cache's TTLs.
+    sample_cache = ResultCache(
+        MemoryBackend(max_entries=20_000, max_bytes=64 * 2 ** 20),
+        default_ttl=count_cache.default_ttl,
+        ttls=count_cache.ttls,
+    )
+    metrics.add_cache('document_samples', sample_cache.info)
+    datasets_response = PreparedResponse.from_obj(dataset_meta)
+    ks_response = PreparedResponse.from_obj(ks)
 
     print(f'done loading resources')
 
@@ -194,6 +356,22 @@ def create_api() -> Blueprint:
     def index() -> Tuple[str, int]:
         return '', 204
 
+    # Returns the latency histograms of the requests (by endpoint) and of their parts (ES and
+    # Postgres queries, waiting for a pooled Postgres connection, building, serializing and
+    # compressing responses), and the counters of the caches, in the Prometheus text format.
+    # See `app/metrics.py`.
+    # curl http://localhost:8080/api/metrics
+    # Returns:
+    # # TYPE wimbd_request_duration_seconds histogram
+    # wimbd_request_duration_seconds_bucket{endpoint="api.len_dist",method="POST",status="200",le="0.001"} 0
+    # ...
+    # wimbd_span_duration_seconds_sum{span="pg.domain_prefix",target="C4"} 0.412
+    # ...
+    # wimbd_cache_events_total{cache="counts",event="hits"} 12
+    @api.route('/api/metrics', methods=['GET'])
+    def get_metrics():
+        return Response(metrics.render(), content_type=PROMETHEUS_MIMETYPE)
+
     # Return an array of datasets the user can pick from
     # curl -H "Content-Type: application/json"
     # -X GET http://localhost:8080/api/datasets
@@ -212,23 +390,27 @@ def create_api() -> Blueprint:
     # }
     @api.route('/api/datasets', methods=['GET'])
     def get_datasets():
-        return jsonify(dataset_meta)
+        return datasets_response.serve()
 
-    # Return an array of datasets the user can pick from
+    # Return the overlap of every subset of the given corpora. `exclusive` is the number of documents
+    # that are in exactly that subset, and in none of the other given corpora.
     # curl -d '{"corpora":["C4", "LAION-2B-en"]}' -H "Content-Type: application/json"
     # # -X POST http://localhost:8080/api/get_overlaps
     # Returns:
     # [
     #   {
     #     "count": 364868892,
+    #     "exclusive": 364838290,
     #     "subset": [ "C4" ]
     #   },
     #   {
     #     "count": 1407171770,
+    #     "exclusive": 1407141168,
     #     "subset": [ "LAION-2B-en" ]
     #   },
     #   {
     #     "count": 30602,
+    #     "exclusive": 30602,
     #     "subset": [ "C4", "LAION-2B-en" ]
     #   }
     # ]
@@ -242,21 +424,7 @@ def create_api() -> Blueprint:
         if any([x not in dataset_files_map for x in used_datasets]):
             return error('Please enter a valid dataset name.')
 
-        corpora_subets = []
-        for i in range(1, len(used_datasets) + 1):
-            corpora_subets.extend(list(itertools.combinations(used_datasets, i)))
-            print(corpora_subets[-1])
-            current_app.logger.info('overlap are:' + ','.join(corpora_subets[-1]))
-
-
-
-        subset_counts = []
-        for subset in corpora_subets:
-            corpora_tuple = tuple(dict.fromkeys(sorted(subset)))
-            corpora_tuple_converted = tuple([dataset_files_map[x] for x in corpora_tuple])
-            count_overlap = overlaps[tuple(sorted(corpora_tuple_converted))]
-            subset_counts.append({'subset': tuple(subset), 'count': count_overlap})
-        return jsonify(subset_counts)
+        return responses.serve(('get_overlaps', tuple(used_datasets)), lambda: overlap_lattice.response(used_datasets))
 
 
     # Return an array of ngram length the user can pick from
@@ -275,7 +443,7 @@ def create_api() -> Blueprint:
     # ]
     @api.route('/api/ks', methods=['GET'])
     def get_ks():
-        return jsonify(ks)
+        return ks_response.serve()
 
     # Return a dictionary of datasets to arrays of top ngrams in that dataset
     # curl -d '{"k":4, "datasets":["c4_en"], "count":3}' -H "Content-Type: application/json"
@@ -299,26 +467,23 @@ def create_api() -> Blueprint:
             return error(f'Please enter a valid k value: {ks}.')
 
         count = data.get("count", 20)
+        if type(count) != int or count < 0:
+            return error('Please enter a non-negative count')
 
         used_datasets = data.get("datasets")
         # used_datasets = ['OpenWebText', 'C4', 'OSCAR', 'The Pile', 'LAION-2B-en']
 
-        if any([d not in dataset_names for d in used_datasets]):
+        if not isinstance(used_datasets, list) or any([d not in dataset_names for d in used_datasets]):
             return error('Please enter a valid dataset name.')
 
-        datasets = []
-        for d in used_datasets:
-            datasets.append(data_k_file_dict[d][k])
-
-        topk_per_data = {}
-
-        for dn, d in zip(used_datasets, datasets):
-            top = list({k: v for k, v in sorted(d.items(), key=lambda item: item[1], reverse=True)}.keys())[:count]
-            topk_per_data[dn] = top
-
-        # current_app.logger.info(topk_per_data)
+        def build():
+            topk_per_data = {}
+            for d in used_datasets:
+                topk_per_data[d] = topk_store.top(d, k, count)
+            # current_app.logger.info(topk_per_data)
+            return topk_per_data
 
-        return jsonify(topk_per_data)
+        return responses.serve(('topk', k, tuple(used_datasets), count), build)
 
      # Return a dictionary of datasets to arrays of top ngrams in that dataset
     # curl -d '{"k":4, "datasets":["c4_en"], "count":3}' -H "Content-Type: application/json"
@@ -331,6 +496,9 @@ def create_api() -> Blueprint:
     #     {"ng": ". If you are", "c": 50},
     #   ]
     # }
+    # With `-H "Accept: application/x-ndarray"`, returns the arrays `{dataset}.counts` (int64),
+    # `{dataset}.offsets` (int32) and `{dataset}.blob` (the UTF-8 n-grams as uint8) of each
+    # dataset instead, in the layout of `app/arrays.py`.
     @api.route('/api/topk_with_counts', methods=['POST'])
     def get_topk_with_counts():
         data = request.json
@@ -342,33 +510,86 @@ def create_api() -> Blueprint:
             return error(f'Please enter a valid k value: {ks}.')
 
         count = data.get("count", 20)
+        if type(count) != int or count < 0:
+            return error('Please enter a non-negative count')
 
         used_datasets = data.get("datasets")
 
-        if any([d not in dataset_names for d in used_datasets]):
+        if not isinstance(used_datasets, list) or any([d not in dataset_names for d in used_datasets]):
             return error('Please enter a valid dataset name.')
 
-        datasets = []
-        for d in used_datasets:
-            datasets.append(data_k_file_dict[d][k])
+        mimetype = negotiate()
+        if mimetype is None:
+            return error(f'Please accept application/json or {NDARRAY_MIMETYPE}.', 406)
 
-        topk_per_data = {}
+        # Note: this endpoint returns `count + 1` entries per dataset.
+        def build():
+            topk_per_data = {}
+            for d in used_datasets:
+                top = topk_store.top_with_counts(d, k, count + 1)
+                topk_per_data[d] = [{'ng': ng, 'c': c} for ng, c in top]
+            # current_app.logger.info(topk_per_data)
+            return topk_per_data
+
+        def build_columns():
+            return pack_arrays({
+                f'{d}.{name}': array
+                for d in used_datasets for name, array in topk_store.top_columns(d, k, count + 1).items()
+            })
+
+        key = ('topk_with_counts', mimetype, k, tuple(used_datasets), count)
+        return responses.serve(key, build_columns if mimetype == NDARRAY_MIMETYPE else build, mimetype,
+                               vary='Accept, Accept-Encoding')
+    
+    def count_in_clusters(text, used_datasets) -> Dict[str, Optional[int]]:
+        """
+        Counts the documents containing `text` in each dataset, with one `msearch` per ES cluster.
+        The clusters are queried concurrently, and a dataset whose cluster times out or fails
+        gets a count of `None` instead of failing the whole request.
+        """
+        counts = {}
+        missing = defaultdict(list)
+        for d in used_datasets:
+            c = count_cache.get(dataset_es_map[d], text)
+            if c is None:
+                missing[es_clusters[d]].append(d)
+            else:
+                counts[d] = c
+
+        futures = {
+            es_executor.submit(
+                metrics.timed('es.count', es_cluster_names[datasets[0]], count_documents_in_indices),
+                [dataset_es_map[d] for d in datasets], text,
+                timeout=ES_COUNT_TIMEOUT, es=es_client
+            ): datasets
+            for es_client, datasets in missing.items()
+        }
+        wait(futures, timeout=ES_COUNT_DEADLINE)
+        for future, datasets in futures.items():
+            if not future.done():
+                future.cancel()
+                current_app.logger.warning(f'Counting in {datasets} did not finish within {ES_COUNT_DEADLINE}s.')
+                results = [None] * len(datasets)
+            elif future.exception() is not None:
+                current_app.logger.warning(f'Counting in {datasets} failed: {future.exception()}')
+                results = [None] * len(datasets)
+            else:
+                results = future.result()
 
-        for dn, d in zip(used_datasets, datasets):
-            top = []
-            for ind, (k, v) in enumerate(sorted(d.items(), key=lambda item: item[1], reverse=True)):
-                top.append({'ng': k, 'c': v})
-                if ind >= count: break
-            # current_app.logger.info(top)
-            topk_per_data[dn] = top
+            for d, c in zip(datasets, results):
+                counts[d] = c
+                if c is not None:
+                    count_cache.set(dataset_es_map[d], text, c)
 
-        # current_app.logger.info(topk_per_data)
+        return {d: counts[d] for d in used_datasets}
 
-        return jsonify(topk_per_data)
-    
-    @lru_cache
-    def call_es(text, dataset, es_index):
-        return count_documents_containing_phrases(dataset_es_map[dataset], text, es=es_index)
+    def available_datasets() -> List[str]:
+        """
+        :return: The datasets whose index exists. A cluster whose indices couldn't be loaded yet
+            doesn't rule out any of its datasets.
+        """
+        catalogs = {d: es_catalogs[es_cluster_names[d]] for d in dataset_es_map}
+        return [d for d in dataset_es_map if not catalogs[d].loaded or dataset_es_map[d] in catalogs[d]]
 
     # Returns how many times a term exists in each dataset
     # curl -d '{"text":"well", "datasets":["c4"]}' -H "Content-Type: application/json"
@@ -390,22 +611,14 @@ def create_api() -> Blueprint:
 
         used_datasets = data.get("datasets")
 
-        print('used datasets: ', used_datasets)
+        if used_datasets is None or any([d not in dataset_es_map for d in used_datasets]):
+            return error('Please enter a valid dataset name.')
 
-        # indices = get_indices().keys()
-        # current_app.logger.info('used_datasets:' + ','.join(used_datasets))
-        # if any([dataset_es_map[d].replace('*', '1') not in indices for d in used_datasets]):
-        #     return error(f'Please enter a valid dataset name, out of: {indices}')
+        available = available_datasets()
+        if any([d not in available for d in used_datasets]):
+            return error(f'Please enter a valid dataset name, out of: {available}')
 
-        counts = {}
-        for d in used_datasets:
-            # c = count_documents_containing_phrases(dataset_es_map[d], text)
-            if d == 'Dolma':
-                c = call_es(text, d, es_dolma)
-            else:
-                c = call_es(text, d, es_default)
-            # c = call_es(text, d)
-            counts[d] = c
+        counts = count_in_clusters(text, used_datasets)
 
         # current_app.logger.info(counts)
         entry = {"message": "user-ngram", "event": "n-gram counts", "ngram": text}
@@ -414,24 +627,365 @@ def create_api() -> Blueprint:
         return jsonify(counts)
 
 
+    def count_batch(dataset, phrases) -> List[Optional[int]]:
+        index = dataset_es_map[dataset]
+        counts = [count_cache.get(index, p) for p in phrases]
+        missing = [i for i, c in enumerate(counts) if c is None]
+        if missing:
+            with metrics.span('es.count_batch', index):
+                es_counts = count_documents_for_each_phrase(
+                    index, [phrases[i] for i in missing], batch_size=len(missing),
+                    timeout=ES_COUNT_TIMEOUT, es=es_clusters[dataset]
+                )
+            for i, c in zip(missing, es_counts):
+                counts[i] = c
+                if c is not None:
+                    count_cache.set(index, phrases[i], c)
+        return counts
+
+    # Returns how many documents contain each phrase in each dataset, as a stream of JSON lines.
+    # The first line lists the phrases that were counted (empty ones are dropped), and every
+    # following line holds the counts of one batch of phrases, starting at `offset`, in one dataset.
+    # Lines arrive in the order the batches finish.
+    # curl -d '{"phrases":["well", "as well as"], "datasets":["C4", "Dolma"], "batch_size":100}' -H "Content-Type: application/json"
+    # -X POST http://localhost:8080/api/text_count_batch
+    # Returns:
+    # {"phrases": ["well", "as well as"]}
+    # {"dataset": "Dolma", "offset": 0, "counts": [1802345161, 393140287]}
+    # {"dataset": "C4", "offset": 0, "counts": [212660501, 42513006]}
+    @api.route('/api/text_count_batch', methods=['POST'])
+    def text_count_batch():
+        data = request.json
+        if data is None:
+            return error("No request body")
+
+        phrases = data.get("phrases")
+        if not isinstance(phrases, list) or any([type(p) != str for p in phrases]):
+            return error('Please enter a list of strings')
+        phrases = clean_str_list(phrases)
+        if len(phrases) == 0 or len(phrases) > TEXT_COUNT_BATCH_MAX_PHRASES:
+            return error(f'Please enter between 1 and {TEXT_COUNT_BATCH_MAX_PHRASES} phrases')
+
+        used_datasets = data.get("datasets")
+        available = available_datasets()
+        if not isinstance(used_datasets, list) or any([d not in available for d in used_datasets]):
+            return error(f'Please enter a valid dataset name, out of: {available}')
+
+        batch_size = data.get("batch_size", 100)
+        if type(batch_size) != int or not 1 <= batch_size <= TEXT_COUNT_BATCH_MAX_SIZE:
+            return error(f'Please enter a batch size between 1 and {TEXT_COUNT_BATCH_MAX_SIZE}')
+
+        entry = {"message": "user-ngram-batch", "event": "n-gram batch counts", "num_ngrams": len(phrases)}
+        current_app.logger.info(entry)
+
+        jobs = iter([
+            (d, offset) for d in used_datasets for offset in range(0, len(phrases), batch_size)
+        ])
+
+        def submit(job):
+            d, offset = job
+            return es_executor.submit(count_batch, d, phrases[offset:offset + batch_size])
+
+        def generate():
+            yield json.dumps({"phrases": phrases}) + '\n'
+
+            # At most TEXT_COUNT_BATCH_CONCURRENCY batches of a request are in flight at once.
+            in_flight = {}
+            for job in itertools.islice(jobs, TEXT_COUNT_BATCH_CONCURRENCY):
+                in_flight[submit(job)] = job
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    d, offset = in_flight.pop(future)
+                    row = {"dataset": d, "offset": offset}
+                    if future.exception() is not None:
+                        current_app.logger.warning(f'Counting a batch in {d} failed: {future.exception()}')
+                        row["error"] = "Counting failed"
+                    else:
+                        row["counts"] = future.result()
+                    yield json.dumps(row) + '\n'
+
+                    job = next(jobs, None)
+                    if job is not None:
+                        in_flight[submit(job)] = job
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    def term_frequencies(dataset, terms) -> Dict[str, int]:
+        index = dataset_es_map[dataset]
+        frequencies = {t: term_frequency_cache.get(index, t) for t in terms}
+        missing = [t for t, f in frequencies.items() if f is None]
+        if missing:
+            with metrics.span('es.term_frequency', index):
+                es_frequencies = count_total_occurrences_of_unigrams(
+                    index, missing, es=es_clusters[dataset], max_concurrency=TERM_FREQUENCY_CONCURRENCY
+                )
+            for t, f in es_frequencies.items():
+                frequencies[t] = f
+                term_frequency_cache.set(index, t, f)
+        return frequencies
+
+    # Returns how many times each term occurs in total (not in how many documents) in each dataset.
+    # Terms are single words, counted as the token the index analyzes them into (e.g. "Legal" as
+    # "legal"), and a term that isn't analyzed into exactly one token gets a 400. The totals are
+    # summed over the term statistics of every shard.
+    # curl -d '{"terms":["well", "legal"], "datasets":["C4"]}' -H "Content-Type: application/json"
+    # -X POST http://localhost:8080/api/term_frequency
+    # Returns:
+    # {
+    #   "C4": {"legal": 3489123, "well": 80512344}
+    # }
+    # A dataset whose counting fails gets null.
+    @api.route('/api/term_frequency', methods=['POST'])
+    def term_frequency():
+        data = request.json
+        if data is None:
+            return error("No request body")
+
+        terms = data.get("terms")
+        if not isinstance(terms, list) or any([type(t) != str for t in terms]):
+            return error('Please enter a list of strings')
+        terms = list(dict.fromkeys(clean_str_list(terms)))
+        if len(terms) == 0 or len(terms) > TERM_FREQUENCY_MAX_TERMS:
+            return error(f'Please enter between 1 and {TERM_FREQUENCY_MAX_TERMS} terms')
+        if any([len(t.split()) != 1 for t in terms]):
+            return error('Please enter single words')
+
+        used_datasets = data.get("datasets")
+        if used_datasets is None or any([d not in dataset_es_map for d in used_datasets]):
+            return error('Please enter a valid dataset name.')
+
+        entry = {"message": "user-term-frequency", "event": "term frequencies", "terms": terms}
+        current_app.logger.info(entry)
+
+        futures = {d: es_executor.submit(term_frequencies, d, terms) for d in dict.fromkeys(used_datasets)}
+        wait(futures.values(), timeout=ES_COUNT_DEADLINE)
+        # Terms are checked by the analyzer of each dataset's index, while counting.
+        for future in futures.values():
+            if future.done() and isinstance(future.exception(), InvalidTermError):
+                return error(f'Please enter single words: {future.exception()}')
+        frequencies = {}
+        for d, future in futures.items():
+            if not future.done():
+                future.cancel()
+                current_app.logger.warning(f'Term frequencies in {d} did not finish within {ES_COUNT_DEADLINE}s.')
+                frequencies[d] = None
+            elif future.exception() is not None:
+                current_app.logger.warning(f'Term frequencies in {d} failed: {future.exception()}')
+                frequencies[d] = None
+            else:
+                frequencies[d] = future.result()
+
+        return jsonify(frequencies)
+
+    def document_samples(dataset, text, count, source) -> List[Dict[str, Any]]:
+        index = dataset_es_map[dataset]
+        key = json.dumps([text, count, source])
+        samples = sample_cache.get(index, key)
+        if samples is None:
+            with metrics.span('es.documents', index):
+                samples = sample_documents_containing_phrases(
+                    index, text, num_documents=count, source=source, timeout=ES_COUNT_TIMEOUT,
+                    es=es_clusters[dataset]
+                )
+            sample_cache.set(index, key, samples)
+        return samples
+
+    # Returns example documents containing a phrase in each dataset: their ids, and the passages of
+    # their text around the phrase. Optional: "count" (up to 20, 5 by default) documents per dataset,
+    # and "includes" / "excludes" to also return some of their `_source` fields (never their text).
+    # curl -d '{"text":"terms of use", "datasets":["C4"], "count":1, "includes":["url"]}' -H "Content-Type: application/json"
+    # -X POST http://localhost:8080/api/documents
+    # Returns:
+    # {
+    #   "C4": [
+    #     {
+    #       "index": "c4",
+    #       "id": "Lh2kz4gBqq0sxGHvRC1Y",
+    #       "highlights": ["By using this site you agree to the <em>terms</em> <em>of</em> <em>use</em>."],
+    #       "source": {"url": "https://..."}
+    #     }
+    #   ]
+    # }
+    # A dataset whose search fails gets null.
+    @api.route('/api/documents', methods=['POST'])
+    def documents():
+        data = request.json
+        if data is None:
+            return error("No request body")
+
+        text = data.get("text")
+        if type(text) != str or text.strip() == '':
+            return error('Please enter a valid string')
+        text = normalize_phrase(text)
+
+        used_datasets = data.get("datasets")
+        available = available_datasets()
+        if not isinstance(used_datasets, list) or any([d not in available for d in used_datasets]):
+            return error(f'Please enter a valid dataset name, out of: {available}')
+
+        count = data.get("count", DOCUMENTS_DEFAULT_COUNT)
+        if type(count) != int or not 1 <= count <= DOCUMENTS_MAX_COUNT:
+            return error(f'Please enter a count between 1 and {DOCUMENTS_MAX_COUNT}')
+
+        includes, excludes = data.get("includes"), data.get("excludes")
+        for fields in (includes, excludes):
+            if fields is not None and (not isinstance(fields, list) or any([type(f) != str for f in fields])):
+                return error('Please enter a list of field names')
+        # The text is only returned as highlighted passages.
+        source = False
+        if includes or excludes:
+            source = {"excludes": sorted(set(excludes or []) | {"text"})}
+            if includes:
+                source["includes"] = sorted(set(includes))
+
+        entry = {"message": "user-documents", "event": "document samples", "ngram": text}
+        current_app.logger.info(entry)
+
+        futures = {d: es_executor.submit(document_samples, d, text, count, source) for d in dict.fromkeys(used_datasets)}
+        wait(futures.values(), timeout=ES_COUNT_DEADLINE)
+        samples = {}
+        for d, future in futures.items():
+            if not future.done():
+                future.cancel()
+                current_app.logger.warning(f'Document samples of {d} did not finish within {ES_COUNT_DEADLINE}s.')
+                samples[d] = None
+            elif future.exception() is not None:
+                current_app.logger.warning(f'Document samples of {d} failed: {future.exception()}')
+                samples[d] = None
+            else:
+                samples[d] = future.result()
+
+        return jsonify(samples)
+
+    # Streams every document containing the phrases (any of them, or all of them with "all_phrases")
+    # in a dataset, as JSON lines, from a point in time of its index. Every page of hits is followed
+    # by a line with a cursor, and the number of documents streamed so far: posting the same request
+    # with the cursor resumes the export after that page, until the point in time expires (5 minutes
+    # after the last page). The last cursor is null.
+    # Optional: "slices" (1 to 8) pages that many slices of the index in parallel, "page_size" (up to
+    # 10,000), "limit" caps the number of documents, and "fields" only returns those `_source` fields.
+    # curl -d '{"dataset":"C4", "phrases":["terms of use"], "fields":["url"], "limit":2}' -H "Content-Type: application/json"
+    # -X POST http://localhost:8080/api/documents/export
+    # Returns:
+    # {"index": "c4", "id": "Lh2kz4gBqq0sxGHvRC1Y", "source": {"url": "https://..."}}
+    # {"index": "c4", "id": "Mx2kz4gBqq0sxGHvRC1Y", "source": {"url": "https://..."}}
+    # {"cursor": null, "count": 2}
+    @api.route('/api/documents/export', methods=['POST'])
+    def export_documents():
+        data = request.json
+        if data is None:
+            return error("No request body")
+
+        dataset = data.get("dataset")
+        available = available_datasets()
+        if dataset not in available:
+            return error(f'Please enter a valid dataset name, out of: {available}')
+
+        phrases = data.get("phrases")
+        if isinstance(phrases, str):
+            phrases = [phrases]
+        if not isinstance(phrases, list) or any([type(p) != str for p in phrases]):
+            return error('Please enter a list of strings')
+        phrases = clean_str_list(phrases)
+        if len(phrases) == 0 or len(phrases) > EXPORT_MAX_PHRASES:
+            return error(f'Please enter between 1 and {EXPORT_MAX_PHRASES} phrases')
+
+        slices = data.get("slices", 1)
+        if type(slices) != int or not 1 <= slices <= EXPORT_MAX_SLICES:
+            return error(f'Please enter a number of slices between 1 and {EXPORT_MAX_SLICES}')
+        page_size = data.get("page_size", EXPORT_PAGE_SIZE)
+        if type(page_size) != int or not 1 <= page_size <= EXPORT_MAX_PAGE_SIZE:
+            return error(f'Please enter a page size between 1 and {EXPORT_MAX_PAGE_SIZE}')
+        limit = data.get("limit")
+        if limit is not None and (type(limit) != int or limit < 1):
+            return error('Please enter a positive limit')
+        fields = data.get("fields")
+        if fields is not None and (not isinstance(fields, list) or any([type(f) != str for f in fields])):
+            return error('Please enter a list of field names')
+        cursor = data.get("cursor")
+        if cursor is not None and type(cursor) != str:
+            return error('Please enter the cursor of a previous export')
+
+        entry = {"message": "user-export", "event": "document export", "dataset": dataset,
+                 "num_phrases": len(phrases), "resumed": cursor is not None}
+        current_app.logger.info(entry)
+
+        pages = export_documents_containing_phrases(
+            dataset_es_map[dataset], phrases, all_phrases=bool(data.get("all_phrases", False)),
+            slices=slices, page_size=page_size, limit=limit,
+            source={"includes": fields} if fields is not None else True, cursor=cursor,
+            es=es_clusters[dataset]
+        )
+        # The first page is fetched before responding, so that a bad cursor gets an error status.
+        try:
+            first = next(pages, ([], None))
+        except CursorError as e:
+            return error(str(e))
+        except Exception as e:
+            current_app.logger.warning(f'Exporting from {dataset} failed: {e}')
+            return error('Exporting failed', 500)
+
+        def generate():
+            count = 0
+            try:
+                for hits, next_cursor in itertools.chain([first], pages):
+                    count += len(hits)
+                    lines = [
+                        json.dumps({"index": hit["_index"], "id": hit["_id"], "source": hit.get("_source")})
+                        for hit in hits
+                    ]
+                    lines.append(json.dumps({"cursor": next_cursor, "count": count}))
+                    yield '\n'.join(lines) + '\n'
+            except Exception as e:
+                current_app.logger.warning(f'Exporting from {dataset} failed: {e}')
+                yield json.dumps({"error": "Exporting failed"}) + '\n'
+            finally:
+                pages.close()
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    # Table names come from `db_map`, never from the request. The prefix is matched as the range
+    # [prefix, prefix_upper_bound(prefix)) with the `text_pattern_ops` operators, which the
+    # `(domain text_pattern_ops)` index created by `app/db/populate.py --create-indexes` serves even
+    # in the generic plan of a prepared statement (unlike `LIKE $1`). A prefix without an upper
+    # bound is matched as [prefix, ...).
+    domain_prefix_queries = {
+        corpus: f"SELECT domain, count, percentage, rank FROM {table} "
+                f"WHERE domain ~>=~ %s AND domain ~<~ %s ORDER BY count DESC LIMIT %s;"
+        for corpus, table in db_map.items()
+    }
+    domain_prefix_open_queries = {
+        corpus: f"SELECT domain, count, percentage, rank FROM {table} "
+                f"WHERE domain ~>=~ %s ORDER BY count DESC LIMIT %s;"
+        for corpus, table in db_map.items()
+    }
+
     @lru_cache
     def get_domain_prefix(corpus, prefix) -> List[dict]:
         domain_counts = []
-        with pool.connection() as conn:
+        with db_connection() as conn, metrics.span('pg.domain_prefix', corpus):
             with conn.cursor() as cur:
-                limit = 1000
-                db_corpus = db_map[corpus]
-                q = f"SELECT * FROM {db_corpus} WHERE domain LIKE '{prefix}%' ORDER BY count DESC LIMIT {limit};"
-                rows = cur.execute(q).fetchall()
+                upper = prefix_upper_bound(prefix)
+                if upper is None:
+                    query, params = domain_prefix_open_queries[corpus], (prefix, DOMAIN_PREFIX_LIMIT)
+                else:
+                    query, params = domain_prefix_queries[corpus], (prefix, upper, DOMAIN_PREFIX_LIMIT)
+                rows = cur.execute(query, params, prepare=True).fetchall()
                 for row in rows:
                     domain_counts.append({
-                        'domain': row[1],
-                        'tokens': row[2],
-                        'percentage': row[3],
-                        'rank': row[4],
+                        'domain': row[0],
+                        'tokens': row[1],
+                        'percentage': row[2],
+                        'rank': row[3],
                     })
         return domain_counts
 
+    def domain_prefix_cache_info() -> Dict[str, int]:
+        info = get_domain_prefix.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'entries': info.currsize}
+
+    metrics.add_cache('domain_prefix', domain_prefix_cache_info)
 
     # Returns the number of terms in a domain for each corpora
     # curl -d '{"domain_text":"images.slideplayer.com", "corpora":["laion2b-en"]}' -H "Content-Type: application/json"
@@ -460,41 +1014,60 @@ def create_api() -> Blueprint:
             return error(f'Please enter a valid string')
 
         used_datasets = data.get("corpora")
-        
+        if used_datasets is None or any([d not in db_map for d in used_datasets]):
+            return error('Please enter a valid dataset name.')
+
         entry = {"message": "user-domain-prefix", "event": "domain-prefix", "prefix": text}
         current_app.logger.info(entry)
 
+        # Corpora with an in-memory domain index are answered directly, the others by Postgres,
+        # one query per corpus on the shared executor.
         counts = {}
-        counts_l = []
-        with ThreadPoolExecutor(max_workers=len(used_datasets)) as executor:
-            for d in used_datasets:
-                counts_l.append(executor.submit(get_domain_prefix, d, text))
-                get_domain_prefix(d, text)
-        wait(counts_l, timeout=200)
-        for d, c in zip(used_datasets, counts_l):
-            counts[d] = c.result()
+        futures = {}
+        for d in used_datasets:
+            domain_index = domain_indexes.get(d)
+            if domain_index is not None:
+                with metrics.span('domains.prefix_search', d):
+                    counts[d] = domain_index.prefix_search(text, DOMAIN_PREFIX_LIMIT)
+            else:
+                futures[d] = db_executor.submit(timed, get_domain_prefix, d, text)
+
+        wait(futures.values(), timeout=DOMAIN_PREFIX_DEADLINE)
+        timings = {}
+        for d, future in futures.items():
+            if not future.done():
+                future.cancel()
+                current_app.logger.warning(f'Domain prefix search in {d} did not finish within {DOMAIN_PREFIX_DEADLINE}s.')
+                counts[d] = None
+            elif future.exception() is not None:
+                current_app.logger.warning(f'Domain prefix search in {d} failed: {future.exception()}')
+                counts[d] = None
+            else:
+                counts[d], timings[d] = future.result()
 
-        return jsonify(counts)
+        if timings:
+            current_app.logger.info({"message": "domain-prefix-timings", "event": "domain-prefix", "ms": timings})
 
+        with metrics.span('response.serialize', 'domains_count'):
+            return jsonify(counts)
 
-    def get_top_domains(corpus, count) -> List[dict]:
-        current_app.logger.info("in top domains")
-        domain_counts = []
-        with pool.connection() as conn:
-            with conn.cursor() as cur:
-                db_corpus = db_map[corpus]
-                q = f"SELECT * FROM {db_corpus} WHERE index < {count};"
 
-                rows = cur.execute(q).fetchall()
-                for row in rows:
-                    # current_app.logger.info("top domain row:" + ','.join(map(str, row)))
-                    domain_counts.append({
-                        'domain': row[1],
-                        'tokens': row[2],
-                        'percentage': row[3],
-                        'rank': row[4],
-                    })
-        return domain_counts
+    top_domains_queries = {
+        corpus: f"SELECT domain, count, percentage, rank FROM {table} WHERE index < %s ORDER BY index;"
+        for corpus, table in db_map.items()
+    }
+
+    def get_top_domains(corpus) -> List[tuple]:
+        domain_index = domain_indexes.get(corpus)
+        if domain_index is not None:
+            positions = domain_index.prefix_positions('', top_domains_cache.max_count)
+            return [(row['domain'], row['tokens'], row['percentage'], row['rank'])
+                    for row in domain_index.rows(positions)]
+
+        with db_connection() as conn, metrics.span('pg.top_domains', corpus):
+            with conn.cursor() as cur:
+                params = (top_domains_cache.max_count,)
+                return cur.execute(top_domains_queries[corpus], params, prepare=True).fetchall()
 
     # Returns top domains of each corpora
     # curl -d '{"corpora":["laion2b-en"], "count":10}' -H "Content-Type: application/json"
@@ -529,18 +1102,51 @@ def create_api() -> Blueprint:
         if data is None:
             return error("No request body")
 
-        count = data.get("count", 1000)
+        count = data.get("count", TOP_DOMAINS_MAX_COUNT)
+        if type(count) != int or count < 0:
+            return error('Please enter a valid count.')
 
         used_datasets = data.get("corpora")
+        if used_datasets is None or any([d not in db_map for d in used_datasets]):
+            return error('Please enter a valid dataset name.')
 
-        domain_counts = {}
-        for corpus in used_datasets:
-            domain_counts[corpus] = get_top_domains(corpus, count)
-
-        current_app.logger.info("domain counts")
-        # current_app.logger.info(counts)
-
-        return jsonify(domain_counts)
+        # The top domains of a corpus are only fetched the first time it's requested, in parallel.
+        # A corpus whose query fails or doesn't finish in time gets null.
+        missing = [d for d in dict.fromkeys(used_datasets) if d not in top_domains_cache]
+        futures = {d: db_executor.submit(timed, get_top_domains, d) for d in missing}
+        wait(futures.values(), timeout=DOMAIN_PREFIX_DEADLINE)
+        failed = set()
+        for d, future in futures.items():
+            if not future.done():
+                future.cancel()
+                current_app.logger.warning(f'Top domains of {d} did not finish within {DOMAIN_PREFIX_DEADLINE}s.')
+                failed.add(d)
+            elif future.exception() is not None:
+                current_app.logger.warning(f'Top domains of {d} failed: {future.exception()}')
+                failed.add(d)
+            else:
+                rows, elapsed = future.result()
+                top_domains_cache.put(d, rows)
+                current_app.logger.info(f'loaded the top domains of {d} in {elapsed}ms')
+
+        corpora = tuple(sorted(set(used_datasets)))
+        def build():
+            body = ','.join(
+                f'{json.dumps(d)}:{"null" if d in failed else top_domains_cache.fragment(d, count)}' for d in corpora
+            )
+            return ('{' + body + '}').encode('utf-8')
+
+        if failed:
+            # Not cached, so that the next request queries the failed corpora again.
+            return PreparedResponse(build()).serve()
+        return responses.serve(('top_domains', corpora, count), build)
+
+    def len_window_error(min_len, max_len) -> Optional[str]:
+        if any([v is not None and (type(v) != int or v < 0) for v in [min_len, max_len]]):
+            return 'Please enter valid lengths'
+        if min_len is not None and max_len is not None and min_len > max_len:
+            return 'min_len must not be larger than max_len'
+        return None
 
     # Returns document length distribution of each corpora
     # curl -i -X POST -H 'Content-Type: application/json' -d '{"corpora": ["laion2b-en"]}' localhost:8080/api/len_dist
@@ -553,6 +1159,12 @@ def create_api() -> Blueprint:
     #     ...
     #   ]
     # }
+    # Without other parameters this is the default, stratified curve. With `points`, and / or a
+    # `min_len` / `max_len` window (inclusive), the lengths in the window are downsampled to at most
+    # `points` points (LEN_DIST_DEFAULT_POINTS if not given), e.g.
+    # -d '{"corpora": ["laion2b-en"], "points": 200, "min_len": 1000, "max_len": 20000}'
+    # With `-H "Accept: application/x-ndarray"`, returns the arrays `{corpus}.x` (int32) and
+    # `{corpus}.y` (float32) of each corpus instead, in the layout of `app/arrays.py`.
     @api.route('/api/len_dist', methods=['POST'])
     def len_dist():
 
@@ -561,11 +1173,98 @@ def create_api() -> Blueprint:
             return error("No request body")
 
         used_datasets = data.get("corpora")
+        if used_datasets is None or any([d not in length_dists for d in used_datasets]):
+            return error('Please enter a valid dataset name.')
 
-        len_dist_out = {}
-        for d in used_datasets:
-            len_dist_out[d] = stratified_len_dist[d]
+        points, min_len, max_len = data.get("points"), data.get("min_len"), data.get("max_len")
+        if points is not None and (type(points) != int or not 3 <= points <= LEN_DIST_MAX_POINTS):
+            return error(f'Please enter a number of points between 3 and {LEN_DIST_MAX_POINTS}')
+        window_error = len_window_error(min_len, max_len)
+        if window_error is not None:
+            return error(window_error)
+
+        mimetype = negotiate()
+        if mimetype is None:
+            return error(f'Please accept application/json or {NDARRAY_MIMETYPE}.', 406)
 
-        return jsonify(len_dist_out)
+        def curve(d):
+            if points is None and min_len is None and max_len is None:
+                return length_dists[d].curve()
+            return length_dists[d].downsample(points or LEN_DIST_DEFAULT_POINTS, min_len, max_len)
+
+        def build():
+            len_dist_out = {}
+            for d in used_datasets:
+                x, y = curve(d)
+                len_dist_out[d] = list(zip(x.tolist(), y.tolist()))
+            return len_dist_out
+
+        def build_columns():
+            columns = {}
+            for d in used_datasets:
+                x, y = curve(d)
+                columns[f'{d}.x'] = x.astype(np.int32)
+                columns[f'{d}.y'] = y.astype(np.float32)
+            return pack_arrays(columns)
+
+        key = ('len_dist', mimetype, tuple(used_datasets), points, min_len, max_len)
+        return responses.serve(key, build_columns if mimetype == NDARRAY_MIMETYPE else build, mimetype,
+                               vary='Accept, Accept-Encoding')
+
+    # Returns statistics of the document length distribution of each corpora, within the optional,
+    # inclusive `min_len` / `max_len` window: the fraction of documents in the window (`mass`), the
+    # lengths at the given quantiles of the documents in the window (`percentiles`, in the order of
+    # the request, null if the window is empty), and with `bins`, the fraction of documents in each
+    # of `bins` equal-width bins (on a log scale with `log_bins`). Bin `i` holds the lengths in
+    # [edges[i], edges[i + 1]).
+    # curl -X POST -H 'Content-Type: application/json' -d '{"corpora": ["C4"], "percentiles": [0.5], "bins": 2, "max_len": 999}' localhost:8080/api/len_dist_stats
+    # Returns:
+    # {
+    #   "C4": {
+    #     "bins": { "edges": [ 1, 501, 1000 ], "mass": [ 0.4512, 0.2005 ] },
+    #     "mass": 0.6517,
+    #     "percentiles": [ 412 ]
+    #   }
+    # }
+    @api.route('/api/len_dist_stats', methods=['POST'])
+    def len_dist_stats():
+
+        data = request.json
+        if data is None:
+            return error("No request body")
+
+        used_datasets = data.get("corpora")
+        if used_datasets is None or any([d not in length_dists for d in used_datasets]):
+            return error('Please enter a valid dataset name.')
+
+        min_len, max_len = data.get("min_len"), data.get("max_len")
+        window_error = len_window_error(min_len, max_len)
+        if window_error is not None:
+            return error(window_error)
+
+        qs = data.get("percentiles", LEN_DIST_DEFAULT_PERCENTILES)
+        if not isinstance(qs, list) or len(qs) > LEN_DIST_MAX_PERCENTILES or \
+                any([type(q) not in (int, float) or not 0 <= q <= 1 for q in qs]):
+            return error(f'Please enter at most {LEN_DIST_MAX_PERCENTILES} quantiles between 0 and 1')
+
+        bins, log_bins = data.get("bins"), data.get("log_bins", False)
+        if bins is not None and (type(bins) != int or not 1 <= bins <= LEN_DIST_MAX_BINS):
+            return error(f'Please enter a number of bins between 1 and {LEN_DIST_MAX_BINS}')
+
+        def build():
+            stats = {}
+            for d in used_datasets:
+                dist = length_dists[d]
+                stats[d] = {
+                    'mass': dist.mass(min_len, max_len),
+                    'percentiles': dist.percentiles(qs, min_len, max_len),
+                }
+                if bins is not None:
+                    edges = dist.bin_edges(bins, min_len, max_len, log=bool(log_bins))
+                    stats[d]['bins'] = {'edges': edges.tolist(), 'mass': dist.bins(edges).tolist()}
+            return stats
+
+        key = ('len_dist_stats', tuple(used_datasets), min_len, max_len, tuple(qs), bins, bool(log_bins))
+        return responses.serve(key, build)
 
     return api
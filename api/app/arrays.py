@@ -0,0 +1,67 @@
+import mmap
+import os
+import struct
+from typing import Dict, Union
+
+import numpy as np
+
+# A file of named, one-dimensional numpy arrays that can be viewed in place from an mmap.
+#
+#   header:   magic (8 bytes), version (uint32), number of arrays (uint32)
+#   arrays:   one entry per array: name (32 bytes), dtype (8 bytes, e.g. '<i8'), offset, length (2 x uint64)
+#   payload:  the arrays, each 8 byte aligned
+ARRAYS_MAGIC = b'WIMBDAR\x00'
+ARRAYS_VERSION = 1
+_HEADER = struct.Struct('<8sII')
+_ENTRY = struct.Struct('<32s8sQQ')
+
+Buffer = Union[bytes, memoryview, mmap.mmap]
+
+
+def pack_arrays(arrays: Dict[str, np.ndarray]) -> bytes:
+    entries, payload = [], bytearray()
+    start = _HEADER.size + _ENTRY.size * len(arrays)
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        if array.ndim != 1:
+            raise ValueError(f'Array {name} has {array.ndim} dimensions, only 1 is supported.')
+        if len(name.encode('utf-8')) > 32:
+            raise ValueError(f'Array name {name} is longer than 32 bytes.')
+        dtype = array.dtype.newbyteorder('<') if array.dtype.byteorder == '>' else array.dtype
+        payload += bytes(-(start + len(payload)) % 8)
+        entries.append(_ENTRY.pack(name.encode('utf-8'), dtype.str.encode('ascii'), start + len(payload), len(array)))
+        payload += array.astype(dtype, copy=False).tobytes()
+    return _HEADER.pack(ARRAYS_MAGIC, ARRAYS_VERSION, len(arrays)) + b''.join(entries) + bytes(payload)
+
+
+def unpack_arrays(buf: Buffer) -> Dict[str, np.ndarray]:
+    """
+    Views the arrays of a buffer written by `pack_arrays` without copying them.
+    """
+    view = memoryview(buf)
+    magic, version, num_arrays = _HEADER.unpack_from(view, 0)
+    if magic != ARRAYS_MAGIC or version != ARRAYS_VERSION:
+        raise ValueError(f'Not an arrays file of version {ARRAYS_VERSION}.')
+
+    arrays = {}
+    for i in range(num_arrays):
+        name, dtype, offset, length = _ENTRY.unpack_from(view, _HEADER.size + i * _ENTRY.size)
+        name = name.rstrip(b'\x00').decode('utf-8')
+        arrays[name] = np.frombuffer(view, dtype=dtype.rstrip(b'\x00').decode('ascii'), count=length, offset=offset)
+    return arrays
+
+
+def write_arrays(path: str, arrays: Dict[str, np.ndarray]):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(pack_arrays(arrays))
+    os.replace(tmp_path, path)
+
+
+def open_arrays(path: str) -> Dict[str, np.ndarray]:
+    """
+    Memory-maps a file written by `write_arrays`, so worker processes share its pages.
+    """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return unpack_arrays(mm)
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+from typing import Dict, Iterable, Optional
+
+# A bundle is a single file holding all the preprocessed artifacts the API serves, written by
+# `app/db/build_bundle.py`:
+#
+#   header:    magic (8 bytes), version (uint32), manifest length (uint64), manifest sha256 (32 bytes)
+#   manifest:  UTF-8 JSON with the data version and, for every section, its offset, length, format and sha256
+#   sections:  the artifacts in their own memory-mappable formats (`app/topk.py`, `app/arrays.py`, JSON),
+#              each 8 byte aligned
+#
+# Attaching to a bundle only reads the header and the manifest. Sections are viewed in place from the mmap.
+BUNDLE_MAGIC = b'WIMBDBN\x00'
+BUNDLE_VERSION = 1
+_HEADER = struct.Struct('<8sIQ32s')
+
+# The bundle the API serves is the one `current.bundle` in the data directory links to.
+CURRENT_BUNDLE = 'current.bundle'
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def write_bundle(path: str, sections: Dict[str, bytes], formats: Dict[str, str], version: str) -> dict:
+    """
+    Writes a bundle to `path` atomically (through a temporary file that replaces it).
+
+    :param sections: The content of every section, by name (e.g. `topk/c4_en`).
+    :param formats: The format of every section: `topk`, `arrays` or `json`.
+    :param version: The version of the data, e.g. the time it was built at.
+    :return: The manifest.
+    """
+    manifest = {'version': version, 'created_at': time.time(), 'sections': {}}
+    # Offsets are relative to the end of the manifest, whose length isn't known before they are.
+    position = 0
+    for name, content in sections.items():
+        manifest['sections'][name] = {
+            'offset': position,
+            'length': len(content),
+            'format': formats[name],
+            'sha256': hashlib.sha256(content).hexdigest(),
+        }
+        position = _align(position + len(content))
+
+    manifest_bytes = json.dumps(manifest, sort_keys=True).encode('utf-8')
+    start = _align(_HEADER.size + len(manifest_bytes))
+    header = _HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(manifest_bytes), hashlib.sha256(manifest_bytes).digest())
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header + manifest_bytes)
+        for name, content in sections.items():
+            f.write(bytes(start + manifest['sections'][name]['offset'] - f.tell()))
+            f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+    for entry in manifest['sections'].values():
+        entry['offset'] += start
+    return manifest
+
+
+class Bundle:
+    """
+    A memory-mapped bundle. See the top of this module for the layout.
+    """
+    def __init__(self, path: str):
+        self.path = os.path.realpath(path)
+        with open(self.path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mm)
+
+        magic, version, manifest_length, manifest_sha256 = _HEADER.unpack_from(view, 0)
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            raise ValueError(f'{self.path} is not a bundle of version {BUNDLE_VERSION}.')
+        manifest_bytes = bytes(view[_HEADER.size:_HEADER.size + manifest_length])
+        if hashlib.sha256(manifest_bytes).digest() != manifest_sha256:
+            raise ValueError(f'The manifest of {self.path} is corrupted.')
+
+        self.manifest = json.loads(manifest_bytes)
+        start = _align(_HEADER.size + manifest_length)
+        self._sections = {
+            name: view[start + entry['offset']:start + entry['offset'] + entry['length']]
+            for name, entry in self.manifest['sections'].items()
+        }
+
+    @property
+    def version(self) -> str:
+        return self.manifest['version']
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._sections
+
+    def names(self, prefix: str = '') -> Iterable[str]:
+        return [name for name in self._sections if name.startswith(prefix)]
+
+    def section(self, name: str) -> memoryview:
+        return self._sections[name]
+
+    def verify(self, names: Optional[Iterable[str]] = None):
+        """
+        Checks the sha256 of the given sections (by default, of all of them). This reads them
+        entirely, so it's done by `app/db/build_bundle.py --verify` rather than when attaching.
+        """
+        for name in names if names is not None else self._sections:
+            if hashlib.sha256(self._sections[name]).hexdigest() != self.manifest['sections'][name]['sha256']:
+                raise ValueError(f'Section {name} of {self.path} is corrupted.')
+
+
+def install_bundle(data_dir: str, path: str):
+    """
+    Points `current.bundle` in `data_dir` at the bundle in `path`. The link is replaced atomically,
+    so the API either attaches to the previous bundle or to the new one. Processes that already
+    attached keep their mapping of the previous one.
+    """
+    link = os.path.join(data_dir, CURRENT_BUNDLE)
+    tmp_link = f'{link}.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.relpath(path, data_dir), tmp_link)
+    os.replace(tmp_link, link)
+
+
+def open_current_bundle(data_dir: str) -> Optional[Bundle]:
+    """
+    :return: The bundle `current.bundle` in `data_dir` links to, or None if there is none.
+    """
+    link = os.path.join(data_dir, CURRENT_BUNDLE)
+    return Bundle(link) if os.path.exists(link) else None
@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# An entry is stored together with the unix time it expires at.
+Entry = Tuple[Any, float]
+
+
+def normalize_phrase(phrase: str) -> str:
+    """
+    Collapses runs of whitespace, which don't change the result of a phrase query.
+    """
+    return ' '.join(phrase.split())
+
+
+class CacheStats:
+    """
+    Thread-safe hit / miss / eviction counters of a cache.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counters)
+
+
+class MemoryBackend:
+    """
+    An in-process LRU bounded both by the number of entries and by their (approximate) size in bytes.
+    """
+    def __init__(self, max_entries: int = 100_000, max_bytes: int = 64 * 2 ** 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries: 'OrderedDict[str, Tuple[Any, float, int]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0], entry[1]
+
+    def set(self, key: str, value: Any, expires_at: float, stats: CacheStats):
+        size = len(key) + len(json.dumps(value))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            self._entries[key] = (value, expires_at, size)
+            self.nbytes += size
+
+            evicted = 0
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, (_, _, old_size) = self._entries.popitem(last=False)
+                self.nbytes -= old_size
+                evicted += 1
+        if evicted:
+            stats.incr('evictions', evicted)
+
+    def delete(self, key: str):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SqliteBackend:
+    """
+    A cache stored in a local SQLite file, shared by every worker process on the machine
+    and kept across restarts. Expired and least recently written entries are pruned every
+    `prune_every` writes, once the file holds more than `max_entries` or `max_bytes`.
+    """
+    def __init__(self, path: str, max_entries: int = 5_000_000, max_bytes: int = 2 * 2 ** 30,
+                 prune_every: int = 1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.prune_every = prune_every
+        self._writes = 0
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, written_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_written_at ON cache (written_at)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, nor with forked processes, so every
+        # thread of every process opens its own.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> Optional[Entry]:
+        row = self._connection().execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def set(self, key: str, value: Any, expires_at: float, stats: CacheStats):
+        conn = self._connection()
+        conn.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at, written_at) VALUES (?, ?, ?, ?)',
+            (key, json.dumps(value), expires_at, time.time()),
+        )
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            stats.incr('evictions', self.prune(conn))
+
+    def delete(self, key: str):
+        self._connection().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def prune(self, conn: Optional[sqlite3.Connection] = None) -> int:
+        """
+        :return: The number of entries that were evicted to get back under the bounds.
+        """
+        conn = conn or self._connection()
+        conn.execute('DELETE FROM cache WHERE expires_at < ?', (time.time(),))
+        num_entries, nbytes = conn.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(key) + LENGTH(value)), 0) FROM cache').fetchone()
+        if num_entries <= self.max_entries and nbytes <= self.max_bytes:
+            return 0
+
+        # Drop the oldest entries, assuming they have roughly the average size.
+        average_size = nbytes / num_entries
+        excess = max(num_entries - self.max_entries, int((nbytes - self.max_bytes) / average_size) + 1)
+        conn.execute(
+            'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY written_at LIMIT ?)', (excess,)
+        )
+        return excess
+
+
+class ResultCache:
+    """
+    Caches JSON-serializable query results (e.g. n-gram document counts) by (index, phrase).
+
+    Lookups go to the in-process `memory` backend first, then to the optional `shared` backend,
+    whose hits are copied back into memory. Every index can have its own TTL in seconds.
+    """
+    def __init__(self, memory: Optional[MemoryBackend] = None, shared: Optional[SqliteBackend] = None,
+                 default_ttl: float = 24 * 60 * 60, ttls: Optional[Dict[str, float]] = None):
+        self.memory = memory if memory is not None else MemoryBackend()
+        self.shared = shared
+        self.default_ttl = default_ttl
+        self.ttls = ttls or {}
+        self.stats = CacheStats()
+
+    @staticmethod
+    def key(index: str, phrase: str) -> str:
+        return f'{index}\x00{normalize_phrase(phrase)}'
+
+    def ttl(self, index: str) -> float:
+        return self.ttls.get(index, self.default_ttl)
+
+    def _lookup(self, backend, key: str) -> Optional[Entry]:
+        try:
+            entry = backend.get(key)
+            if entry is not None and entry[1] < time.time():
+                backend.delete(key)
+                self.stats.incr('expirations')
+                return None
+        except sqlite3.Error as e:
+            logger.warning(f'Reading from the shared cache failed: {e}')
+            return None
+        return entry
+
+    def get(self, index: str, phrase: str) -> Optional[Any]:
+        key = self.key(index, phrase)
+        entry = self._lookup(self.memory, key)
+        if entry is not None:
+            self.stats.incr('hits')
+            return entry[0]
+
+        if self.shared is not None:
+            entry = self._lookup(self.shared, key)
+            if entry is not None:
+                self.stats.incr('shared_hits')
+                self.memory.set(key, entry[0], entry[1], self.stats)
+                return entry[0]
+
+        self.stats.incr('misses')
+        return None
+
+    def set(self, index: str, phrase: str, value: Any):
+        key = self.key(index, phrase)
+        expires_at = time.time() + self.ttl(index)
+        self.memory.set(key, value, expires_at, self.stats)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value, expires_at, self.stats)
+            except sqlite3.Error as e:
+                logger.warning(f'Writing to the shared cache failed: {e}')
+
+    def get_or_compute(self, index: str, phrase: str, compute: Callable[[], Any]) -> Any:
+        value = self.get(index, phrase)
+        if value is None:
+            value = compute()
+            self.set(index, phrase, value)
+        return value
+
+    def info(self) -> Dict[str, int]:
+        info = self.stats.snapshot()
+        info['entries'] = len(self.memory)
+        info['bytes'] = self.memory.nbytes
+        return info
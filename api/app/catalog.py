@@ -0,0 +1,150 @@
+import logging
+import os
+import threading
+import time
+from fnmatch import fnmatchcase
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from elasticsearch import Elasticsearch
+
+logger = logging.getLogger(__name__)
+
+# Indices that aren't corpora.
+EXCLUDED_INDICES = [
+    "search-test",
+    "test-index-2",
+    "metrics-endpoint.metadata_current_default",
+]
+
+# How often the metadata is reloaded, and how soon a failed reload is retried.
+CATALOG_TTL = 600
+CATALOG_RETRY = 30
+
+
+class IndexInfo(NamedTuple):
+    docs_count: int
+    # The numbers of the primary shards.
+    shards: Tuple[int, ...]
+    # The fields of the mapping.
+    properties: Tuple[str, ...]
+
+
+class IndexCatalog:
+    """
+    The indices of an ES cluster, with their document counts, primary shards and mapped fields,
+    from the `cat.indices`, `cat.shards` and `get_mapping` cluster-state calls.
+
+    They're loaded on first use, and then reloaded in the background every `ttl` seconds, so
+    lookups never wait for the cluster (except for the very first one). If a reload fails, the
+    previous metadata is kept, and the reload is retried after `retry` seconds. The background
+    thread is started in every process using the catalog, so it can be created before forking.
+    """
+    def __init__(self, es: Elasticsearch, ttl: float = CATALOG_TTL, retry: float = CATALOG_RETRY):
+        self.es = es
+        self.ttl = ttl
+        self.retry = retry
+        self.loaded_at: Optional[float] = None
+        self._indices: Optional[Dict[str, IndexInfo]] = None
+        self._load_lock = threading.Lock()
+        self._refresher_pid: Optional[int] = None
+
+    def refresh(self):
+        """
+        Reloads the metadata from the cluster. Raises if any of the calls fails.
+        """
+        rows = self.es.cat.indices(format="json")
+        names = [
+            row["index"] for row in rows
+            if not row["index"].startswith(".") and row["index"] not in EXCLUDED_INDICES
+        ]
+        docs_counts = {row["index"]: int(row.get("docs.count") or 0) for row in rows}
+
+        shards = {name: set() for name in names}
+        for row in self.es.cat.shards(format="json"):
+            if row.get("index") in shards and row.get("prirep", "p") == "p":
+                shards[row["index"]].add(int(row["shard"]))
+
+        mappings = self.es.indices.get_mapping(index=names) if names else {}
+        self._indices = {
+            name: IndexInfo(
+                docs_count=docs_counts[name],
+                shards=tuple(sorted(shards[name])),
+                properties=tuple(mappings.get(name, {}).get("mappings", {}).get("properties", {})),
+            )
+            for name in names
+        }
+        self.loaded_at = time.time()
+        logger.info(f"Loaded the metadata of {len(names)} indices.")
+
+    def _run_refresher(self):
+        while True:
+            time.sleep(self.ttl if self.loaded_at and time.time() - self.loaded_at < self.ttl else self.retry)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Reloading the index metadata failed, keeping the previous one: {e}")
+
+    def _ensure_loaded(self) -> Optional[Dict[str, IndexInfo]]:
+        if self._refresher_pid != os.getpid():
+            with self._load_lock:
+                if self._refresher_pid != os.getpid():
+                    if self._indices is None:
+                        try:
+                            self.refresh()
+                        except Exception as e:
+                            logger.warning(f"Loading the index metadata failed: {e}")
+                    threading.Thread(target=self._run_refresher, name='index-catalog', daemon=True).start()
+                    self._refresher_pid = os.getpid()
+        return self._indices
+
+    @property
+    def loaded(self) -> bool:
+        return self._ensure_loaded() is not None
+
+    def resolve(self, pattern: str) -> List[str]:
+        """
+        :param pattern: The name of an index, or a pattern like `re_laion2b-en-*`.
+        :return: The names of the matching indices. Empty if the metadata couldn't be loaded.
+        """
+        indices = self._ensure_loaded() or {}
+        if pattern in indices:
+            return [pattern]
+        return sorted(name for name in indices if fnmatchcase(name, pattern))
+
+    def __contains__(self, pattern: str) -> bool:
+        return len(self.resolve(pattern)) > 0
+
+    def indices(self) -> Dict[str, IndexInfo]:
+        return dict(self._ensure_loaded() or {})
+
+    def docs_count(self, pattern: str) -> Optional[int]:
+        """
+        :return: The number of documents of the matching indices, or None if there are none.
+        """
+        names = self.resolve(pattern)
+        if not names:
+            return None
+        indices = self._indices
+        return sum(indices[name].docs_count for name in names)
+
+    def primary_shards(self, pattern: str) -> List[Tuple[str, int]]:
+        """
+        :return: The (index, shard number) of every primary shard of the matching indices.
+        """
+        indices = self._ensure_loaded() or {}
+        return [(name, shard) for name in self.resolve(pattern) for shard in indices[name].shards]
+
+
+_catalogs: Dict[int, IndexCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(es: Elasticsearch) -> IndexCatalog:
+    """
+    :return: The catalog of the cluster of `es`, shared by all the callers using that client.
+    """
+    with _catalogs_lock:
+        catalog = _catalogs.get(id(es))
+        if catalog is None or catalog.es is not es:
+            catalog = _catalogs[id(es)] = IndexCatalog(es)
+        return catalog
@@ -0,0 +1,104 @@
+"""
+Packs the preprocessed artifacts the API serves into one versioned, checksummed bundle, and makes
+it the current one:
+
+- `topk/{corpus}`: the top-k n-grams of every k, from `topk/top-{k}_{corpus}.jsonl`
+- `lengths/{corpus}`: the length distribution, from `lengths_char_summary/chars_{corpus}.json`
+- `overlaps`: the overlap counts, from `overlaps.json` (or `overlaps.txt`)
+- `domains/{table}`: the domain indexes in `domains_index/`, if any (see `app/db/build_domain_index.py`)
+
+python -m app.db.build_bundle --data-dir /skiff_files/apps/wimdb
+
+The bundle is written to `{data dir}/bundles/{version}.bundle` and `{data dir}/current.bundle` is
+then pointed at it atomically. API processes started after that attach to it.
+
+python -m app.db.build_bundle --verify /skiff_files/apps/wimdb/current.bundle
+"""
+
+import argparse
+import json
+import os
+import re
+import time
+from collections import defaultdict
+from glob import glob
+
+from tqdm import tqdm
+
+from app.api import read_topk
+from app.arrays import pack_arrays
+from app.bundle import Bundle, install_bundle, write_bundle
+from app.lengths import LengthDistribution, read_length_distribution
+from app.overlaps import read_overlaps_json, read_overlaps_txt
+from app.topk import TopKTable, pack_tables
+
+TOPK_FILE_RE = re.compile(r'^top-(\d+)_(.+)\.jsonl$')
+LENGTHS_FILE_RE = re.compile(r'^chars_(.+)\.json$')
+
+
+def collect_sections(data_dir: str):
+    sections, formats = {}, {}
+
+    files_per_corpus = defaultdict(dict)
+    for filename in glob(os.path.join(data_dir, 'topk', 'top-*_*.jsonl')):
+        match = TOPK_FILE_RE.match(os.path.basename(filename))
+        if match:
+            files_per_corpus[match.group(2)][int(match.group(1))] = filename
+    for corpus, files in tqdm(sorted(files_per_corpus.items()), desc='top-k'):
+        tables = {k: TopKTable.from_dict(read_topk(filename)) for k, filename in files.items()}
+        sections[f'topk/{corpus}'], formats[f'topk/{corpus}'] = pack_tables(tables), 'topk'
+
+    for filename in tqdm(sorted(glob(os.path.join(data_dir, 'lengths_char_summary', 'chars_*.json'))), desc='lengths'):
+        match = LENGTHS_FILE_RE.match(os.path.basename(filename))
+        if match:
+            arrays = LengthDistribution.build_arrays(*read_length_distribution(filename))
+            sections[f'lengths/{match.group(1)}'], formats[f'lengths/{match.group(1)}'] = pack_arrays(arrays), 'arrays'
+
+    if os.path.exists(os.path.join(data_dir, 'overlaps.json')):
+        overlaps = read_overlaps_json(os.path.join(data_dir, 'overlaps.json'))
+    else:
+        overlaps = read_overlaps_txt(os.path.join(data_dir, 'overlaps.txt'))
+    sections['overlaps'] = json.dumps([{'subset': subset, 'count': count} for subset, count in overlaps]).encode('utf-8')
+    formats['overlaps'] = 'json'
+
+    for filename in sorted(glob(os.path.join(data_dir, 'domains_index', '*.domains'))):
+        table = os.path.basename(filename)[:-len('.domains')]
+        with open(filename, 'rb') as f:
+            sections[f'domains/{table}'], formats[f'domains/{table}'] = f.read(), 'arrays'
+
+    return sections, formats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack the preprocessed artifacts into a bundle.')
+
+    parser.add_argument('--data-dir', type=str, default=os.getenv('WIMBD_DATA_DIR', '/skiff_files/apps/wimdb'),
+                        help='Directory with the artifacts, where the bundle is installed')
+    parser.add_argument('--version', type=str, default=time.strftime('%Y%m%d-%H%M%S', time.gmtime()),
+                        help='Version of the data, the build time (UTC) by default')
+    parser.add_argument('--no-install', action='store_true', help="Don't make the new bundle the current one")
+    parser.add_argument('--verify', type=str, help='Only check the checksums of an existing bundle')
+
+    args = parser.parse_args()
+
+    if args.verify:
+        bundle = Bundle(args.verify)
+        bundle.verify()
+        print(f'{bundle.path}: version {bundle.version}, {len(bundle.names())} sections OK')
+        return
+
+    sections, formats = collect_sections(args.data_dir)
+
+    os.makedirs(os.path.join(args.data_dir, 'bundles'), exist_ok=True)
+    path = os.path.join(args.data_dir, 'bundles', f'{args.version}.bundle')
+    write_bundle(path, sections, formats, args.version)
+    Bundle(path).verify()
+    print(f'wrote {len(sections)} sections ({os.path.getsize(path) / 2 ** 20:.1f} MiB) to {path}')
+
+    if not args.no_install:
+        install_bundle(args.data_dir, path)
+        print(f'{path} is now the current bundle')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Builds the in-memory domain prefix index of a corpus from the CSV written by `app/db/to_csv.py`.
+The API memory-maps `{tablename}.domains` from the output directory, and falls back to Postgres
+for corpora without one.
+
+python -m app.db.build_domain_index --filename skiff_files/domains_per_token_csv/c4.csv --tablename c4
+
+Sorting the domains happens in memory, so this needs a machine that can hold every domain of
+the corpus at once.
+"""
+
+import argparse
+import csv
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from app.arrays import write_arrays
+from app.domains import build_domain_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the domain prefix index of a corpus.')
+
+    parser.add_argument('--filename', type=str, help='Name of the CSV file')
+    parser.add_argument('--tablename', type=str, help='Name of the corpus table, e.g. c4')
+    parser.add_argument('--output-dir', type=str, default='/skiff_files/apps/wimdb/domains_index',
+                        help='Directory to write the {tablename}.domains file to')
+    parser.add_argument('--top-n', type=int, default=1000, help='Number of domains precomputed per prefix')
+    parser.add_argument('--threshold', type=int, default=50_000,
+                        help='Prefixes matching more domains than this get their top domains precomputed')
+
+    args = parser.parse_args()
+
+    domains, counts, percentage, rank = [], [], [], []
+    with open(args.filename, 'r', newline='') as csv_file:
+        for row in tqdm(csv.DictReader(csv_file)):
+            domains.append(row['domain'])
+            counts.append(int(row['count']))
+            percentage.append(float(row['percentage']))
+            rank.append(int(row['rank']))
+    print(f'read {len(domains)} domains')
+
+    arrays = build_domain_index(domains, np.array(counts), np.array(percentage), np.array(rank),
+                                top_n=args.top_n, threshold=args.threshold)
+    print(f"precomputed the top domains of {len(arrays['node_offsets']) - 1} prefixes")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    write_arrays(os.path.join(args.output_dir, f'{args.tablename}.domains'), arrays)
+
+
+if __name__ == '__main__':
+    main()
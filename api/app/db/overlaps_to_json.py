@@ -0,0 +1,28 @@
+"""
+Parses `overlaps.txt` once and writes it as `overlaps.json`, which the API loads instead.
+
+python -m app.db.overlaps_to_json --input /skiff_files/apps/wimdb/overlaps.txt --output /skiff_files/apps/wimdb/overlaps.json
+"""
+
+import argparse
+
+from app.overlaps import read_overlaps_txt, write_overlaps_json
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert overlaps.txt into overlaps.json.')
+
+    parser.add_argument('--input', type=str, default='/skiff_files/apps/wimdb/overlaps.txt',
+                        help='Path of the overlaps.txt file')
+    parser.add_argument('--output', type=str, default='/skiff_files/apps/wimdb/overlaps.json',
+                        help='Path of the overlaps.json file to write')
+
+    args = parser.parse_args()
+
+    entries = read_overlaps_txt(args.input)
+    write_overlaps_json(args.output, entries)
+    print(f'wrote {len(entries)} overlap counts to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,58 +1,172 @@
-import os
-import json
+"""
+Converts the `domains_per_token` files, one JSON object `{"url": ..., "count": ...}` per line and
+per domain, to the CSVs `app/db/populate.py` and `app/db/build_domain_index.py` read: the domains
+by decreasing count, with their share of the tokens and their rank.
+
+python -m app.db.to_csv --input-dir skiff_files/domains_per_token --output-dir skiff_files/domains_per_token_csv --filter dolma
+
+Files are converted in parallel, `--jobs` at a time, and in bounded memory, with external sorts
+of runs of `--run-size` lines in temporary files. A domain that's repeated in a file gets one row,
+with its last count, like when reading the file into a dict: the first pass writes runs sorted by
+domain, and merging them resolves the repeated domains across runs. The second pass sums the
+counts and writes runs sorted by count, which the third pass merges into the CSV. Domains with
+the same count keep the order of their first occurrence in the input file.
+"""
+
+import argparse
 import csv
+import heapq
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from glob import glob
-from tqdm import tqdm
-
-# Set the input and output directory paths
-input_dir = 'skiff_files/domains_per_token/'
-output_dir = 'skiff_files/domains_per_token_csv/'
-
-# Create the output directory if it doesn't exist
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
-    print('created dir')
-
-# Loop through each file in the input directory
-for filename in tqdm(glob(input_dir + '*')):
-    if os.path.isdir(filename):
-        continue
-    if 'dolma' not in filename:
-        continue
-    print(filename)
-    # Open the file and load the JSON data
-    with open(filename, 'r') as json_file:
-        data = [json.loads(x) for x in json_file.readlines()]
-        data = {x['url']: x['count'] for x in data}
-    
-    # order data by count, for having the rank ordered by count
-    data = {k: v for k, v in sorted(data.items(), key=lambda item: item[1], reverse=True)}
-
-    # add rank, and percentage
-    domains_dic = {}
-    total_tokens = sum(data.values())
-    for rank, (k, v) in enumerate(data.items()):
-        domains_dic[k] = {
-            'domain': k,
-            'count': v,
-            'percentage': v / total_tokens,
-            # + 1 to start indexing at 1
-            'rank': rank + 1,
-        }
-    
-    print('done processing data')
-    
-    # Create a new CSV file in the output directory with the same name as the JSON file
-    csv_filename = os.path.splitext(filename.rsplit('/')[-1])[0] + '.csv'
+from itertools import groupby, islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    import json
+    loads = json.loads
+
+
+def _write_run(lines: Iterable[str], tmp_dir: Optional[str]) -> str:
+    fd, path = tempfile.mkstemp(suffix='.run', dir=tmp_dir)
+    with open(fd, 'w', encoding='utf-8') as run:
+        run.writelines(lines)
+    return path
+
+
+def write_domain_runs(filename: str, run_size: int, tmp_dir: Optional[str]) -> List[str]:
+    """
+    Reads a `domains_per_token` file and writes its domains to runs of at most `run_size` input
+    lines, sorted by domain, as lines `{domain}\t{first line number}\t{last line number}\t{count}`.
+    A domain repeated within a run keeps the line number of its first occurrence, and the count of
+    its last one.
+
+    :return: The paths of the runs.
+    """
+    runs = []
+    with open(filename, 'rb') as json_file:
+        lines = enumerate(json_file)
+        while chunk := list(islice(lines, run_size)):
+            domains = {}
+            for i, line in chunk:
+                item = loads(line)
+                first = domains[item['url']][0] if item['url'] in domains else i
+                domains[item['url']] = (first, i, item['count'])
+            runs.append(_write_run(
+                (f'{domain}\t{first}\t{last}\t{count}\n' for domain, (first, last, count) in sorted(domains.items())),
+                tmp_dir
+            ))
+    return runs
+
+
+def read_domain_run(path: str) -> Iterator[Tuple[str, int, int, int]]:
+    with open(path, 'r', encoding='utf-8') as run:
+        for line in run:
+            domain, first, last, count = line.rstrip('\n').rsplit('\t', 3)
+            yield domain, int(first), int(last), int(count)
+
+
+def unique_domains(runs: List[str]) -> Iterator[Tuple[str, int, int]]:
+    """
+    Merges the runs of `write_domain_runs` into one entry per domain, like reading the whole file
+    into a dict: the line number of its first occurrence, and the count of its last one.
+
+    :return: An iterator over (domain, first line number, count).
+    """
+    entries = heapq.merge(*map(read_domain_run, runs), key=lambda entry: entry[0])
+    for domain, group in groupby(entries, key=lambda entry: entry[0]):
+        group = list(group)
+        first = min(entry[1] for entry in group)
+        count = max(group, key=lambda entry: entry[2])[3]
+        yield domain, first, count
+
+
+def write_runs(entries: Iterable[Tuple[str, int, int]], run_size: int, tmp_dir: Optional[str]) -> Tuple[List[str], int]:
+    """
+    Writes (domain, line number, count) entries to sorted runs of at most `run_size` lines
+    `{count}\t{line number}\t{domain}`, by decreasing count and increasing line number.
+
+    :return: The paths of the runs and the total count.
+    """
+    runs, total = [], 0
+    entries = iter(entries)
+    while chunk := list(islice(entries, run_size)):
+        total += sum(count for _, _, count in chunk)
+        chunk = sorted((-count, i, domain) for domain, i, count in chunk)
+        runs.append(_write_run((f'{-count}\t{i}\t{domain}\n' for count, i, domain in chunk), tmp_dir))
+    return runs, total
+
+
+def read_run(path: str) -> Iterator[Tuple[int, int, str]]:
+    with open(path, 'r', encoding='utf-8') as run:
+        for line in run:
+            count, i, domain = line.rstrip('\n').split('\t', 2)
+            yield -int(count), int(i), domain
+
+
+def convert(filename: str, output_dir: str, run_size: int, tmp_dir: Optional[str]) -> Tuple[str, int]:
+    """
+    Writes the CSV of a `domains_per_token` file to `{output_dir}/{file name}.csv`.
+
+    :return: The path of the CSV and its number of domains.
+    """
+    csv_filename = os.path.splitext(os.path.basename(filename))[0] + '.csv'
     csv_path = os.path.join(output_dir, csv_filename)
-    with open(csv_path, 'w', newline='') as csv_file:
-        writer = csv.writer(csv_file)
-        
-        # Write the header row to the CSV file
-        writer.writerow(['domain', 'count', 'percentage', 'rank'])
-        
-        # Loop through each item in the JSON data
-        for _, item in domains_dic.items():
-            # Write a new row to the CSV file with the url and count values
-            writer.writerow([item['domain'], item['count'], item['percentage'], item['rank']])
-    print('done writing csv')
+
+    domain_runs, runs = write_domain_runs(filename, run_size, tmp_dir), []
+    try:
+        runs, total_tokens = write_runs(unique_domains(domain_runs), run_size, tmp_dir)
+        rank = 0
+        with open(f'{csv_path}.tmp', 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(['domain', 'count', 'percentage', 'rank'])
+            for rank, (count, _, domain) in enumerate(heapq.merge(*map(read_run, runs)), start=1):
+                writer.writerow([domain, -count, -count / total_tokens, rank])
+        os.replace(f'{csv_path}.tmp', csv_path)
+    finally:
+        for path in domain_runs + runs:
+            os.remove(path)
+    return csv_path, rank
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert domains_per_token files to CSV.')
+
+    parser.add_argument('--input-dir', type=str, default='skiff_files/domains_per_token',
+                        help='Directory with the domains_per_token files')
+    parser.add_argument('--output-dir', type=str, default='skiff_files/domains_per_token_csv',
+                        help='Directory to write the CSV files to')
+    parser.add_argument('--filter', type=str, help='Only convert the files whose name contains this, e.g. dolma')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of files converted in parallel')
+    parser.add_argument('--run-size', type=int, default=5_000_000,
+                        help='Lines sorted in memory at once, per job')
+    parser.add_argument('--tmp-dir', type=str, default=None, help='Directory for the sorted runs')
+
+    args = parser.parse_args()
+
+    filenames = sorted(
+        filename for filename in glob(os.path.join(args.input_dir, '*'))
+        if not os.path.isdir(filename) and (args.filter is None or args.filter in os.path.basename(filename))
+    )
+    if not filenames:
+        parser.error(f'no files to convert in {args.input_dir}')
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=min(args.jobs, len(filenames))) as executor:
+        futures = {
+            executor.submit(convert, filename, args.output_dir, args.run_size, args.tmp_dir): filename
+            for filename in filenames
+        }
+        for future in as_completed(futures):
+            csv_path, count = future.result()
+            print(f'{futures[future]}: wrote {count:,} domains to {csv_path} ({time.time() - start:.1f}s)')
+
+
+if __name__ == '__main__':
+    main()
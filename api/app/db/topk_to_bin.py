@@ -0,0 +1,45 @@
+"""
+Converts the `top-{k}_{corpus}.jsonl` files into one memory-mappable `{corpus}.topk` file per corpus.
+
+python -m app.db.topk_to_bin --input-dir /skiff_files/apps/wimdb/topk --output-dir /skiff_files/apps/wimdb/topk_bin
+"""
+
+import argparse
+import os
+import re
+from collections import defaultdict
+from glob import glob
+
+from tqdm import tqdm
+
+from app.api import read_topk
+from app.topk import TopKTable, write_topk_file
+
+TOPK_FILE_RE = re.compile(r'^top-(\d+)_(.+)\.jsonl$')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert top-k JSONL files into binary top-k files.')
+
+    parser.add_argument('--input-dir', type=str, default='/skiff_files/apps/wimdb/topk',
+                        help='Directory containing the top-{k}_{corpus}.jsonl files')
+    parser.add_argument('--output-dir', type=str, default='/skiff_files/apps/wimdb/topk_bin',
+                        help='Directory to write the {corpus}.topk files to')
+
+    args = parser.parse_args()
+
+    files_per_corpus = defaultdict(dict)
+    for filename in glob(os.path.join(args.input_dir, 'top-*_*.jsonl')):
+        match = TOPK_FILE_RE.match(os.path.basename(filename))
+        if match:
+            files_per_corpus[match.group(2)][int(match.group(1))] = filename
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for corpus, files in tqdm(sorted(files_per_corpus.items())):
+        tables = {k: TopKTable.from_dict(read_topk(filename)) for k, filename in files.items()}
+        write_topk_file(os.path.join(args.output_dir, f'{corpus}.topk'), tables)
+        print(f'{corpus}: wrote k={sorted(tables)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+from app.arrays import open_arrays, unpack_arrays
+
+
+def _utf8_upper_bound(prefix: bytes) -> Optional[bytes]:
+    """
+    :return: The smallest byte string larger than every string starting with `prefix`, or None
+        if there is none (e.g. for the empty prefix).
+    """
+    prefix = prefix.rstrip(b'\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
+
+
+def _bisect_left(offsets: np.ndarray, blob: memoryview, key: bytes, lo: int = 0, hi: Optional[int] = None) -> int:
+    """
+    Binary search over the byte strings `blob[offsets[i]:offsets[i + 1]]`, which are sorted.
+    """
+    hi = len(offsets) - 1 if hi is None else hi
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if bytes(blob[int(offsets[mid]):int(offsets[mid + 1])]) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _top_positions(rank: np.ndarray, lo: int, hi: int, limit: int) -> np.ndarray:
+    """
+    :return: The positions in [lo, hi) of the (at most) `limit` domains with the smallest rank,
+        ordered by rank. Ranks are unique and follow the counts, so this is the order of
+        `ORDER BY count DESC` with ties broken the same way as in the rank column.
+    """
+    values = rank[lo:hi]
+    if hi - lo > limit:
+        positions = np.argpartition(values, limit - 1)[:limit]
+    else:
+        positions = np.arange(hi - lo)
+    return lo + positions[np.argsort(values[positions])]
+
+
+def build_domain_index(domains: Sequence[str], counts: np.ndarray, percentage: np.ndarray, rank: np.ndarray,
+                       top_n: int = 1000, threshold: int = 50_000) -> Dict[str, np.ndarray]:
+    """
+    Builds the arrays of a `DomainIndex` from the columns of a domain CSV.
+
+    The domains are sorted by their UTF-8 bytes, so the domains starting with a prefix form a
+    contiguous range. For every prefix (a node of the byte-wise trie over the domains) whose range
+    holds more than `threshold` domains, the positions of its `top_n` domains by rank (i.e. by
+    count) are precomputed. Smaller ranges are cheap enough to rank at query time. The root (the empty prefix)
+    is always stored, which gives the top domains of the whole corpus.
+    """
+    encoded = [d.encode('utf-8') for d in domains]
+    order = sorted(range(len(encoded)), key=encoded.__getitem__)
+    encoded = [encoded[i] for i in order]
+    order = np.asarray(order, dtype=np.int64)
+
+    lengths = np.fromiter((len(d) for d in encoded), dtype=np.int64, count=len(encoded))
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    counts = np.asarray(counts, dtype=np.int64)[order]
+    rank = np.asarray(rank, dtype=np.int64)[order]
+
+    node_prefixes = [b'']
+    node_tops = [_top_positions(rank, 0, len(encoded), top_n)]
+
+    # Heavy ranges of the current depth, as (lo, hi) pairs sharing their first `depth` bytes.
+    heavy = [(0, len(encoded))] if len(encoded) > threshold else []
+    depth = 0
+    while heavy:
+        next_heavy = []
+        for lo, hi in heavy:
+            # Domains of exactly `depth` bytes sort first in the range and have no child.
+            lo = lo + int(np.searchsorted(lengths[lo:hi] > depth, True))
+            if lo >= hi:
+                continue
+            next_bytes = blob[offsets[lo:hi] + depth]
+            bounds = np.concatenate(([0], np.flatnonzero(np.diff(next_bytes)) + 1, [hi - lo])) + lo
+            for child_lo, child_hi in zip(bounds[:-1], bounds[1:]):
+                if child_hi - child_lo > threshold:
+                    node_prefixes.append(encoded[child_lo][:depth + 1])
+                    node_tops.append(_top_positions(rank, child_lo, child_hi, top_n))
+                    next_heavy.append((int(child_lo), int(child_hi)))
+        heavy = next_heavy
+        depth += 1
+
+    node_order = sorted(range(len(node_prefixes)), key=node_prefixes.__getitem__)
+    node_offsets = np.zeros(len(node_prefixes) + 1, dtype=np.int64)
+    np.cumsum([len(node_prefixes[i]) for i in node_order], out=node_offsets[1:])
+    node_top_offsets = np.zeros(len(node_prefixes) + 1, dtype=np.int64)
+    np.cumsum([len(node_tops[i]) for i in node_order], out=node_top_offsets[1:])
+
+    return {
+        'meta': np.array([top_n, threshold], dtype=np.int64),
+        'offsets': offsets,
+        'blob': blob,
+        'counts': counts,
+        'percentage': np.asarray(percentage, dtype=np.float64)[order],
+        'rank': rank,
+        'node_offsets': node_offsets,
+        'node_blob': np.frombuffer(b''.join(node_prefixes[i] for i in node_order), dtype=np.uint8),
+        'node_top_offsets': node_top_offsets,
+        'node_top': np.concatenate([node_tops[i] for i in node_order]).astype(np.int64),
+    }
+
+
+class DomainIndex:
+    """
+    An in-memory, array-backed index answering the same queries as the domain tables in Postgres:
+    the domains starting with a prefix, ordered by count. See `build_domain_index` for the layout.
+    """
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.top_n, self.threshold = (int(x) for x in arrays['meta'])
+        self.offsets = arrays['offsets']
+        self.blob = memoryview(arrays['blob'])
+        self.counts = arrays['counts']
+        self.percentage = arrays['percentage']
+        self.rank = arrays['rank']
+        self.node_offsets = arrays['node_offsets']
+        self.node_blob = memoryview(arrays['node_blob'])
+        self.node_top_offsets = arrays['node_top_offsets']
+        self.node_top = arrays['node_top']
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def _range(self, prefix: bytes):
+        lo = _bisect_left(self.offsets, self.blob, prefix)
+        upper = _utf8_upper_bound(prefix)
+        hi = len(self) if upper is None else _bisect_left(self.offsets, self.blob, upper, lo)
+        return lo, hi
+
+    def _precomputed_top(self, prefix: bytes) -> Optional[np.ndarray]:
+        i = _bisect_left(self.node_offsets, self.node_blob, prefix)
+        if i < len(self.node_offsets) - 1 and \
+                bytes(self.node_blob[int(self.node_offsets[i]):int(self.node_offsets[i + 1])]) == prefix:
+            return self.node_top[self.node_top_offsets[i]:self.node_top_offsets[i + 1]]
+        return None
+
+    def prefix_positions(self, prefix: str, limit: int) -> np.ndarray:
+        """
+        :return: The positions of the (at most `limit`) domains starting with `prefix`, by rank.
+        """
+        prefix = prefix.encode('utf-8')
+        lo, hi = self._range(prefix)
+        if hi - lo > self.threshold and limit <= self.top_n:
+            positions = self._precomputed_top(prefix)
+            if positions is not None:
+                return positions[:limit]
+
+        return _top_positions(self.rank, lo, hi, limit)
+
+    def rows(self, positions: np.ndarray) -> List[dict]:
+        offsets = self.offsets
+        return [
+            {
+                'domain': str(self.blob[int(offsets[i]):int(offsets[i + 1])], 'utf-8'),
+                'tokens': tokens,
+                'percentage': percentage,
+                'rank': rank,
+            }
+            for i, tokens, percentage, rank in zip(
+                positions.tolist(), self.counts[positions].tolist(), self.percentage[positions].tolist(),
+                self.rank[positions].tolist()
+            )
+        ]
+
+    def prefix_search(self, prefix: str, limit: int) -> List[dict]:
+        """
+        :return: The same rows as the Postgres prefix query: the domains starting with `prefix`,
+            ordered by count, as dicts with `domain`, `tokens`, `percentage` and `rank`.
+        """
+        return self.rows(self.prefix_positions(prefix, limit))
+
+
+class DomainIndexes:
+    """
+    Lazily memory-maps the `{table}.domains` files written by `app/db/build_domain_index.py`, or
+    views the `domains/{table}` sections of a bundle. Corpora without either get None, and are
+    served from Postgres instead.
+    """
+    def __init__(self, directory: str, db_map: Dict[str, str], bundle=None):
+        self.paths = {corpus: os.path.join(directory, f'{table}.domains') for corpus, table in db_map.items()}
+        self.sections = {corpus: f'domains/{table}' for corpus, table in db_map.items()}
+        self.bundle = bundle
+        self._indexes: Dict[str, Optional[DomainIndex]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, corpus: str) -> Optional[DomainIndex]:
+        if corpus not in self._indexes:
+            with self._lock:
+                if corpus not in self._indexes:
+                    path, section = self.paths.get(corpus), self.sections.get(corpus)
+                    if self.bundle is not None and section in self.bundle:
+                        self._indexes[corpus] = DomainIndex(unpack_arrays(self.bundle.section(section)))
+                    elif path and os.path.exists(path):
+                        self._indexes[corpus] = DomainIndex(open_arrays(path))
+                    else:
+                        self._indexes[corpus] = None
+        return self._indexes[corpus]
+
+
+class TopDomainsCache:
+    """
+    The top `max_count` domains of every corpus, stored as columns once they are first loaded.
+    The JSON of the counts in `common_counts` is serialized once, other counts are serialized
+    from the columns on request.
+    """
+    def __init__(self, max_count: int = 1000, common_counts: Sequence[int] = (10, 100, 1000)):
+        self.max_count = max_count
+        self.common_counts = [c for c in common_counts if c <= max_count]
+        self._columns: Dict[str, Dict[str, np.ndarray]] = {}
+        self._fragments: Dict[str, Dict[int, str]] = {}
+
+    def __contains__(self, corpus: str) -> bool:
+        return corpus in self._fragments
+
+    def put(self, corpus: str, rows: Sequence[Sequence]):
+        """
+        :param rows: The top (domain, tokens, percentage, rank) rows of the corpus, ordered by rank.
+        """
+        rows = rows[:self.max_count]
+        self._columns[corpus] = {
+            'domain': np.array([row[0] for row in rows], dtype=object),
+            'tokens': np.array([row[1] for row in rows], dtype=np.int64),
+            'percentage': np.array([row[2] for row in rows], dtype=np.float64),
+            'rank': np.array([row[3] for row in rows], dtype=np.int64),
+        }
+        self._fragments[corpus] = {count: self._serialize(corpus, count) for count in self.common_counts}
+
+    def _serialize(self, corpus: str, count: int) -> str:
+        columns = self._columns[corpus]
+        rows = [
+            {'domain': domain, 'percentage': percentage, 'rank': rank, 'tokens': tokens}
+            for domain, percentage, rank, tokens in zip(
+                columns['domain'][:count].tolist(), columns['percentage'][:count].tolist(),
+                columns['rank'][:count].tolist(), columns['tokens'][:count].tolist(),
+            )
+        ]
+        return json.dumps(rows, separators=(',', ':'))
+
+    def fragment(self, corpus: str, count: int) -> str:
+        """
+        :return: The JSON list of the top `count` domains of a corpus that's in the cache.
+        """
+        count = min(count, self.max_count)
+        fragment = self._fragments[corpus].get(count)
+        return fragment if fragment is not None else self._serialize(corpus, count)
@@ -1,40 +1,74 @@
 import logging
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from functools import cache
 from pathlib import Path
-from typing import Dict, Generator, Iterable, List, Optional, Union
+from typing import Dict, Generator, Iterable, Iterator, List, Optional, Tuple, Union
 
 import yaml
 from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import NotFoundError
+
+from app.catalog import get_catalog
+from app.export import export_hits
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_CONFIG_LOCATION = "/api/es_config.yml"
 
 
+# Transport settings that can be set under `transport:` in the config file, with their defaults.
+# `connections_per_node` is the size of the keep-alive connection pool to every ES node, which
+# bounds how many requests can be in flight to a node at once.
+DEFAULT_TRANSPORT = {
+    "connections_per_node": 10,
+    "node_class": "urllib3",
+    "http_compress": True,
+}
+
+
 @cache
 def es_init(config: Path = DEFAULT_CONFIG_LOCATION, timeout: int = 30) -> Elasticsearch:
     """
-    :param config: Path to the config yaml file, containing `cloud_id` and `api_key` fields.
+    :param config: Path to the config yaml file, containing either `cloud_id` and `api_key` fields,
+        or a list of `hosts` (e.g. a local ES). An optional `transport` section overrides
+        `DEFAULT_TRANSPORT`, and the ES_CONNECTIONS_PER_NODE environment variable overrides
+        the pool size.
     :return: Authenticated ElasticSearch client.
+
+    Example config:
+
+        cloud_id: ...
+        api_key: ...
+        transport:
+          connections_per_node: 32
+          node_class: requests
     """
     with open(config) as file_ref:
         config = yaml.safe_load(file_ref)
 
-    cloud_id = config["cloud_id"]
-    api_key = config.get("api_key", os.getenv("ES_API_KEY", None))
-    if not api_key:
-        raise RuntimeError(
-            f"Please specify ES_API_KEY environment variable or add api_key to {DEFAULT_CONFIG_LOCATION}."
-        )
+    transport = {**DEFAULT_TRANSPORT, **config.get("transport", {})}
+    if os.getenv("ES_CONNECTIONS_PER_NODE"):
+        transport["connections_per_node"] = int(os.getenv("ES_CONNECTIONS_PER_NODE"))
+
+    if "hosts" in config:
+        connection = {"hosts": config["hosts"]}
+        if config.get("api_key"):
+            connection["api_key"] = config["api_key"]
+    else:
+        cloud_id = config["cloud_id"]
+        api_key = config.get("api_key", os.getenv("ES_API_KEY", None))
+        if not api_key:
+            raise RuntimeError(
+                f"Please specify ES_API_KEY environment variable or add api_key to {DEFAULT_CONFIG_LOCATION}."
+            )
+        connection = {"cloud_id": cloud_id, "api_key": api_key}
 
     es = Elasticsearch(
-        cloud_id=cloud_id,
-        api_key=api_key,
+        **connection,
         retry_on_timeout=True,
-        http_compress=True,
         request_timeout=timeout,
+        **transport,
     )
 
     return es
@@ -45,28 +79,15 @@ def get_indices(
 ) -> Dict:
     """
     :param return_mapping: Whether to return mapping along with index information.
-    :return: Dictionary of existing indices.
+    :return: Dictionary of existing indices, from the catalog of the cluster (see `app/catalog.py`).
     """
     es = es or es_init()
 
-    indices = es.cat.indices(format="json")
-    exclude = [
-        "search-test",
-        "test-index-2",
-        "metrics-endpoint.metadata_current_default",
-    ]
-    indices = {
-        index["index"]: {key: index[key] for key in ["docs.count"]}
-        for index in indices
-        if not index["index"].startswith(".") and not index["index"] in exclude
-    }
-
-    if return_mapping:
-        mappings = es.indices.get_mapping(index=list(indices.keys()))
-        for key in mappings:
-            indices[key]["properties"] = list(
-                mappings[key]["mappings"]["properties"].keys()
-            )
+    indices = {}
+    for name, info in get_catalog(es).indices().items():
+        indices[name] = {"docs.count": str(info.docs_count)}
+        if return_mapping:
+            indices[name]["properties"] = list(info.properties)
 
     return indices
 
@@ -149,6 +170,56 @@ def count_documents_containing_phrases(
     return result["count"]
 
 
+def count_documents_in_indices(
+    indices: List[str],
+    phrases: Union[str, List[str]],
+    all_phrases: bool = False,
+    is_regexp: bool = False,
+    timeout: str = "10s",
+    es: Optional[Elasticsearch] = None,
+) -> List[Optional[int]]:
+    """
+    :param indices: Names of the indices to count in. They should all live on the cluster of `es`.
+    :param phrases: A single string or a list of strings to be matched in the `text` field
+        of the indices.
+    :param all_phrases: Whether the document should contain all phrases (AND clause) or any
+        of the phrases (OR clause).
+    :param is_regexp: Whether the phrases are regular expressions.
+    :param timeout: The time each index has to answer. An index that times out or fails gets
+        a count of `None`, without failing the other indices.
+    :return: The number of documents matching the conditions in each index, computed with a
+        single `msearch` call.
+
+    Examples:
+
+        count_documents_in_indices(["c4", "re_oscar"], "legal")  # [c4 count, re_oscar count]
+    """
+    es = es or es_init()
+
+    query = _query_documents_contain_phrases(phrases, all_phrases, is_regexp=is_regexp)
+    searches = []
+    for index in indices:
+        searches.append({"index": index})
+        searches.append(
+            {"size": 0, "query": query, "track_total_hits": True, "timeout": timeout}
+        )
+
+    results = es.msearch(searches=searches, rest_total_hits_as_int=True)
+
+    counts = []
+    for index, result in zip(indices, results["responses"]):
+        if "error" in result:
+            logger.warning(f"Counting in '{index}' failed: {result['error']}")
+            counts.append(None)
+        elif result.get("timed_out"):
+            # The total is only a lower bound when the search timed out.
+            logger.warning(f"Counting in '{index}' timed out after {timeout}.")
+            counts.append(None)
+        else:
+            counts.append(result["hits"]["total"])
+    return counts
+
+
 # def multiple_count_documents_containing_phrases(
 #     index: str,
 #     phrases: Union[str, List[str]],
@@ -214,33 +285,94 @@ def get_documents_containing_phrases(
     query = _query_documents_contain_phrases(phrases, all_phrases, is_regexp=is_regexp)
 
     if return_all_hits:
-        sort = [{sort_field: "asc"}]
-        pit = es.open_point_in_time(index=index, keep_alive="1m")
-        pit_search = {"id": pit["id"], "keep_alive": "1m"}
-        # all_results = []
-        results = es.search(index=index, query=query, size=num_documents, sort=sort)[
-            "hits"
-        ]["hits"]
-        yield from results
-        while len(results) > 0:
-            # todo: perhaps we need to refresh pit?
-            results = es.search(
-                index=index,
-                query=query,
-                size=num_documents,
-                sort=sort,
-                search_after=results[-1]["sort"],
-            )["hits"]["hits"]
-            yield from results
-        try:
-            es.close_point_in_time(id=pit["id"])
-        except NotFoundError:
-            # Already closed.
-            pass
+        # `num_documents` is the page size of the export.
+        pages = export_hits(index, query, es=es, page_size=num_documents, sort=[{sort_field: "asc"}])
+        return (hit for hits, _ in pages for hit in hits)
     else:
         return es.search(index=index, query=query, size=num_documents)["hits"]["hits"]
 
 
+def sample_documents_containing_phrases(
+    index: str,
+    phrases: Union[str, List[str]],
+    all_phrases: bool = False,
+    num_documents: int = 10,
+    source: Union[bool, Dict] = False,
+    fragment_size: int = 150,
+    number_of_fragments: int = 3,
+    timeout: str = "10s",
+    es: Optional[Elasticsearch] = None,
+) -> List[Dict]:
+    """
+    Like `get_documents_containing_phrases`, but returns the passages of the documents around the
+    phrases rather than the documents, which can be very large.
+
+    :param source: The `_source` parameter of the search. By default, no fields are returned.
+    :param fragment_size: The length of a passage, in characters.
+    :param number_of_fragments: The largest number of passages per document.
+    :return: The `index` and `id` of each hit, its `highlights`, passages of `text` with the
+        phrases in `<em>` tags, and its `source` if `source` isn't False.
+    """
+    es = es or es_init()
+
+    if isinstance(phrases, str):
+        phrases = [phrases]
+    query = _query_documents_contain_phrases(phrases, all_phrases)
+    highlight = {
+        "fields": {"text": {"fragment_size": fragment_size, "number_of_fragments": number_of_fragments}},
+        # Every phrase is highlighted, whether the documents must contain any or all of them.
+        "highlight_query": {"bool": {"should": [{"match_phrase": {"text": phrase}} for phrase in phrases]}},
+    }
+    hits = es.search(
+        index=index,
+        query=query,
+        size=num_documents,
+        source=source,
+        highlight=highlight,
+        track_total_hits=False,
+        timeout=timeout,
+    )["hits"]["hits"]
+
+    samples = []
+    for hit in hits:
+        sample = {
+            "index": hit["_index"],
+            "id": hit["_id"],
+            "highlights": hit.get("highlight", {}).get("text", []),
+        }
+        if source is not False:
+            sample["source"] = hit.get("_source", {})
+        samples.append(sample)
+    return samples
+
+
+def export_documents_containing_phrases(
+    index: str,
+    phrases: Union[str, List[str]],
+    all_phrases: bool = False,
+    is_regexp: bool = False,
+    slices: int = 1,
+    page_size: int = 1000,
+    limit: Optional[int] = None,
+    source: Union[bool, Dict] = True,
+    cursor: Optional[str] = None,
+    es: Optional[Elasticsearch] = None,
+) -> Iterator[Tuple[List[Dict], Optional[str]]]:
+    """
+    Exports every document matching the phrases, like `get_documents_containing_phrases`, in pages.
+    See `app.export.export_hits` for the slices, the limit and the cursors.
+
+    :return: An iterator over pages of hits, each with the cursor resuming after it, or None after
+        the last page.
+    """
+    es = es or es_init()
+
+    query = _query_documents_contain_phrases(phrases, all_phrases, is_regexp=is_regexp)
+    return export_hits(
+        index, query, es=es, slices=slices, page_size=page_size, limit=limit, source=source, cursor=cursor
+    )
+
+
 def count_documents_for_each_phrase(
     index: str,
     phrases: Union[str, Iterable[str], Iterable[List[str]]],
@@ -270,7 +402,6 @@ def count_documents_for_each_phrase(
                 "`all_phrases` is set to False, please provide a list of strings."
             )
     es = es or es_init()
-    num_shards = len(es.cat.shards(index=index, format="json"))
     final_counts = []
 
     done = False
@@ -287,6 +418,7 @@ def count_documents_for_each_phrase(
             queries.append({"index": index, "search_type": "query_then_fetch"})
             queries.append(
                 {
+                    "size": 0,
                     "stored_fields": [],
                     "timeout": timeout,
                     "track_scores": False,
@@ -294,7 +426,7 @@ def count_documents_for_each_phrase(
                     "query": {"bool": {"filter": match_query}},
                 }
             )
-            if i == batch_size:
+            if i + 1 == batch_size:
                 break
         if len(queries) == 0:
             done = True
@@ -305,20 +437,75 @@ def count_documents_for_each_phrase(
             search_type="query_then_fetch",
             rest_total_hits_as_int=True,
         )
-        final_counts += [r["hits"]["total"] for r in results["responses"]]
+        # A failed search gets a count of `None` rather than failing the whole batch, and so does
+        # one that timed out, whose total is only a lower bound.
+        timed_out = sum(1 for r in results["responses"] if "error" not in r and r.get("timed_out"))
+        if timed_out:
+            logger.warning(f"Counting {timed_out} phrases in '{index}' timed out after {timeout}.")
+        final_counts += [
+            None if "error" in r or r.get("timed_out") else r["hits"]["total"]
+            for r in results["responses"]
+        ]
     return final_counts
 
 
+def get_primary_shards(
+    index: str, es: Optional[Elasticsearch] = None
+) -> List[Tuple[str, int]]:
+    """
+    :param index: Name of the index, or a pattern matching several indices.
+    :return: The (concrete index, shard number) of every primary shard, from the catalog of the
+        cluster, or from ES if the catalog doesn't know the index yet.
+    """
+    es = es or es_init()
+    shards = get_catalog(es).primary_shards(index)
+    if shards:
+        return shards
+
+    rows = es.cat.shards(index=index, format="json")
+    return sorted(
+        {(row["index"], int(row["shard"])) for row in rows if row.get("prirep", "p") == "p"}
+    )
+
+
+class InvalidTermError(ValueError):
+    """
+    A term that the analyzer of the `text` field doesn't turn into exactly one token.
+    """
+
+
+def analyze_terms(
+    index: str, terms: List[str], es: Optional[Elasticsearch] = None, max_concurrency: int = 8
+) -> Dict[str, List[str]]:
+    """
+    :param index: Name of a concrete index, whose `text` field analyzer is used.
+    :return: The tokens each term is indexed as, e.g. `["u.s"]` for "U.S.".
+    """
+    es = es or es_init()
+
+    def analyze(term: str) -> List[str]:
+        return [token["token"] for token in es.indices.analyze(index=index, field="text", text=term)["tokens"]]
+
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="es-analyze") as executor:
+        return dict(zip(terms, executor.map(analyze, terms)))
+
+
 def count_total_occurrences_of_unigrams(
     index: str,
     unigrams: Union[str, List[str]],
     es: Optional[Elasticsearch] = None,
+    max_concurrency: int = 8,
+    batch_size: int = 500,
 ) -> Dict[str, int]:
     """
-    :param index: Name of the index
-    :param terms: A single unigram or a list of unigrams to be matched in the `text` field
+    :param index: Name of the index, or a pattern matching several indices.
+    :param unigrams: A single unigram or a list of unigrams to be matched in the `text` field
         of the index.
-    :return: The total number of occurrences of each unigram in `terms` across all documents.
+    :param max_concurrency: The largest number of ES requests in flight at once.
+    :param batch_size: The largest number of searches per `msearch`, and of documents per `mtermvectors`.
+    :return: The total number of occurrences of each unigram across all documents. A unigram is
+        counted as the token the analyzer of the `text` field turns it into, e.g. "Legal" as "legal".
+    :raises InvalidTermError: If a unigram isn't analyzed into exactly one token.
 
     Examples:
 
@@ -328,6 +515,7 @@ def count_total_occurrences_of_unigrams(
     """
     if isinstance(unigrams, str):
         unigrams = [unigrams]
+    unigrams = list(dict.fromkeys(unigrams))
 
     es = es or es_init()
 
@@ -335,42 +523,100 @@ def count_total_occurrences_of_unigrams(
     # is to return term statistics for a randomly selected shard. For more information on term vector behaviour, please
     # see the following:
     # https://www.elastic.co/guide/en/elasticsearch/reference/master/docs-termvectors.html#docs-termvectors-api-behavior
-    num_shards = len(es.cat.shards(index=index, format="json"))
-
-    logger.debug(f"Total number of shards in '{index}': {num_shards}")
-
-    term_freq_dict = {}
-    for term in unigrams:
-        query = {"bool": {"filter": {"match": {"text": term}}}}
-
-        total_freq = 0
-        for i in range(num_shards):
-            documents = es.search(
-                index=index,
-                query=query,
-                preference=f"_shards:{i}",
-                stored_fields=[],
-                track_total_hits=False,
+    #
+    # The term statistics of a shard come with the term vector of any of its documents containing
+    # the term. So every shard gets one search per term for such a document (all of them in a few
+    # `msearch` calls), and then one `mtermvectors` call for the documents it returned.
+    shards = get_primary_shards(index, es=es)
+    logger.debug(f"Total number of primary shards in '{index}': {len(shards)}")
+    if not shards:
+        raise RuntimeError(f"No primary shards found for '{index}'.")
+
+    # Term vectors hold the analyzed tokens, so the unigrams are looked up as those.
+    analyzed = analyze_terms(shards[0][0], unigrams, es=es, max_concurrency=max_concurrency)
+    for term, tokens in analyzed.items():
+        if len(tokens) != 1:
+            raise InvalidTermError(f"'{term}' is indexed as {len(tokens)} terms: {tokens}.")
+    tokens = {term: analyzed[term][0] for term in unigrams}
+
+    searches = [(shard, term) for shard in shards for term in unigrams]
+
+    def find_documents(batch: List[Tuple[Tuple[str, int], str]]) -> List[Optional[str]]:
+        body = []
+        for (shard_index, shard), term in batch:
+            body.append({"index": shard_index, "preference": f"_shards:{shard}"})
+            body.append(
+                {
+                    "size": 1,
+                    "query": {"bool": {"filter": {"match": {"text": term}}}},
+                    "stored_fields": [],
+                    "track_total_hits": False,
+                }
             )
-
-            if len(documents["hits"]["hits"]) > 0:
-                doc_id = documents["hits"]["hits"][0]["_id"]
-
-                term_vector = es.termvectors(
-                    index=index,
-                    id=doc_id,
-                    fields=["text"],
-                    positions=False,
-                    term_statistics=True,
-                    preference=f"_shards:{i}",
-                )
-
-                ttf = term_vector["term_vectors"]["text"]["terms"][term]["ttf"]
-                logger.debug(f"Total term frequency for shard {i}: {ttf}")
-                total_freq += ttf
-
+        results = es.msearch(searches=body)
+        doc_ids = []
+        for ((shard_index, shard), term), result in zip(batch, results["responses"]):
+            if "error" in result:
+                raise RuntimeError(f"Searching for '{term}' in shard {shard} of '{shard_index}' failed: {result['error']}")
+            hits = result["hits"]["hits"]
+            doc_ids.append(hits[0]["_id"] if hits else None)
+        return doc_ids
+
+    def term_frequencies(shard: Tuple[str, int], doc_ids: List[str]) -> Dict[str, Dict[str, int]]:
+        shard_index, shard_number = shard
+        results = es.mtermvectors(
+            index=shard_index,
+            docs=[
+                {
+                    "_id": doc_id,
+                    "fields": ["text"],
+                    "term_statistics": True,
+                    "positions": False,
+                    "offsets": False,
+                    "payloads": False,
+                }
+                for doc_id in doc_ids
+            ],
+            preference=f"_shards:{shard_number}",
+        )
+        return {
+            doc["_id"]: {term: stats.get("ttf", 0) for term, stats in doc["term_vectors"]["text"]["terms"].items()}
+            for doc in results["docs"]
+            if doc.get("found") and "text" in doc.get("term_vectors", {})
+        }
+
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="es-ttf") as executor:
+        batches = [searches[i:i + batch_size] for i in range(0, len(searches), batch_size)]
+        doc_ids = [doc_id for ids in executor.map(find_documents, batches) for doc_id in ids]
+
+        docs_per_shard = defaultdict(dict)
+        for (shard, term), doc_id in zip(searches, doc_ids):
+            if doc_id is not None:
+                docs_per_shard[shard].setdefault(doc_id, []).append(term)
+
+        jobs = []
+        for shard, docs in docs_per_shard.items():
+            ids = list(docs)
+            jobs += [(shard, ids[i:i + batch_size]) for i in range(0, len(ids), batch_size)]
+        frequencies = executor.map(lambda job: (job[0], job[1], term_frequencies(*job)), jobs)
+
+        term_freq_dict = {term: 0 for term in unigrams}
+        for shard, ids, ttfs in frequencies:
+            if len(ttfs) != len(ids):
+                raise RuntimeError(f"Missing term vectors of {set(ids) - set(ttfs)} in shard {shard}.")
+            for doc_id, doc_ttfs in ttfs.items():
+                for term in docs_per_shard[shard][doc_id]:
+                    ttf = doc_ttfs.get(tokens[term])
+                    if ttf is None:
+                        # The document matched the term, so its term vector has to contain the token.
+                        raise RuntimeError(
+                            f"The term vector of document '{doc_id}' in shard {shard} has no '{tokens[term]}'."
+                        )
+                    logger.debug(f"Total term frequency of '{term}' in shard {shard}: {ttf}")
+                    term_freq_dict[term] += ttf
+
+    for term, total_freq in term_freq_dict.items():
         logger.info(
             f"The term: '{term}' occurs {total_freq} times across all documents in '{index}'."
         )
-        term_freq_dict[term] = total_freq
     return term_freq_dict
@@ -0,0 +1,153 @@
+import base64
+import hashlib
+import json
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import NotFoundError
+
+logger = logging.getLogger(__name__)
+
+# Hits per search.
+EXPORT_PAGE_SIZE = 1000
+# How long ES keeps the point in time open after the last page, and so how long a cursor can be resumed.
+EXPORT_KEEP_ALIVE = "5m"
+# The largest number of slices an export is split into.
+EXPORT_MAX_SLICES = 8
+
+
+class CursorError(ValueError):
+    """
+    A cursor that can't be resumed: malformed, for another query, or whose point in time expired.
+    """
+
+
+def _query_digest(index: str, query: Dict, options: Any) -> str:
+    return hashlib.sha1(json.dumps([index, query, options], sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def encode_cursor(state: Dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Dict:
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        assert isinstance(state["pit"], str) and isinstance(state["after"], list)
+        assert isinstance(state["done"], list) and len(state["done"]) == len(state["after"])
+    except Exception:
+        raise CursorError("Invalid cursor.")
+    return state
+
+
+def export_hits(
+    index: str,
+    query: Dict,
+    es: Elasticsearch,
+    slices: int = 1,
+    page_size: int = EXPORT_PAGE_SIZE,
+    limit: Optional[int] = None,
+    source: Any = True,
+    sort: Optional[List] = None,
+    keep_alive: str = EXPORT_KEEP_ALIVE,
+    cursor: Optional[str] = None,
+) -> Iterator[Tuple[List[Dict], Optional[str]]]:
+    """
+    Pages through every hit of `query`, in a point in time of the index, so the export sees a
+    consistent snapshot however long it takes.
+
+    The point in time is split into `slices` slices, paged with `search_after` in parallel. Every
+    slice has one search in flight: the next page of a slice is fetched while the caller consumes
+    the current one. Every search extends the point in time by `keep_alive`.
+
+    :param index: Name of the index, or a pattern matching several indices.
+    :param limit: The largest number of hits to export, if any.
+    :param source: The `_source` parameter of the searches, e.g. `{"includes": ["url"]}`.
+    :param sort: The order of the hits within a slice. By default, the order of the shards and
+        documents, which is the cheapest.
+    :param cursor: A cursor returned by a previous export of the same query, to resume it from there,
+        with its slices and limit.
+    :return: An iterator over pages of hits, in the order they arrive, each with the cursor
+        resuming after it, or None after the last page. Stopping early leaves the point in time
+        open until it expires, so the last cursor can be resumed.
+    :raises CursorError: If `cursor` can't be resumed, on the first `next`.
+    """
+    sort = sort or [{"_shard_doc": "asc"}]
+    digest = _query_digest(index, query, [source, sort])
+    if cursor is not None:
+        state = decode_cursor(cursor)
+        if state.get("query") != digest:
+            raise CursorError("The cursor is for another query.")
+    else:
+        pit = es.open_point_in_time(index=index, keep_alive=keep_alive)
+        slices = max(1, min(slices, EXPORT_MAX_SLICES))
+        state = {"query": digest, "pit": pit["id"], "after": [None] * slices, "done": [False] * slices,
+                 "remaining": limit}
+    num_slices = len(state["after"])
+
+    def fetch(i: int, after: Optional[List]) -> List[Dict]:
+        body = {
+            "pit": {"id": state["pit"], "keep_alive": keep_alive},
+            "query": query,
+            "size": page_size,
+            "sort": sort,
+            "track_total_hits": False,
+            "source": source,
+        }
+        if num_slices > 1:
+            body["slice"] = {"id": i, "max": num_slices}
+        if after is not None:
+            body["search_after"] = after
+        try:
+            response = es.search(**body)
+        except NotFoundError:
+            raise CursorError("The point in time of the export expired.")
+        # ES may return a new id for the point in time, to be used by the next searches.
+        state["pit"] = response.get("pit_id", state["pit"])
+        return response["hits"]["hits"]
+
+    def close():
+        try:
+            es.close_point_in_time(id=state["pit"])
+        except NotFoundError:
+            # Already closed.
+            pass
+
+    executor = ThreadPoolExecutor(max_workers=num_slices, thread_name_prefix="export")
+    pending = {}
+    try:
+        for i in range(num_slices):
+            if not state["done"][i]:
+                pending[executor.submit(fetch, i, state["after"][i])] = i
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = pending.pop(future)
+                hits = future.result()
+                if state.get("remaining") is not None:
+                    hits = hits[:state["remaining"]]
+                    state["remaining"] -= len(hits)
+
+                if len(hits) < page_size or state.get("remaining") == 0:
+                    state["done"][i] = True
+                else:
+                    # Prefetch the next page of the slice while this one is consumed.
+                    pending[executor.submit(fetch, i, hits[-1]["sort"])] = i
+                if hits:
+                    state["after"][i] = hits[-1]["sort"]
+
+                if state.get("remaining") == 0:
+                    state["done"] = [True] * num_slices
+                if all(state["done"]):
+                    close()
+                    yield hits, None
+                    return
+                if hits:
+                    yield hits, encode_cursor(state)
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.arrays import open_arrays, unpack_arrays, write_arrays
+
+logger = logging.getLogger(__name__)
+
+# Points with a lower probability are left out of the curves, they're indistinguishable from 0 in the plot.
+MIN_PROBABILITY = 1e-7
+
+
+def read_length_distribution(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads a `lengths_char_summary` file, a JSON object from document lengths to their probability.
+
+    :return: The lengths in ascending order and their probabilities.
+    """
+    with open(path, 'r') as f:
+        data = json.load(f)
+    sizes = np.fromiter((int(size) for size in data), dtype=np.int64, count=len(data))
+    probs = np.fromiter((float(p) for p in data.values()), dtype=np.float64, count=len(data))
+    order = np.argsort(sizes, kind='stable')
+    return sizes[order], probs[order]
+
+
+def stratify(probs: np.ndarray) -> np.ndarray:
+    """
+    :return: The positions of the default curve: every point up to 100, then every 25th point up to
+        8005, every 3rd up to 10000 (to show e.g. the spike around 9K characters in The Pile), and
+        every 25th after that, leaving out the points below `MIN_PROBABILITY`.
+    """
+    n = len(probs)
+    positions = np.concatenate([
+        np.arange(0, min(n, 100)),
+        np.arange(100, min(n, 8005), 25),
+        np.arange(8005, min(n, 10000), 3),
+        np.arange(10000, n, 25),
+    ])
+    return positions[probs[positions] > MIN_PROBABILITY]
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int, log_x: bool = True) -> np.ndarray:
+    """
+    Largest-triangle-three-buckets downsampling.
+
+    The points between the first and the last one are split into `points - 2` buckets, and each
+    bucket keeps the point forming the largest triangle with the point kept from the previous
+    bucket and the average of the next bucket. With `log_x`, buckets have the same width on a
+    log scale, as the curves are plotted, so short lengths keep all their points. Buckets that
+    would be empty are dropped, so fewer than `points` points may be returned.
+
+    :param x: Ascending, and non-negative if `log_x` is set.
+    :return: The positions of the kept points, in ascending order.
+    """
+    n = len(x)
+    if n <= points or n <= 2:
+        return np.arange(n)
+    if points < 3:
+        raise ValueError('LTTB needs at least 3 points.')
+
+    u = np.log1p(x) if log_x else x.astype(np.float64)
+    y = y.astype(np.float64)
+
+    edges = np.searchsorted(u, np.linspace(u[1], u[n - 1], points - 1))
+    edges[0], edges[-1] = 1, n - 1
+    edges = np.unique(edges)
+    starts, ends = edges[:-1], edges[1:]
+
+    # The average point of every bucket, and the last point as the "bucket" after the last one.
+    sizes = ends - starts
+    next_u = np.append(np.add.reduceat(u[:n - 1], starts) / sizes, u[-1])[1:]
+    next_y = np.append(np.add.reduceat(y[:n - 1], starts) / sizes, y[-1])[1:]
+
+    positions = np.empty(len(starts) + 2, dtype=np.int64)
+    positions[0], positions[-1] = 0, n - 1
+    a = 0
+    for i, (lo, hi) in enumerate(zip(starts.tolist(), ends.tolist())):
+        if hi - lo > 1:
+            area = np.abs((u[a] - next_u[i]) * (y[lo:hi] - y[a]) - (u[a] - u[lo:hi]) * (next_y[i] - y[a]))
+            a = lo + int(np.argmax(area))
+        else:
+            a = lo
+        positions[i + 1] = a
+    return positions
+
+
+def _shortest_float64(values: np.ndarray) -> np.ndarray:
+    """
+    :return: `values` (e.g. float32) as the float64 of their shortest decimal representation, so
+        0.005 as float32 is serialized as 0.005 rather than 0.004999999888241291.
+    """
+    return values.astype(str).astype(np.float64)
+
+
+class LengthDistribution:
+    """
+    The document length distribution of a corpus: the lengths in ascending order, their probability
+    as float32, and the cumulative probabilities as float64 (with a leading 0, so the probability
+    of the lengths at positions [lo, hi) is `cumsum[hi] - cumsum[lo]`).
+
+    Windows, masses, percentiles and bins are binary searches over these arrays.
+    """
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.sizes = arrays['sizes']
+        self.probs = arrays['probs']
+        self.cumsum = arrays['cumsum']
+        self.curve_positions = arrays['curve']
+
+    @staticmethod
+    def build_arrays(sizes: np.ndarray, probs: np.ndarray) -> Dict[str, np.ndarray]:
+        cumsum = np.zeros(len(probs) + 1, dtype=np.float64)
+        np.cumsum(probs, out=cumsum[1:])
+        return {
+            'sizes': sizes.astype(np.int64),
+            'probs': probs.astype(np.float32),
+            'cumsum': cumsum,
+            'curve': stratify(probs),
+        }
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def window(self, min_len: Optional[int] = None, max_len: Optional[int] = None) -> Tuple[int, int]:
+        """
+        :return: The range [lo, hi) of the positions of the lengths in [min_len, max_len].
+        """
+        lo = 0 if min_len is None else int(np.searchsorted(self.sizes, min_len, side='left'))
+        hi = len(self) if max_len is None else int(np.searchsorted(self.sizes, max_len, side='right'))
+        return lo, max(lo, hi)
+
+    def _points(self, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        return self.sizes[positions], _shortest_float64(self.probs[positions])
+
+    def curve(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: The lengths and probabilities of the default curve.
+        """
+        return self._points(self.curve_positions)
+
+    def downsample(self, points: int, min_len: Optional[int] = None,
+                   max_len: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: At most `points` lengths and probabilities picked by `lttb` among the lengths in
+            [min_len, max_len] with a probability of at least `MIN_PROBABILITY`.
+        """
+        lo, hi = self.window(min_len, max_len)
+        visible = lo + np.flatnonzero(self.probs[lo:hi] > MIN_PROBABILITY)
+        return self._points(visible[lttb(self.sizes[visible], self.probs[visible], points)])
+
+    def mass(self, min_len: Optional[int] = None, max_len: Optional[int] = None) -> float:
+        """
+        :return: The probability of a document length in [min_len, max_len].
+        """
+        lo, hi = self.window(min_len, max_len)
+        return float(self.cumsum[hi] - self.cumsum[lo])
+
+    def percentiles(self, qs: Sequence[float], min_len: Optional[int] = None,
+                    max_len: Optional[int] = None) -> List[Optional[int]]:
+        """
+        :param qs: Quantiles in [0, 1], e.g. 0.5 for the median.
+        :return: For every quantile, the smallest length in [min_len, max_len] such that at least
+            that fraction of the documents in the window is at most that long. None if the window
+            is empty.
+        """
+        lo, hi = self.window(min_len, max_len)
+        total = self.cumsum[hi] - self.cumsum[lo]
+        if total <= 0:
+            return [None] * len(qs)
+        targets = self.cumsum[lo] + np.asarray(qs, dtype=np.float64) * total
+        # The first position whose cumulative probability reaches the target, within the window.
+        ends = np.clip(np.searchsorted(self.cumsum, targets, side='left'), lo + 1, hi)
+        return self.sizes[ends - 1].tolist()
+
+    def bin_edges(self, count: int, min_len: Optional[int] = None, max_len: Optional[int] = None,
+                  log: bool = False) -> np.ndarray:
+        """
+        :return: The edges of (at most) `count` bins covering [min_len, max_len] (by default, all the
+            lengths), of the same width on a linear or on a log scale. Bins that would be narrower than
+            one character are merged. A window past the shortest or the longest length gets a single,
+            empty, bin at its bound.
+        """
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+        start = int(self.sizes[0]) if min_len is None else min_len
+        stop = (int(self.sizes[-1]) if max_len is None else max_len) + 1
+        if min_len is None:
+            start = min(start, stop - 1)
+        stop = max(stop, start + 1)
+        if log:
+            edges = np.geomspace(max(start, 1), stop, count + 1)
+            edges[0] = start
+        else:
+            edges = np.linspace(start, stop, count + 1)
+        return np.unique(np.round(edges).astype(np.int64))
+
+    def bins(self, edges: Sequence[int]) -> np.ndarray:
+        """
+        :param edges: Ascending lengths, bin `i` holds the lengths in [edges[i], edges[i + 1]).
+        :return: The probability of every bin.
+        """
+        cumulative = self.cumsum[np.searchsorted(self.sizes, edges, side='left')]
+        return np.diff(cumulative)
+
+
+class LengthDistributions:
+    """
+    The `LengthDistribution` of every corpus.
+
+    They're either viewed from the `lengths/{file name}` sections of a bundle, or loaded from the
+    JSON files. Parsing those happens once: the arrays are written to `{cache_dir}/{file name}.lengths`
+    (in the layout of `app/arrays.py`), and memory-mapped from there as long as it's newer than the
+    JSON file.
+    """
+    def __init__(self, dists: Dict[str, LengthDistribution]):
+        self._dists = dists
+
+    @classmethod
+    def from_files(cls, json_dir: str, cache_dir: Optional[str], files_map: Dict[str, str]) -> 'LengthDistributions':
+        return cls({
+            corpus: LengthDistribution(cls._load(
+                os.path.join(json_dir, f'chars_{file_name}.json'),
+                os.path.join(cache_dir, f'{file_name}.lengths') if cache_dir else None,
+            ))
+            for corpus, file_name in files_map.items()
+        })
+
+    @classmethod
+    def from_bundle(cls, bundle, files_map: Dict[str, str]) -> 'LengthDistributions':
+        return cls({
+            corpus: LengthDistribution(unpack_arrays(bundle.section(f'lengths/{file_name}')))
+            for corpus, file_name in files_map.items()
+        })
+
+    @staticmethod
+    def _load(json_path: str, cache_path: Optional[str]) -> Dict[str, np.ndarray]:
+        if cache_path and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(json_path):
+            arrays = open_arrays(cache_path)
+            # Files written before the cumulative sums were added are rebuilt.
+            if 'cumsum' in arrays:
+                return arrays
+
+        arrays = LengthDistribution.build_arrays(*read_length_distribution(json_path))
+        if cache_path:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                write_arrays(cache_path, arrays)
+            except OSError as e:
+                logger.warning(f'Could not cache the length distribution of {json_path}: {e}')
+        return arrays
+
+    def __contains__(self, corpus: str) -> bool:
+        return corpus in self._dists
+
+    def __getitem__(self, corpus: str) -> LengthDistribution:
+        return self._dists[corpus]
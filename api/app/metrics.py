@@ -0,0 +1,168 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+from flask import Blueprint, g, request
+
+# Upper bounds, in seconds, of the buckets of the latency histograms.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The content type of the Prometheus text exposition format.
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + '}'
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """
+    A thread-safe histogram with one series per combination of label values, rendered in the
+    Prometheus text format (cumulative `_bucket` counts, `_sum` and `_count`).
+    """
+    def __init__(self, name: str, help: str, labelnames: Sequence[str], buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Label values -> (counts per bucket, with a last one for +Inf, sum).
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][i] += 1
+            series[1][0] += value
+
+    def render(self, const_labels: Sequence[Tuple[str, str]] = ()) -> List[str]:
+        """
+        :param const_labels: (name, value) of labels added to every series, e.g. the worker.
+        """
+        const_names, const_values = [name for name, _ in const_labels], [value for _, value in const_labels]
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labelvalues, list(counts), total[0]) for labelvalues, (counts, total) in self._series.items())
+        for labelvalues, counts, total in series:
+            cumulative = 0
+            for bound, count in zip([*map(_number, self.buckets), '+Inf'], counts):
+                cumulative += count
+                labels = _labels([*const_names, *self.labelnames, 'le'], [*const_values, *labelvalues, bound])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _labels([*const_names, *self.labelnames], [*const_values, *labelvalues])
+            lines.append(f'{self.name}_sum{labels} {_number(total)}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Metrics:
+    """
+    Latencies of the API, exposed in the Prometheus text format:
+
+    - `wimbd_request_duration_seconds{endpoint, method, status}`: handling a request, until its
+      response (for streamed responses, its first line) is returned.
+    - `wimbd_span_duration_seconds{span, target}`: the parts of a request, e.g. an ES query
+      (`es.count` on a cluster), a Postgres query (`pg.domain_prefix` on a corpus), waiting for a
+      pooled connection (`pg.pool_wait`), or building, serializing and compressing a response
+      (`response.build`, `response.serialize` and `response.prepare` for an endpoint).
+    - `wimbd_cache_events_total{cache, event}`, `wimbd_cache_entries{cache}` and `wimbd_cache_bytes{cache}`:
+      the hits, misses, etc. and the size of the caches registered with `add_cache`.
+
+    The metrics are per process, and every series has a `worker` label with the pid of its process:
+    with the pre-fork server (see `app/prefork.py`), a scrape lands on any of the workers, and
+    reports the requests that worker served. The counters of a worker only ever grow, so `rate()`
+    works per worker, and summing over `worker` gives the whole server.
+    """
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.requests = Histogram('wimbd_request_duration_seconds', 'Time to handle a request.',
+                                  ['endpoint', 'method', 'status'], buckets)
+        self.spans = Histogram('wimbd_span_duration_seconds', 'Time spent in a part of a request.',
+                               ['span', 'target'], buckets)
+        self._caches: Dict[str, Callable[[], Dict[str, int]]] = {}
+
+    def observe(self, span: str, seconds: float, target: str = ''):
+        self.spans.observe(seconds, span, target)
+
+    @contextmanager
+    def span(self, span: str, target: str = '') -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(span, time.perf_counter() - start, target)
+
+    def timed(self, span: str, target: str, fn: Callable) -> Callable:
+        """
+        :return: `fn`, recording the time of every call as `span`, e.g. to submit to an executor.
+        """
+        def wrapper(*args, **kwargs):
+            with self.span(span, target):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def add_cache(self, name: str, info: Callable[[], Dict[str, int]]):
+        """
+        Registers a cache whose counters `info()` returns when the metrics are rendered, e.g.
+        `{'hits': 10, 'misses': 2, 'entries': 8}`. `entries` and `bytes` are reported as its size,
+        the other counters as events.
+        """
+        self._caches[name] = info
+
+    def instrument(self, blueprint: Blueprint):
+        """
+        Records the latency of every request handled by the routes of `blueprint`.
+        """
+        @blueprint.before_request
+        def start_timer():
+            g.request_start = time.perf_counter()
+
+        @blueprint.after_request
+        def record_latency(response):
+            start = g.pop('request_start', None)
+            if start is not None:
+                self.requests.observe(time.perf_counter() - start, request.endpoint or '', request.method,
+                                      str(response.status_code))
+            return response
+
+        # A request whose view raised doesn't always reach `after_request` (e.g. when exceptions are
+        # propagated), so it's recorded as a 500 when its context is torn down.
+        @blueprint.teardown_request
+        def record_error(exc):
+            start = g.pop('request_start', None)
+            if start is not None:
+                self.requests.observe(time.perf_counter() - start, request.endpoint or '', request.method, '500')
+
+    def render(self) -> str:
+        worker = str(os.getpid())
+        lines = self.requests.render([('worker', worker)]) + self.spans.render([('worker', worker)])
+
+        events, sizes = [], {'entries': [], 'bytes': []}
+        for name, info in sorted(self._caches.items()):
+            for key, value in sorted(info().items()):
+                if key in sizes:
+                    sizes[key].append(f'wimbd_cache_{key}{_labels(["worker", "cache"], [worker, name])} {value}')
+                else:
+                    labels = _labels(["worker", "cache", "event"], [worker, name, key])
+                    events.append(f'wimbd_cache_events_total{labels} {value}')
+        lines += ['# HELP wimbd_cache_events_total Cache hits, misses, evictions, etc.',
+                  '# TYPE wimbd_cache_events_total counter', *events]
+        for key, series in sizes.items():
+            lines += [f'# HELP wimbd_cache_{key} Size of a cache.', f'# TYPE wimbd_cache_{key} gauge', *series]
+        return '\n'.join(lines) + '\n'
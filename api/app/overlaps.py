@@ -0,0 +1,150 @@
+import ast
+import itertools
+import json
+import logging
+from functools import lru_cache
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+OverlapEntries = List[Tuple[List[str], int]]
+
+
+def read_overlaps_txt(in_f: str) -> OverlapEntries:
+    """
+    Parses `overlaps.txt`, where every line is a python literal of the form `(['c4_en', 'oscar'], 1234)`.
+    This is slow, so it's meant to be run offline by `app/db/overlaps_to_json.py`.
+    """
+    entries = []
+    with open(in_f, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                subset, count = ast.literal_eval(line)
+                entries.append((list(dict.fromkeys(subset)), count))
+    return entries
+
+
+def write_overlaps_json(out_f: str, entries: OverlapEntries):
+    with open(out_f, 'w') as f:
+        json.dump([{'subset': subset, 'count': count} for subset, count in entries], f)
+
+
+def read_overlaps_json(in_f: str) -> OverlapEntries:
+    with open(in_f, 'rb') as f:
+        return loads_overlaps_json(f.read())
+
+
+def loads_overlaps_json(data: bytes) -> OverlapEntries:
+    return [(x['subset'], x['count']) for x in json.loads(bytes(data))]
+
+
+class OverlapLattice:
+    """
+    The overlap counts of every subset of corpora, stored in a dense array indexed by a
+    bitmask where bit `i` stands for `corpora[i]`.
+
+    `counts[mask]` is the number of documents shared by all the corpora in `mask`. The
+    serialized `/api/get_overlaps` response of every mask is built once up front, along
+    with the inclusion-exclusion "exclusive" count of each region, i.e. the number of
+    documents that are in exactly that subset of the requested corpora and no other.
+    """
+    def __init__(self, corpora: Sequence[str], counts: np.ndarray):
+        self.corpora = list(corpora)
+        self.bits = {corpus: 1 << i for i, corpus in enumerate(self.corpora)}
+        self.counts = counts
+        self._responses: List[bytes] = [b'[]'] * len(counts)
+        for mask in range(1, len(counts)):
+            self._responses[mask] = self._serialize(self._canonical_order(mask))
+
+    @classmethod
+    def from_entries(cls, corpora: Sequence[str], entries: Iterable[Tuple[Iterable[str], int]]) -> 'OverlapLattice':
+        """
+        :param corpora: The corpora that make up the lattice, in bit order.
+        :param entries: (subset, count) pairs, where the subset contains names from `corpora`.
+        """
+        bits = {corpus: 1 << i for i, corpus in enumerate(corpora)}
+        counts = np.zeros(1 << len(corpora), dtype=np.int64)
+        present = np.zeros(len(counts), dtype=bool)
+        for subset, count in entries:
+            mask = 0
+            for corpus in subset:
+                mask |= bits[corpus]
+            counts[mask] = count
+            present[mask] = True
+
+        missing = int((~present[1:]).sum())
+        if missing:
+            logger.warning(f'{missing} corpora subsets have no overlap count, using 0 for them.')
+        return cls(corpora, counts)
+
+    def mask(self, subset: Iterable[str]) -> int:
+        mask = 0
+        for corpus in subset:
+            mask |= self.bits[corpus]
+        return mask
+
+    def _canonical_order(self, mask: int) -> List[str]:
+        return [corpus for corpus in self.corpora if mask & self.bits[corpus]]
+
+    def exclusive_counts(self, mask: int) -> np.ndarray:
+        """
+        :return: An array indexed like `counts`, where every submask of `mask` holds the number
+            of documents that are in all of its corpora and in none of the other corpora of `mask`.
+        """
+        exclusive = self.counts.copy()
+        masks = np.arange(len(exclusive))
+        for bit in self.bits.values():
+            if mask & bit:
+                without = masks[(masks & bit) == 0]
+                exclusive[without] -= exclusive[without | bit]
+        return exclusive
+
+    def _serialize(self, used_datasets: Sequence[str]) -> bytes:
+        bits = [self.bits[corpus] for corpus in used_datasets]
+        exclusive = self.exclusive_counts(self.mask(used_datasets))
+
+        # Same order as enumerating `itertools.combinations` of every size over `used_datasets`.
+        subsets = []
+        for size in range(1, len(used_datasets) + 1):
+            subsets.extend(_combinations(len(used_datasets), size))
+
+        subset_counts = []
+        for subset in subsets:
+            mask = 0
+            for i in subset:
+                mask |= bits[i]
+            subset_counts.append({
+                'subset': [used_datasets[i] for i in subset],
+                'count': int(self.counts[mask]),
+                'exclusive': int(exclusive[mask]),
+            })
+        return json.dumps(subset_counts, separators=(',', ':')).encode('utf-8')
+
+    def response(self, used_datasets: Sequence[str]) -> bytes:
+        """
+        :return: The serialized list of `{"subset", "count", "exclusive"}` objects for every
+            non-empty subset of `used_datasets`, in the order the corpora were given.
+        """
+        mask = self.mask(used_datasets)
+        if list(used_datasets) == self._canonical_order(mask):
+            return self._responses[mask]
+        return self._ordered_response(tuple(used_datasets))
+
+    @lru_cache(maxsize=1024)
+    def _ordered_response(self, used_datasets: Tuple[str, ...]) -> bytes:
+        return self._serialize(used_datasets)
+
+
+@lru_cache(maxsize=None)
+def _combinations(n: int, size: int) -> Tuple[Tuple[int, ...], ...]:
+    return tuple(itertools.combinations(range(n), size))
+
+
+def entries_to_corpora(entries: OverlapEntries, names_map: Dict[str, str]) -> OverlapEntries:
+    """
+    Renames the corpora of every entry, e.g. from file names to display names.
+    """
+    return [([names_map[x] for x in subset], count) for subset, count in entries]
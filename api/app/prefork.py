@@ -0,0 +1,309 @@
+import gc
+import json
+import logging
+import mmap
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Callable, Dict, Generic, List, Optional, TypeVar
+
+import numpy as np
+from gevent.pywsgi import WSGIHandler
+
+T = TypeVar('T')
+
+
+class NoDelayWSGIHandler(WSGIHandler):
+    """
+    pywsgi sends the headers and the body of a response with two writes. With Nagle's algorithm,
+    the body is then held back until the client acknowledges the headers, which clients delay by
+    up to 40ms, so every response with a body took 40ms. The connections are set to TCP_NODELAY.
+    """
+    def handle(self):
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            # Not a TCP socket.
+            pass
+        super().handle()
+
+
+class ProcessLocal(Generic[T]):
+    """
+    A value created on first use in every process, for the resources that can't be shared by the
+    workers forked by `Master`: connection pools, executors and clients holding sockets or threads.
+    """
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._pid: Optional[int] = None
+        self._value: Optional[T] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self._factory()
+                    self._pid = os.getpid()
+        return self._value
+
+
+# Columns of the per-worker counters, in shared memory so every worker can report all of them.
+PID, GENERATION, REQUESTS, ERRORS = range(4)
+STARTED_AT, HEARTBEAT = range(2)
+
+
+class WorkerStats:
+    """
+    Counters of every worker slot, in an anonymous shared mapping created before the workers are
+    forked. Every slot is only written by the worker holding it (and by the master, when the slot
+    is assigned or freed). The last row holds the totals of the workers that exited.
+    """
+    def __init__(self, slots: int):
+        self.slots = slots
+        ints_size = (slots + 1) * 4 * 8
+        self._mm = mmap.mmap(-1, ints_size + (slots + 1) * 2 * 8)
+        self.ints = np.frombuffer(self._mm, dtype=np.int64, count=(slots + 1) * 4).reshape(slots + 1, 4)
+        self.times = np.frombuffer(self._mm, dtype=np.float64, count=(slots + 1) * 2, offset=ints_size).reshape(slots + 1, 2)
+
+    def assign(self, slot: int, pid: int, generation: int):
+        self.ints[slot] = [pid, generation, 0, 0]
+        self.times[slot] = [time.time(), time.time()]
+
+    def free(self, slot: int):
+        self.ints[self.slots, REQUESTS] += self.ints[slot, REQUESTS]
+        self.ints[self.slots, ERRORS] += self.ints[slot, ERRORS]
+        self.ints[slot] = 0
+        self.times[slot] = 0
+
+    def free_slot(self) -> int:
+        return int(np.flatnonzero(self.ints[:self.slots, PID] == 0)[0])
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        workers = [
+            {
+                'pid': int(ints[PID]),
+                'generation': int(ints[GENERATION]),
+                'requests': int(ints[REQUESTS]),
+                'errors': int(ints[ERRORS]),
+                'uptime': round(now - times[STARTED_AT], 1),
+                'heartbeat_age': round(now - times[HEARTBEAT], 1),
+            }
+            for ints, times in zip(self.ints[:self.slots].tolist(), self.times[:self.slots].tolist())
+            if ints[PID] != 0
+        ]
+        return {
+            'workers': workers,
+            'exited': {'requests': int(self.ints[self.slots, REQUESTS]), 'errors': int(self.ints[self.slots, ERRORS])},
+        }
+
+
+class CountingMiddleware:
+    """
+    Counts the requests and the 5xx responses of a worker in its slot, and serves `/api/workers`:
+    the counters of all the workers.
+    """
+    def __init__(self, app, stats: WorkerStats, slot: int):
+        self.app = app
+        self.stats = stats
+        self.slot = slot
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') == '/api/workers':
+            body = json.dumps(self.stats.snapshot()).encode('utf-8')
+            start_response('200 OK', [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))])
+            return [body]
+
+        self.stats.ints[self.slot, REQUESTS] += 1
+
+        def counting_start_response(status, headers, exc_info=None):
+            if status.startswith('5'):
+                self.stats.ints[self.slot, ERRORS] += 1
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, counting_start_response)
+
+
+class Master:
+    """
+    Pre-fork server: the application (and so all the data `create_api` loads) is created once in
+    this process, and then `workers` processes are forked that serve it from a shared listening
+    socket with a gevent `WSGIServer`. The loaded data is shared copy-on-write; `gc.freeze()` keeps
+    the garbage collector of the workers from touching (and so copying) it.
+
+    - A worker that exits is replaced, and one whose heartbeat is older than `worker_timeout`
+      seconds (e.g. stuck in a request) is killed and replaced.
+    - SIGHUP reloads: the application is created again (e.g. attaching to a newly installed
+      bundle), a new generation of workers is forked, and the old ones are stopped gracefully.
+      If creating the application fails, the current workers keep serving. A reload requested
+      while the previous generation is still stopping runs once it has stopped.
+    - SIGTERM / SIGINT stop the workers gracefully, giving in-flight requests `shutdown_timeout`
+      seconds to finish.
+    """
+    def __init__(self, create_app: Callable[[], Callable], port: int, workers: int, worker_timeout: float = 120,
+                 shutdown_timeout: float = 30, logger: Optional[logging.Logger] = None):
+        self.create_app = create_app
+        self.port = port
+        self.num_workers = workers
+        self.worker_timeout = worker_timeout
+        self.shutdown_timeout = shutdown_timeout
+        self.logger = logger or logging.getLogger(__name__)
+
+        # During a reload the old and the new generation run side by side.
+        self.stats = WorkerStats(2 * workers)
+        self.generation = 0
+        self.app = None
+        self.sock: Optional[socket.socket] = None
+        # pid -> slot, of the workers of the current generation and of the ones being stopped.
+        self.workers: Dict[int, int] = {}
+        self.stopping: Dict[int, float] = {}
+        self._reload = False
+        self._stop = False
+
+    def _load(self):
+        gc.unfreeze()
+        app = self.create_app()
+        self.app = None
+        gc.collect()
+        self.app = app
+        # Everything allocated so far moves to the permanent generation, which the workers' garbage
+        # collections skip, so they don't write to (and copy) the pages of the shared data.
+        gc.freeze()
+
+    def _spawn(self):
+        slot = self.stats.free_slot()
+        # The slot is taken before forking, so the worker's first counts aren't reset.
+        self.stats.assign(slot, -1, self.generation)
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker(slot)
+            except BaseException:
+                self.logger.exception('worker crashed')
+                code = 1
+            finally:
+                os._exit(code)
+
+        self.stats.ints[slot, PID] = pid
+        self.workers[pid] = slot
+        self.logger.info(f'started worker {pid} (generation {self.generation}, slot {slot})')
+
+    def _run_worker(self, slot: int):
+        import gevent
+        import gevent.socket
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+
+        for signum in [signal.SIGHUP, signal.SIGINT]:
+            signal.signal(signum, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        # The server needs a cooperative socket to accept connections without blocking the worker.
+        listener = gevent.socket.socket(fileno=self.sock.detach())
+        # The requests run in a pool, which stopping the server waits for (up to the shutdown timeout).
+        server = WSGIServer(listener, CountingMiddleware(self.app, self.stats, slot), spawn=Pool(),
+                            handler_class=NoDelayWSGIHandler, log=self.logger, error_log=self.logger)
+        gevent.signal_handler(signal.SIGTERM, server.close)
+
+        def heartbeat():
+            while True:
+                self.stats.times[slot, HEARTBEAT] = time.time()
+                gevent.sleep(1)
+
+        gevent.spawn(heartbeat)
+        server.serve_forever(stop_timeout=self.shutdown_timeout)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot = self.workers.pop(pid, None)
+            if slot is None:
+                continue
+            if pid in self.stopping:
+                del self.stopping[pid]
+            else:
+                self.logger.warning(f'worker {pid} exited with status {status}')
+            self.stats.free(slot)
+
+    def _check_heartbeats(self):
+        now = time.time()
+        for pid, slot in list(self.workers.items()):
+            if pid not in self.stopping and now - self.stats.times[slot, HEARTBEAT] > self.worker_timeout:
+                self.logger.warning(f'worker {pid} missed its heartbeat for {self.worker_timeout}s, killing it')
+                self._kill(pid, signal.SIGKILL)
+
+    def _kill(self, pid: int, signum: int):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _stop_workers(self, pids: List[int]):
+        for pid in pids:
+            self.stopping[pid] = time.time()
+            self._kill(pid, signal.SIGTERM)
+
+    def _current_workers(self) -> List[int]:
+        return [pid for pid in self.workers if pid not in self.stopping]
+
+    def run(self):
+        self._load()
+        self.sock = socket.create_server(('0.0.0.0', self.port), backlog=2048)
+        self.logger.info(f'Server listening at http://0.0.0.0:{self.port} with {self.num_workers} workers')
+
+        def on_reload(signum, frame):
+            self._reload = True
+
+        def on_stop(signum, frame):
+            self._stop = True
+
+        signal.signal(signal.SIGHUP, on_reload)
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+
+        while not self._stop:
+            self._reap()
+
+            # A reload waits until the previous generation is stopped, so that at most two generations
+            # (and `2 * workers` slots) are ever in use. Reloads requested meanwhile run once.
+            if self._reload and not self.stopping:
+                self._reload = False
+                self.logger.info('reloading')
+                try:
+                    self._load()
+                except Exception:
+                    self.logger.exception('reloading failed, keeping the current workers')
+                else:
+                    old = self._current_workers()
+                    self.generation += 1
+                    for _ in range(self.num_workers):
+                        self._spawn()
+                    self._stop_workers(old)
+
+            for _ in range(self.num_workers - len(self._current_workers())):
+                self._spawn()
+
+            self._check_heartbeats()
+            # Workers being stopped get the shutdown timeout to drain their requests.
+            for pid, since in list(self.stopping.items()):
+                if time.time() - since > self.shutdown_timeout + 5:
+                    self._kill(pid, signal.SIGKILL)
+            time.sleep(0.5)
+
+        self.logger.info('stopping')
+        self._stop_workers(self._current_workers())
+        deadline = time.time() + self.shutdown_timeout + 5
+        while self.workers and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in self.workers:
+            self._kill(pid, signal.SIGKILL)
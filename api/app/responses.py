@@ -0,0 +1,182 @@
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Any, Callable, ContextManager, Hashable, Optional, Sequence, Union
+
+from flask import Response, request
+
+from app.cache import CacheStats
+from app.metrics import Metrics
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this aren't worth compressing.
+MIN_COMPRESS_SIZE = 1024
+
+# Compression levels of the responses prepared on the request path, e.g. on a `ResponseCache` miss,
+# whose keys come from the request: the highest levels cost many times the CPU for a few percent.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Compression levels of the fixed responses prepared once, at startup.
+STATIC_GZIP_LEVEL = 9
+STATIC_BROTLI_QUALITY = 11
+
+# Columnar responses: named, typed arrays in the layout of `app/arrays.py`, which
+# `app.arrays.unpack_arrays` reads without copying.
+NDARRAY_MIMETYPE = 'application/x-ndarray'
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Serializes `obj` to compact JSON with sorted keys (like `jsonify`), with orjson when it's installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def negotiate(mimetypes: Sequence[str] = ('application/json', NDARRAY_MIMETYPE)) -> Optional[str]:
+    """
+    :return: The mimetype out of `mimetypes` that the request's `Accept` header prefers, the first
+        one if it doesn't have a preference, or None if it accepts none of them.
+    """
+    if not request.accept_mimetypes:
+        return mimetypes[0]
+    return request.accept_mimetypes.best_match(mimetypes)
+
+
+class PreparedResponse:
+    """
+    A response body that's serialized and compressed once, and served with a strong ETag.
+
+    Every encoding is a different representation, so each gets its own ETag. A request whose
+    `If-None-Match` holds the ETag of the representation it would get is answered with a 304.
+    The endpoints using this are read-only queries, so this holds for POST requests too.
+    """
+    def __init__(self, body: bytes, mimetype: str = 'application/json', vary: str = 'Accept-Encoding',
+                 gzip_level: int = GZIP_LEVEL, brotli_quality: int = BROTLI_QUALITY):
+        self.mimetype = mimetype
+        self.vary = vary
+        self.bodies = {'identity': body}
+        if len(body) >= MIN_COMPRESS_SIZE:
+            self.bodies['gzip'] = gzip.compress(body, compresslevel=gzip_level, mtime=0)
+            if brotli is not None:
+                self.bodies['br'] = brotli.compress(body, quality=brotli_quality)
+
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.etags = {encoding: f'{digest}-{encoding}' for encoding in self.bodies}
+
+    @classmethod
+    def from_obj(cls, obj: Any) -> 'PreparedResponse':
+        """
+        Prepares a fixed response once, e.g. at startup, so it's compressed at the highest levels.
+        """
+        return cls(dumps(obj), gzip_level=STATIC_GZIP_LEVEL, brotli_quality=STATIC_BROTLI_QUALITY)
+
+    def nbytes(self) -> int:
+        return sum(len(body) for body in self.bodies.values())
+
+    def _encoding(self) -> str:
+        accepted = request.accept_encodings
+        for encoding in ['br', 'gzip']:
+            if encoding in self.bodies and accepted[encoding] > 0:
+                return encoding
+        return 'identity'
+
+    def serve(self) -> Response:
+        encoding = self._encoding()
+        etag = self.etags[encoding]
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.bodies[encoding], mimetype=self.mimetype)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(etag)
+        response.headers['Vary'] = self.vary
+        # Clients may keep the body, but have to revalidate it with the ETag before using it.
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+
+class ResponseCache:
+    """
+    An LRU of `PreparedResponse`s, bounded by the number of entries and their total size.
+
+    With `metrics`, building, serializing and preparing (compressing and hashing) the responses
+    are recorded as the `response.build`, `response.serialize` and `response.prepare` spans of the
+    endpoint, the first element of the key.
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 256 * 2 ** 20, metrics: Optional[Metrics] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.stats = CacheStats()
+        self.nbytes = 0
+        self._entries: 'OrderedDict[Hashable, PreparedResponse]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[PreparedResponse]:
+        with self._lock:
+            prepared = self._entries.get(key)
+            if prepared is not None:
+                self._entries.move_to_end(key)
+            return prepared
+
+    def put(self, key: Hashable, prepared: PreparedResponse):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes()
+            self._entries[key] = prepared
+            self.nbytes += prepared.nbytes()
+            while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes()
+                self.stats.incr('evictions')
+
+    def _span(self, span: str, key: Hashable) -> ContextManager:
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.span(span, str(key[0] if isinstance(key, tuple) else key))
+
+    def serve(self, key: Hashable, build: Callable[[], Union[bytes, Any]], mimetype: str = 'application/json',
+              vary: str = 'Accept-Encoding') -> Response:
+        """
+        Serves the cached response of `key`, or builds it from `build()`, which returns either
+        the serialized body or an object to serialize as JSON.
+        """
+        prepared = self.get(key)
+        if prepared is None:
+            self.stats.incr('misses')
+            with self._span('response.build', key):
+                body = build()
+            if not isinstance(body, bytes):
+                with self._span('response.serialize', key):
+                    body = dumps(body)
+            with self._span('response.prepare', key):
+                prepared = PreparedResponse(body, mimetype, vary)
+            self.put(key, prepared)
+        else:
+            self.stats.incr('hits')
+        return prepared.serve()
+
+    def info(self) -> dict:
+        info = self.stats.snapshot()
+        with self._lock:
+            info['entries'] = len(self._entries)
+            info['bytes'] = self.nbytes
+        return info
@@ -0,0 +1,218 @@
+import mmap
+import os
+import struct
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+import numpy as np
+
+# Binary layout of a top-k file (all integers are little endian):
+#
+#   header:   magic (8 bytes), version (uint32), number of tables (uint32)
+#   tables:   one entry per k: k, n, counts offset, string offsets offset, blob offset, blob length (6 x uint64)
+#   payload:  per table an int64 count array (n), an int64 string offset array (n + 1) and a UTF-8 blob
+#
+# Arrays are 8 byte aligned so they can be viewed in place from an mmap.
+TOPK_MAGIC = b'WIMBDTK\x00'
+TOPK_VERSION = 1
+_HEADER = struct.Struct('<8sII')
+_ENTRY = struct.Struct('<6Q')
+
+Buffer = Union[bytes, memoryview, mmap.mmap]
+
+
+class TopKTable:
+    """
+    A single (corpus, k) list of n-grams, sorted by count in descending order.
+
+    The strings are stored as one UTF-8 blob with an offset table next to a
+    parallel array of counts, so taking the first `count` entries is a slice
+    instead of a sort over a dict.
+    """
+    def __init__(self, counts: np.ndarray, offsets: np.ndarray, blob: Buffer):
+        self.counts = counts
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, int]) -> 'TopKTable':
+        strings = list(data.keys())
+        counts = np.fromiter(data.values(), dtype=np.int64, count=len(strings))
+        # A stable sort keeps ties in file order, same as `sorted` over the dict did.
+        order = np.argsort(-counts, kind='stable')
+
+        encoded = [strings[i].encode('utf-8') for i in order]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=offsets[1:])
+
+        return cls(counts[order], offsets, b''.join(encoded))
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def strings(self, count: int) -> List[str]:
+        count = max(0, min(count, len(self)))
+        offsets = self.offsets[:count + 1].tolist()
+        blob = self.blob
+        return [str(blob[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(count)]
+
+    def with_counts(self, count: int) -> List[Tuple[str, int]]:
+        strings = self.strings(count)
+        return list(zip(strings, self.counts[:len(strings)].tolist()))
+
+    def columns(self, count: int) -> Dict[str, np.ndarray]:
+        """
+        :return: The first `count` entries as arrays: the counts, the int32 offsets of the strings
+            into the UTF-8 blob, and the blob as uint8.
+        """
+        count = max(0, min(count, len(self)))
+        offsets = self.offsets[:count + 1]
+        return {
+            'counts': self.counts[:count],
+            'offsets': offsets.astype(np.int32),
+            'blob': np.frombuffer(self.blob, dtype=np.uint8, count=int(offsets[-1])),
+        }
+
+    def nbytes(self) -> int:
+        return self.counts.nbytes + self.offsets.nbytes + len(self.blob)
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+def pack_tables(tables: Dict[int, TopKTable]) -> bytes:
+    """
+    :param tables: The tables of a single corpus, keyed by k.
+    :return: The tables serialized in the binary top-k layout.
+    """
+    ks = sorted(tables)
+    position = _HEADER.size + _ENTRY.size * len(ks)
+    entries, chunks = [], []
+    for k in ks:
+        table = tables[k]
+        counts_off = _align(position)
+        offsets_off = counts_off + table.counts.nbytes
+        blob_off = offsets_off + table.offsets.nbytes
+        position = blob_off + len(table.blob)
+        entries.append(_ENTRY.pack(k, len(table), counts_off, offsets_off, blob_off, len(table.blob)))
+        chunks.append((counts_off, [table.counts.astype('<i8').tobytes(), table.offsets.astype('<i8').tobytes(),
+                                    bytes(table.blob)]))
+
+    out = bytearray(_HEADER.pack(TOPK_MAGIC, TOPK_VERSION, len(ks)) + b''.join(entries))
+    for start, parts in chunks:
+        out += bytes(start - len(out))
+        for part in parts:
+            out += part
+    return bytes(out)
+
+
+def unpack_tables(buf: Buffer) -> Dict[int, TopKTable]:
+    """
+    Views the tables of a buffer written by `pack_tables` without copying them.
+    """
+    view = memoryview(buf)
+    magic, version, num_tables = _HEADER.unpack_from(view, 0)
+    if magic != TOPK_MAGIC or version != TOPK_VERSION:
+        raise ValueError(f'Not a top-k file of version {TOPK_VERSION}.')
+
+    tables = {}
+    for i in range(num_tables):
+        k, n, counts_off, offsets_off, blob_off, blob_len = _ENTRY.unpack_from(view, _HEADER.size + i * _ENTRY.size)
+        counts = np.frombuffer(view, dtype='<i8', count=n, offset=counts_off)
+        offsets = np.frombuffer(view, dtype='<i8', count=n + 1, offset=offsets_off)
+        tables[k] = TopKTable(counts, offsets, view[blob_off:blob_off + blob_len])
+    return tables
+
+
+def write_topk_file(path: str, tables: Dict[int, TopKTable]):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(pack_tables(tables))
+    os.replace(tmp_path, path)
+
+
+def open_topk_file(path: str) -> Dict[int, TopKTable]:
+    """
+    Memory-maps a top-k file. The pages are shared through the OS page cache, so
+    every worker process reading the same file only pays for it once.
+    """
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return unpack_tables(mm)
+
+
+class TopKStore:
+    """
+    Holds the pre-sorted top-k n-gram tables of every corpus, keyed by (corpus, k).
+
+    Corpora can either be added eagerly from parsed dicts, or registered with a
+    loader that is only called the first time the corpus is requested.
+    """
+    def __init__(self):
+        self._tables: Dict[str, Dict[int, TopKTable]] = {}
+        self._loaders: Dict[str, Callable[[], Dict[int, TopKTable]]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_binary_dir(cls, directory: str, files_map: Dict[str, str]) -> 'TopKStore':
+        """
+        :param directory: Directory with the `{file name}.topk` files written by `app/db/topk_to_bin.py`.
+        :param files_map: Mapping from corpus names to their file names.
+        """
+        store = cls()
+        for corpus, file_name in files_map.items():
+            path = os.path.join(directory, f'{file_name}.topk')
+            store.register(corpus, lambda path=path: open_topk_file(path))
+        return store
+
+    @classmethod
+    def from_bundle(cls, bundle, files_map: Dict[str, str]) -> 'TopKStore':
+        """
+        :param bundle: An `app.bundle.Bundle` with a `topk/{file name}` section per corpus.
+        :param files_map: Mapping from corpus names to their file names.
+        """
+        store = cls()
+        for corpus, file_name in files_map.items():
+            store.register(corpus, lambda name=f'topk/{file_name}': unpack_tables(bundle.section(name)))
+        return store
+
+    def add(self, corpus: str, k: int, data: Dict[str, int]):
+        self._tables.setdefault(corpus, {})[k] = TopKTable.from_dict(data)
+
+    def register(self, corpus: str, loader: Callable[[], Dict[int, TopKTable]]):
+        self._loaders[corpus] = loader
+
+    def _corpus_tables(self, corpus: str) -> Dict[int, TopKTable]:
+        tables = self._tables.get(corpus)
+        if tables is None:
+            with self._lock:
+                tables = self._tables.get(corpus)
+                if tables is None:
+                    tables = self._tables[corpus] = self._loaders[corpus]()
+        return tables
+
+    def table(self, corpus: str, k: int) -> TopKTable:
+        return self._corpus_tables(corpus)[k]
+
+    def top(self, corpus: str, k: int, count: int) -> List[str]:
+        return self.table(corpus, k).strings(count)
+
+    def top_with_counts(self, corpus: str, k: int, count: int) -> List[Tuple[str, int]]:
+        return self.table(corpus, k).with_counts(count)
+
+    def top_columns(self, corpus: str, k: int, count: int) -> Dict[str, np.ndarray]:
+        return self.table(corpus, k).columns(count)
+
+    def corpora(self) -> Iterable[str]:
+        return self._tables.keys() | self._loaders.keys()
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        :return: The number of bytes held by the arrays of each loaded corpus. For
+            memory-mapped corpora this is the size of the mapping.
+        """
+        return {
+            corpus: sum(table.nbytes() for table in tables.values())
+            for corpus, tables in self._tables.items()
+        }
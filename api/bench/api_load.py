@@ -0,0 +1,271 @@
+"""
+Drives every /api/* endpoint of `create_api` under concurrent load and reports, per endpoint,
+the throughput and the p50 / p95 / p99 latencies, so that changes to the API can be measured
+without the ES clusters and the Postgres database.
+
+python -m bench.api_load --clients 8 --duration 5 --save baseline.json
+python -m bench.api_load --clients 8 --duration 5 --compare baseline.json
+
+The API runs in its own process behind the gevent `WSGIServer` used in production, with the
+in-process stand-ins of `bench/standins.py`: ES answers after `--es-latency-ms`, and the domain
+tables are in SQLite. It serves synthetic artifacts generated into `--data-dir` (reused if they
+were generated with the same scale). Every endpoint is then loaded by `--clients` client processes
+with keep-alive connections for `--duration` seconds. The API's output goes to `server.log`
+in the data directory.
+
+With `--compare`, the results are compared to a baseline saved by `--save`, and the exit status
+is 1 if the throughput or the p99 latency of an endpoint is more than `--threshold` worse.
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+def _subset(rng: np.random.Generator, items, max_size: int = 3):
+    size = int(rng.integers(1, min(max_size, len(items)) + 1))
+    return [str(item) for item in rng.choice(items, size=size, replace=False)]
+
+
+def _phrase(rng: np.random.Generator, workload: dict) -> str:
+    return f"phrase {rng.integers(workload['phrases'])}"
+
+
+def _prefix(rng: np.random.Generator) -> str:
+    return str(rng.choice(['www.', 'cdn.', 'images.', 'blog.', 'i.', 'm.'])) + '0123456789abcdef'[:int(rng.integers(0, 3))]
+
+
+# Every scenario makes the (method, path, JSON body) of a request, from the corpora the API lists.
+SCENARIOS = {
+    'datasets': lambda rng, w: ('GET', '/api/datasets', None),
+    'ks': lambda rng, w: ('GET', '/api/ks', None),
+    'get_overlaps': lambda rng, w: ('POST', '/api/get_overlaps', {'corpora': _subset(rng, w['all'], 4)}),
+    'topk': lambda rng, w: ('POST', '/api/topk', {
+        'k': int(rng.choice(w['ks'])), 'datasets': _subset(rng, w['all']), 'count': int(rng.choice([20, 100, 1000]))}),
+    'topk_with_counts': lambda rng, w: ('POST', '/api/topk_with_counts', {
+        'k': int(rng.choice(w['ks'])), 'datasets': _subset(rng, w['all']), 'count': int(rng.choice([20, 100, 1000]))}),
+    'text_count': lambda rng, w: ('POST', '/api/text_count', {
+        'text': _phrase(rng, w), 'datasets': _subset(rng, w['indexed'], 6)}),
+    'text_count_batch': lambda rng, w: ('POST', '/api/text_count_batch', {
+        'phrases': [_phrase(rng, w) for _ in range(50)], 'datasets': _subset(rng, w['indexed']), 'batch_size': 25}),
+    'term_frequency': lambda rng, w: ('POST', '/api/term_frequency', {
+        'terms': [f'w{rng.integers(w["phrases"])}' for _ in range(5)], 'datasets': _subset(rng, w['indexed'])}),
+    'documents': lambda rng, w: ('POST', '/api/documents', {
+        'text': _phrase(rng, w), 'datasets': _subset(rng, w['indexed']), 'includes': ['url']}),
+    'documents_export': lambda rng, w: ('POST', '/api/documents/export', {
+        'dataset': str(rng.choice(w['indexed'])), 'phrases': [_phrase(rng, w)], 'slices': 2, 'limit': 2000}),
+    'domains_count': lambda rng, w: ('POST', '/api/domains_count', {
+        'domain_text': _prefix(rng), 'corpora': _subset(rng, w['url'])}),
+    'top_domains': lambda rng, w: ('POST', '/api/top_domains', {
+        'corpora': _subset(rng, w['url']), 'count': int(rng.choice([10, 100, 1000]))}),
+    'len_dist': lambda rng, w: ('POST', '/api/len_dist', {'corpora': _subset(rng, w['all'])}),
+    'len_dist_window': lambda rng, w: ('POST', '/api/len_dist', {
+        'corpora': _subset(rng, w['all']), 'points': 500, 'min_len': int(rng.integers(1, 1000)) * 10,
+        'max_len': 20_000 + int(rng.integers(0, 1000)) * 10}),
+    'len_dist_stats': lambda rng, w: ('POST', '/api/len_dist_stats', {
+        'corpora': _subset(rng, w['all']), 'bins': 50, 'min_len': int(rng.integers(1, 1000))}),
+    'metrics': lambda rng, w: ('GET', '/api/metrics', None),
+}
+
+
+def request(conn: http.client.HTTPConnection, method: str, path: str, body=None):
+    headers = {'Content-Type': 'application/json'} if body is not None else {}
+    conn.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def serve(args):
+    from flask import Flask
+    from gevent.pywsgi import WSGIServer
+
+    from app.api import create_api
+    from app.prefork import NoDelayWSGIHandler
+    from bench.standins import FakeElasticsearch, SqlitePool
+
+    es_clients = {name: FakeElasticsearch(latency=args.es_latency_ms / 1000) for name in ['default', 'dolma']}
+    db_path = os.path.join(args.data_dir, 'domains.sqlite')
+    app = Flask('bench')
+    app.register_blueprint(create_api(data_dir=args.data_dir, es_clients=es_clients,
+                                      connection_pool=lambda: SqlitePool(db_path)), url_prefix='/')
+    WSGIServer(('127.0.0.1', args.port), app, handler_class=NoDelayWSGIHandler, log=None).serve_forever()
+
+
+def wait_until_up(port: int, timeout: float = 300):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            request(http.client.HTTPConnection('127.0.0.1', port, timeout=5), 'GET', '/')
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('The API did not start.')
+
+
+def client(port: int, scenario: str, workload: dict, duration: float, seed: int, queue):
+    rng = np.random.default_rng(seed)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    latencies, errors = [], 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        method, path, body = SCENARIOS[scenario](rng, workload)
+        start = time.perf_counter()
+        status, _ = request(conn, method, path, body)
+        if status == 200:
+            latencies.append(time.perf_counter() - start)
+        else:
+            errors += 1
+    queue.put((latencies, errors))
+
+
+def run_scenario(scenario: str, workload: dict, args) -> dict:
+    # A few sequential requests first, so the results don't include building the first responses.
+    rng = np.random.default_rng(args.seed)
+    conn = http.client.HTTPConnection('127.0.0.1', args.port, timeout=60)
+    for _ in range(args.warmup):
+        request(conn, *SCENARIOS[scenario](rng, workload))
+    conn.close()
+
+    queue = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=client, args=(args.port, scenario, workload, args.duration,
+                                                            args.seed + i, queue))
+               for i in range(args.clients)]
+    for p in clients:
+        p.start()
+    results = [queue.get() for _ in clients]
+    for p in clients:
+        p.join()
+        if p.exitcode != 0:
+            raise RuntimeError(f'A client exited with {p.exitcode}.')
+
+    latencies = np.array([x for latencies, _ in results for x in latencies]) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]).tolist() if len(latencies) else [None] * 3
+    return {
+        'requests': len(latencies),
+        'errors': sum(errors for _, errors in results),
+        'rps': len(latencies) / args.duration,
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+    }
+
+
+def prepare_data(args) -> dict:
+    from bench.standins import write_synthetic_data
+
+    scale = {'ngrams': args.ngrams, 'lengths': args.lengths, 'domains': args.domains, 'seed': args.seed}
+    params_path = os.path.join(args.data_dir, 'synthetic.json')
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == scale:
+                return scale
+    print(f'generating synthetic data in {args.data_dir}')
+    return write_synthetic_data(args.data_dir, **scale)
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Prints the change of every endpoint against `baseline`.
+
+    :return: Whether an endpoint regressed by more than `threshold`.
+    """
+    regressed = False
+    print(f'\n{"endpoint":<20}{"req/s":>10}{"Δ":>9}{"p99 ms":>10}{"Δ":>9}')
+    for scenario, result in results.items():
+        before = baseline['results'].get(scenario)
+        if before is None or not before['rps'] or before['p99_ms'] is None or result['p99_ms'] is None:
+            continue
+        rps_change = result['rps'] / before['rps'] - 1
+        p99_change = result['p99_ms'] / before['p99_ms'] - 1
+        worse = rps_change < -threshold or p99_change > threshold
+        regressed |= worse
+        print(f'{scenario:<20}{result["rps"]:>10.1f}{rps_change:>+9.1%}{result["p99_ms"]:>10.1f}{p99_change:>+9.1%}'
+              f'{"  regression" if worse else ""}')
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load every API endpoint with local stand-ins for ES and Postgres.')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent client processes')
+    parser.add_argument('--duration', type=float, default=5, help='Seconds of load per endpoint')
+    parser.add_argument('--warmup', type=int, default=20, help='Sequential requests per endpoint before the load')
+    parser.add_argument('--endpoints', type=str, nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help='Endpoints (scenarios) to load')
+    parser.add_argument('--es-latency-ms', type=float, default=20, help='Latency of the ES stand-in per call')
+    parser.add_argument('--phrases', type=int, default=100_000, help='Number of distinct phrases counted')
+    parser.add_argument('--data-dir', type=str, default=os.path.join(tempfile.gettempdir(), 'wimbd_bench'),
+                        help='Directory of the synthetic artifacts')
+    parser.add_argument('--ngrams', type=int, default=20_000, help='Top-k n-grams per corpus and k')
+    parser.add_argument('--lengths', type=int, default=100_000, help='Distinct lengths per corpus')
+    parser.add_argument('--domains', type=int, default=200_000, help='Domains per domain table')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8124)
+    parser.add_argument('--save', type=str, help='Save the results to this JSON file')
+    parser.add_argument('--compare', type=str, help='Compare the results to a baseline saved with --save')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Relative change reported as a regression')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    scale = prepare_data(args)
+
+    # The API's own output goes to a log file in the data directory.
+    log = open(os.path.join(args.data_dir, 'server.log'), 'w')
+    server = subprocess.Popen([sys.executable, '-m', 'bench.api_load', '--serve', '--data-dir', args.data_dir,
+                               '--port', str(args.port), '--es-latency-ms', str(args.es_latency_ms)],
+                              stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_until_up(args.port)
+        _, body = request(http.client.HTTPConnection('127.0.0.1', args.port), 'GET', '/api/datasets')
+        meta = json.loads(body)
+        _, body = request(http.client.HTTPConnection('127.0.0.1', args.port), 'GET', '/api/ks')
+        workload = {
+            'all': list(meta),
+            'indexed': [d for d, m in meta.items() if 'indexed' in m['meta']],
+            'url': [d for d, m in meta.items() if 'url' in m['meta']],
+            'ks': json.loads(body),
+            'phrases': args.phrases,
+        }
+
+        results = {}
+        print(f'{"endpoint":<20}{"req/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"errors":>8}')
+        for scenario in args.endpoints:
+            result = results[scenario] = run_scenario(scenario, workload, args)
+            p50, p95, p99 = (f'{result[p]:>10.1f}' if result[p] is not None else f'{"-":>10}'
+                             for p in ['p50_ms', 'p95_ms', 'p99_ms'])
+            print(f'{scenario:<20}{result["rps"]:>10.1f}{p50}{p95}{p99}{result["errors"]:>8}')
+    finally:
+        server.terminate()
+        server.wait()
+        log.close()
+
+    if args.save:
+        config = {
+            'clients': args.clients, 'duration': args.duration, 'es_latency_ms': args.es_latency_ms,
+            'phrases': args.phrases, **scale, 'cpus': os.cpu_count(), 'python': platform.python_version(),
+        }
+        with open(args.save, 'w') as f:
+            json.dump({'created_at': time.time(), 'config': config, 'results': results}, f, indent=2)
+        print(f'saved the results to {args.save}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
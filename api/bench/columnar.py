@@ -0,0 +1,90 @@
+"""
+Compares the JSON and the columnar (`application/x-ndarray`) responses of /api/len_dist and
+/api/topk_with_counts: payload size, raw and gzipped, and the time to encode and decode them.
+
+python -m bench.columnar --corpora 11 --points 20000 --count 1000
+
+The data is synthetic, but shaped like the real responses: `--points` (x, y) pairs per corpus
+for the length distributions, and `--count` n-grams per corpus for the top-k.
+"""
+
+import argparse
+import gzip
+import json
+import time
+
+import numpy as np
+
+from app.arrays import pack_arrays, unpack_arrays
+from app.responses import dumps, orjson
+from app.topk import TopKTable
+
+
+def len_dist_payloads(num_corpora, points, rng):
+    pairs, columns = {}, {}
+    for i in range(num_corpora):
+        x = np.sort(rng.choice(np.arange(1, points * 20), size=points, replace=False)).astype(np.int32)
+        y = rng.random(points).astype(np.float32) * 1e-3
+        pairs[f'corpus-{i}'] = list(zip(x.tolist(), y.astype(np.float64).tolist()))
+        columns[f'corpus-{i}.x'] = x
+        columns[f'corpus-{i}.y'] = y
+    return pairs, columns
+
+
+def topk_payloads(num_corpora, count, rng):
+    objects, columns = {}, {}
+    for i in range(num_corpora):
+        ngrams = {' '.join(f'w{w}' for w in rng.integers(0, 50_000, size=3)): int(c)
+                  for c in rng.integers(1, 10 ** 9, size=count)}
+        table = TopKTable.from_dict(ngrams)
+        objects[f'corpus-{i}'] = [{'ng': ng, 'c': c} for ng, c in table.with_counts(count)]
+        for name, array in table.columns(count).items():
+            columns[f'corpus-{i}.{name}'] = array
+    return objects, columns
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def report(name, obj, columns, repeat):
+    encoders = {
+        'json': lambda: json.dumps(obj, sort_keys=True, separators=(',', ':')).encode('utf-8'),
+        'ndarray': lambda: pack_arrays(columns),
+    }
+    if orjson is not None:
+        encoders['orjson'] = lambda: dumps(obj)
+
+    print(f'{name}:')
+    print(f'  {"format":<10}{"bytes":>12}{"gzipped":>12}{"encode ms":>12}{"decode ms":>12}')
+    for fmt, encode in encoders.items():
+        body = encode()
+        if fmt == 'ndarray':
+            # Includes turning the arrays into Python lists, which most clients don't need.
+            decode = lambda: [a.tolist() for a in unpack_arrays(body).values()]
+        else:
+            decode = lambda: json.loads(body)
+        print(f'  {fmt:<10}{len(body):>12}{len(gzip.compress(body, compresslevel=9)):>12}'
+              f'{timeit(encode, repeat):>12.2f}{timeit(decode, repeat):>12.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the JSON and columnar response formats.')
+    parser.add_argument('--corpora', type=int, default=11, help='Number of corpora per request')
+    parser.add_argument('--points', type=int, default=20_000, help='Length distribution points per corpus')
+    parser.add_argument('--count', type=int, default=1000, help='Top-k n-grams per corpus')
+    parser.add_argument('--repeat', type=int, default=20, help='Repetitions, the fastest one is reported')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    report('len_dist', *len_dist_payloads(args.corpora, args.points, rng), args.repeat)
+    report('topk_with_counts', *topk_payloads(args.corpora, args.count, rng), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Compares the throughput of concurrent n-gram count requests for the two ES transport modes:
+`threaded` (the default, one OS thread per in-flight request) and `gevent` (monkey-patched
+sockets, one greenlet per in-flight request).
+
+python -m bench.es_transport --requests 2000 --concurrency 64 --latency-ms 20
+
+The requests go through `count_documents_in_indices`, the code path of /api/text_count, to a
+local ES stand-in that answers `_msearch` after a fixed delay, so the numbers isolate the
+transport and connection pool from the rest of the API. Each mode runs in its own process.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the ES transport modes.')
+
+    parser.add_argument('--requests', type=int, default=2000, help='Number of count requests per mode')
+    parser.add_argument('--concurrency', type=int, default=64, help='Number of requests in flight')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Delay of the ES stand-in per request')
+    parser.add_argument('--connections-per-node', type=int, default=64, help='Size of the connection pool')
+    parser.add_argument('--mode', choices=['threaded', 'gevent'], default=None,
+                        help='Run a single mode against --url (used internally)')
+    parser.add_argument('--url', type=str, default=None, help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def serve_stand_in(latency: float):
+    """
+    Runs an HTTP server that answers `_msearch` like ES would, with a count of 1 per search.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            num_searches = len([line for line in body.splitlines() if line.strip()]) // 2
+            time.sleep(latency)
+            payload = json.dumps({'responses': [
+                {'timed_out': False, 'hits': {'total': 1, 'hits': []}} for _ in range(num_searches)
+            ]}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.elasticsearch+json;compatible-with=8')
+            self.send_header('X-Elastic-Product', 'Elasticsearch')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    ThreadingHTTPServer.daemon_threads = True
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+
+def run_mode(args):
+    if args.mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+
+    from app.es import count_documents_in_indices, es_init
+
+    with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False) as f:
+        f.write(f'hosts: ["{args.url}"]\ntransport:\n  connections_per_node: {args.connections_per_node}\n')
+    es = es_init(f.name)
+
+    latencies = []
+
+    def one(i):
+        start = time.perf_counter()
+        count_documents_in_indices(['c4', 're_oscar', 're_pile'], f'phrase {i}', es=es)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if args.mode == 'gevent':
+        from gevent.pool import Pool
+        Pool(args.concurrency).map(one, range(args.requests))
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            list(executor.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    os.unlink(f.name)
+
+    latencies.sort()
+    print(json.dumps({
+        'mode': args.mode,
+        'throughput': args.requests / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+    }))
+
+
+def main():
+    args = parse_args()
+    if args.mode:
+        run_mode(args)
+        return
+
+    server_cmd = [sys.executable, '-c', f'from bench.es_transport import serve_stand_in; serve_stand_in({args.latency_ms / 1000})']
+    server = subprocess.Popen(server_cmd, stdout=subprocess.PIPE, text=True)
+    try:
+        url = f'http://127.0.0.1:{server.stdout.readline().strip()}'
+        for mode in ['threaded', 'gevent']:
+            out = subprocess.run(
+                [sys.executable, '-m', 'bench.es_transport', '--mode', mode, '--url', url,
+                 '--requests', str(args.requests), '--concurrency', str(args.concurrency),
+                 '--connections-per-node', str(args.connections_per_node)],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            print(f"{result['mode']:>9}: {result['throughput']:8.1f} req/s | p50 {result['p50_ms']:7.1f} ms "
+                  f"| p99 {result['p99_ms']:7.1f} ms")
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
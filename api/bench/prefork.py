@@ -0,0 +1,162 @@
+"""
+Compares the throughput of the single-process gevent server with the pre-fork server of
+`app/prefork.py`, on a CPU-bound stand-in for the API: serializing the top n-grams of a
+`TopKTable` of a few million entries loaded at start-up.
+
+python -m bench.prefork --workers 4 --clients 16 --duration 10
+
+For each mode, the server runs in its own process group and is loaded by `--clients` client
+processes with keep-alive connections. Besides requests per second and latencies, it reports the
+proportional set size (PSS) of all the server processes, which shows how much of the data the
+forked workers share. Arrays are shared, while Python objects the workers touch are copied
+(reference counting writes to them).
+"""
+
+import argparse
+import http.client
+import logging
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+
+def create_bench_app(num_ngrams: int):
+    from flask import Flask, jsonify, request
+
+    from app.topk import TopKTable
+
+    table = TopKTable.from_dict({f'ngram number {i}': (i * 7919) % 1_000_003 for i in range(num_ngrams)})
+    app = Flask('bench')
+
+    @app.route('/topk')
+    def topk():
+        count = int(request.args.get('count', 2000))
+        return jsonify([{'ng': ng, 'c': c} for ng, c in table.with_counts(count)])
+
+    @app.route('/')
+    def index():
+        return '', 204
+
+    return app
+
+
+def serve(mode: str, port: int, workers: int, num_ngrams: int):
+    logging.basicConfig(level=logging.WARNING)
+    if mode == 'prefork':
+        from app.prefork import Master
+        Master(lambda: create_bench_app(num_ngrams), port, workers).run()
+    else:
+        from gevent.pywsgi import WSGIServer
+
+        from app.prefork import NoDelayWSGIHandler
+        WSGIServer(('0.0.0.0', port), create_bench_app(num_ngrams), handler_class=NoDelayWSGIHandler,
+                   log=None).serve_forever()
+
+
+def wait_until_up(port: int, timeout: float = 120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('The server did not start.')
+
+
+def client(port: int, duration: float, seed: int, queue):
+    rng = np.random.default_rng(seed)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    latencies = []
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        start = time.perf_counter()
+        conn.request('GET', f'/topk?count={rng.integers(1000, 3000)}')
+        response = conn.getresponse()
+        response.read()
+        if response.status == 200:
+            latencies.append(time.perf_counter() - start)
+    queue.put(latencies)
+
+
+def pss_kib(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/smaps_rollup') as f:
+                total += sum(int(line.split()[1]) for line in f if line.startswith('Pss:'))
+        except OSError:
+            pass
+    return total
+
+
+def server_pids(root: int):
+    pids = [root]
+    try:
+        out = subprocess.run(['pgrep', '-P', str(root)], capture_output=True, text=True).stdout
+        pids += [int(pid) for pid in out.split()]
+    except FileNotFoundError:
+        pass
+    return pids
+
+
+def run(mode: str, args):
+    port = args.port
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'bench.prefork', '--serve', mode, '--port', str(port),
+         '--workers', str(args.workers), '--ngrams', str(args.ngrams)],
+        start_new_session=True,
+    )
+    try:
+        wait_until_up(port)
+        # Let the pre-fork workers start before measuring.
+        time.sleep(2)
+
+        queue = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(port, args.duration, i, queue))
+                   for i in range(args.clients)]
+        for p in clients:
+            p.start()
+        time.sleep(args.duration / 2)
+        pss = pss_kib(server_pids(server.pid))
+        latencies = np.array([x for _ in clients for x in queue.get()]) * 1000
+        for p in clients:
+            p.join()
+            if p.exitcode != 0:
+                raise RuntimeError(f'A client exited with {p.exitcode}.')
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+
+    print(f'{mode:<10}{len(latencies) / args.duration:>10.1f}{np.percentile(latencies, 50):>10.1f}'
+          f'{np.percentile(latencies, 99):>10.1f}{pss / 1024:>12.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the single-process and the pre-fork server.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Workers of the pre-fork server')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent client processes')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of load per mode')
+    parser.add_argument('--ngrams', type=int, default=2_000_000, help='Number of n-grams the app loads')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--serve', choices=['single', 'prefork'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.workers, args.ngrams)
+        return
+
+    print(f'{"mode":<10}{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}{"PSS MiB":>12}')
+    for mode in ['single', 'prefork']:
+        run(mode, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+"""
+In-process stand-ins for the services the API depends on, and synthetic artifacts to serve, so
+that `create_api` runs anywhere:
+
+- `FakeElasticsearch`: the subset of the `Elasticsearch` client used by `app/es.py`, answering
+  after a fixed latency with counts derived from a hash of the query.
+- `SqlitePool`: a `psycopg_pool.ConnectionPool` stand-in over SQLite copies of the domain tables.
+- `write_synthetic_data`: top-k, length distribution and overlap artifacts in the layout of
+  the data directory, and the SQLite domain tables.
+"""
+
+import itertools
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from app.overlaps import write_overlaps_json
+
+# The file names and the domain tables of the corpora, as in `create_api`.
+CORPUS_FILES = ['openwebtext', 'c4_en', 'mc4', 'oscar', 'pile_train', 'redpajama', 's2orc_v0', 's2orc_v3',
+                'laion2B-en', 'stack', 'dolma-v1_5']
+DOMAIN_TABLES = ['oscar', 'laion', 'c4', 'redpajama', 'mc4', 'dolma']
+KS = [1, 2, 3, 4, 5, 10, 100]
+
+# Spread the synthetic domains over a few common host prefixes, like in `bench/domain_prefix.py`.
+HOST_PREFIXES = ['www.', 'cdn.', 'images.', 'blog.', 'i.', 'en.', 'm.', 'shop.']
+
+# The largest number of documents `FakeElasticsearch` matches per query.
+MAX_FAKE_HITS = 1_000_000
+
+
+# The indices `FakeElasticsearch` reports, matching the index names and patterns of `create_api`.
+INDICES = ['re_oscar', 're_laion2b-en-1', 're_laion2b-en-2', 'openwebtext', 're_pile', 'c4', 'docs_v1.5_2023-11-02']
+
+
+def _matching(indices: List[str], index: Optional[str]) -> List[str]:
+    if index is None:
+        return indices
+    patterns = index.split(',') if isinstance(index, str) else index
+    return [name for name in indices if any(fnmatchcase(name, pattern) for pattern in patterns)]
+
+
+class _FakeCat:
+    def __init__(self, indices: List[str], num_shards: int):
+        self._indices = indices
+        self.num_shards = num_shards
+
+    def shards(self, index: Optional[str] = None, format: Optional[str] = None, **kwargs) -> List[dict]:
+        return [{'index': name, 'shard': str(i), 'prirep': prirep}
+                for name in _matching(self._indices, index) for i in range(self.num_shards) for prirep in 'pr']
+
+    def indices(self, index: Optional[str] = None, format: Optional[str] = None, **kwargs) -> List[dict]:
+        return [{'index': name, 'docs.count': str(MAX_FAKE_HITS * self.num_shards), 'pri': str(self.num_shards)}
+                for name in _matching(self._indices, index)]
+
+
+def _analyze(text: str) -> List[str]:
+    """
+    Tokenizes like the standard analyzer, for the usual cases: lowercased words, keeping the
+    apostrophes and the inner dots, e.g. "Don't visit the U.S." -> ["don't", "visit", "the", "u.s"].
+    """
+    return re.findall(r"\w+(?:[.']\w+)*", text.lower())
+
+
+class _FakeIndices:
+    def __init__(self, indices: List[str]):
+        self._indices = indices
+
+    def analyze(self, index: Optional[str] = None, field: Optional[str] = None, text: str = '', **kwargs) -> dict:
+        return {'tokens': [{'token': token, 'position': i} for i, token in enumerate(_analyze(text))]}
+
+    def get_mapping(self, index: Optional[str] = None, **kwargs) -> dict:
+        return {name: {'mappings': {'properties': {'text': {'type': 'text'}}}}
+                for name in _matching(self._indices, index)}
+
+
+def _query_text(query: Any) -> str:
+    """
+    :return: The phrases of the `match` and `match_phrase` clauses of a query, joined by spaces.
+    """
+    if isinstance(query, dict):
+        phrases = [value['text'] for key, value in query.items()
+                   if key in ('match', 'match_phrase') and isinstance(value.get('text'), str)]
+        return ' '.join(phrases + [_query_text(value) for value in query.values() if isinstance(value, (dict, list))]).strip()
+    if isinstance(query, list):
+        return ' '.join(_query_text(value) for value in query).strip()
+    return ''
+
+
+def _filter_source(source: dict, fields: Any) -> dict:
+    """
+    :return: `source` filtered like the `_source` parameter of a search, without wildcards.
+    """
+    if isinstance(fields, dict):
+        return {key: value for key, value in source.items()
+                if key in fields.get('includes', source) and key not in fields.get('excludes', [])}
+    return source
+
+
+class FakeElasticsearch:
+    """
+    Answers `count`, `msearch`, `search` (with points in time and slices) and `mtermvectors` like
+    an ES cluster of `indices` would, after `latency` seconds per call. The number of documents a
+    query matches in an index, and the total frequency of a term in a shard, are hashes of both,
+    so repeated queries get the same answers. The id of a matching document holds its text: the phrases of the query.
+    """
+    def __init__(self, latency: float = 0.02, num_shards: int = 4, indices: List[str] = INDICES):
+        self.latency = latency
+        self.cat = _FakeCat(indices, num_shards)
+        self.indices = _FakeIndices(indices)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def hits(index: str, query: Any) -> int:
+        return zlib.crc32(json.dumps([index, query], sort_keys=True).encode('utf-8')) % MAX_FAKE_HITS
+
+    @staticmethod
+    def _total(count: int, as_int: bool):
+        return count if as_int else {'value': count, 'relation': 'eq'}
+
+    def count(self, index: str, query: Any = None, **kwargs) -> dict:
+        self._call()
+        return {'count': self.hits(index, query)}
+
+    def _search(self, index: str, query: Any, size: int, search_after: Optional[List], as_int: bool,
+                slice: Optional[dict] = None) -> dict:
+        count = self.hits(index, query)
+        # A slice gets every `max`-th document.
+        first, step = (slice['id'], slice['max']) if slice else (0, 1)
+        start = search_after[0] + step if search_after else first
+        text = _query_text(query)
+        hits = [
+            {'_index': index, '_id': f'{i}/{text}', '_score': 1.0, 'sort': [i],
+             '_source': {'text': f'synthetic document {i} of {index}: {text}', 'url': f'https://{index}.example.com/{i}'}}
+            for i in range(start, min(start + size * step, count), step)
+        ]
+        return {'timed_out': False, 'hits': {'total': self._total(count, as_int), 'hits': hits}}
+
+    def msearch(self, searches: List[dict], index: Optional[str] = None, rest_total_hits_as_int: bool = False,
+                **kwargs) -> dict:
+        self._call()
+        return {'responses': [
+            self._search(header.get('index', index), body.get('query'), body.get('size', 0), None,
+                         rest_total_hits_as_int)
+            for header, body in zip(searches[::2], searches[1::2])
+        ]}
+
+    def open_point_in_time(self, index: str, keep_alive: str, **kwargs) -> dict:
+        self._call()
+        return {'id': f'pit/{index}'}
+
+    def close_point_in_time(self, id: str, **kwargs) -> dict:
+        self._call()
+        return {'succeeded': True}
+
+    def search(self, index: Optional[str] = None, query: Any = None, size: int = 10,
+               search_after: Optional[List] = None, rest_total_hits_as_int: bool = False,
+               pit: Optional[dict] = None, slice: Optional[dict] = None, source: Any = True,
+               highlight: Optional[dict] = None, **kwargs) -> dict:
+        self._call()
+        if pit is not None:
+            index = pit['id'].split('/', 1)[1]
+        response = self._search(index, query, size, search_after, rest_total_hits_as_int, slice)
+        if pit is not None:
+            response['pit_id'] = pit['id']
+        for hit in response['hits']['hits']:
+            if highlight is not None:
+                hit['highlight'] = {'text': [hit['_source']['text'].replace(': ', ': <em>', 1) + '</em>']}
+            if source is False:
+                del hit['_source']
+            else:
+                hit['_source'] = _filter_source(hit['_source'], source)
+        return response
+
+    def mtermvectors(self, index: str, docs: List[dict], preference: Optional[str] = None, **kwargs) -> dict:
+        self._call()
+        return {'docs': [
+            {'_index': index, '_id': doc['_id'], 'found': True, 'term_vectors': {'text': {'terms': {
+                term: {'ttf': self.hits(index, [term, preference]), 'term_freq': 1}
+                for term in _analyze(doc['_id'].split('/', 1)[1])
+            }}}}
+            for doc in docs
+        ]}
+
+
+class _SqliteCursor:
+    def __init__(self, conn: sqlite3.Connection):
+        self._cursor = conn.cursor()
+
+    def __enter__(self) -> '_SqliteCursor':
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+    def execute(self, query: str, params=(), prepare: Optional[bool] = None) -> '_SqliteCursor':
+        # SQLite compares text byte-wise, like the `text_pattern_ops` operators. `index` is a
+        # keyword in SQLite, so the column is quoted.
+        query = query.replace('%s', '?').replace('~>=~', '>=').replace('~<~', '<')
+        query = re.sub(r'\bindex\b', '"index"', query)
+        self._cursor.execute(query, params)
+        return self
+
+    def fetchall(self) -> List[tuple]:
+        return self._cursor.fetchall()
+
+
+class _SqliteConnection:
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def cursor(self) -> _SqliteCursor:
+        return _SqliteCursor(self._conn)
+
+
+class SqlitePool:
+    """
+    Stands in for a `psycopg_pool.ConnectionPool` to the domain tables: `size` connections to the
+    SQLite file written by `write_synthetic_data`, running the API's queries translated to SQLite.
+    """
+    def __init__(self, path: str, size: int = 8):
+        self._connections = queue.Queue()
+        for _ in range(size):
+            self._connections.put(sqlite3.connect(path, check_same_thread=False))
+
+    @contextmanager
+    def connection(self):
+        conn = self._connections.get()
+        try:
+            yield _SqliteConnection(conn)
+        finally:
+            self._connections.put(conn)
+
+
+def _zipf_counts(rng: np.random.Generator, n: int, top: int) -> np.ndarray:
+    counts = (top / np.arange(1, n + 1) ** 1.1).astype(np.int64) + 1
+    return counts + rng.integers(0, 3, n)
+
+
+def write_synthetic_data(data_dir: str, ngrams: int = 20_000, lengths: int = 100_000, domains: int = 200_000,
+                         seed: int = 0) -> Dict[str, Any]:
+    """
+    Writes synthetic artifacts for every corpus to `data_dir`: `ngrams` top-k n-grams per k,
+    a length distribution over `lengths` lengths, the overlaps of every subset of corpora, and
+    `domains` domains per domain table in `domains.sqlite`.
+
+    :return: The parameters, stored in `synthetic.json` too.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(data_dir, 'topk'), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, 'lengths_char_summary'), exist_ok=True)
+
+    for file_name in CORPUS_FILES:
+        for k in KS:
+            counts = _zipf_counts(rng, ngrams, 10 ** 9)
+            with open(os.path.join(data_dir, 'topk', f'top-{k}_{file_name}.jsonl'), 'w') as f:
+                for i, count in enumerate(counts.tolist()):
+                    words = [f'n{i}'] + [f'w{(i * 31 + j) % 5000}' for j in range(1, min(k, 10))]
+                    f.write(json.dumps({'string': ' '.join(words), 'count': count}) + '\n')
+
+        sizes = np.arange(1, lengths + 1)
+        probs = np.exp(-((np.log(sizes) - np.log(2000)) ** 2) / 2) * rng.uniform(0.5, 1.5, lengths)
+        probs /= probs.sum()
+        with open(os.path.join(data_dir, 'lengths_char_summary', f'chars_{file_name}.json'), 'w') as f:
+            json.dump({str(size): prob for size, prob in zip(sizes.tolist(), probs.tolist())}, f)
+
+    overlaps = [
+        (list(subset), int(rng.integers(0, 10 ** 9)) // len(subset) ** 2)
+        for r in range(1, len(CORPUS_FILES) + 1) for subset in itertools.combinations(CORPUS_FILES, r)
+    ]
+    write_overlaps_json(os.path.join(data_dir, 'overlaps.json'), overlaps)
+
+    db_path = os.path.join(data_dir, 'domains.sqlite')
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    with sqlite3.connect(db_path) as conn:
+        for table in DOMAIN_TABLES:
+            counts = _zipf_counts(rng, domains, 10 ** 8)
+            prefixes = rng.integers(0, len(HOST_PREFIXES), domains).tolist()
+            names = rng.integers(0, 2 ** 48, domains).tolist()
+            total = int(counts.sum())
+            conn.execute(f'CREATE TABLE {table} ("index" INTEGER, domain TEXT, count INTEGER, percentage REAL, rank INTEGER)')
+            conn.executemany(
+                f'INSERT INTO {table} VALUES (?, ?, ?, ?, ?)',
+                ((i, f'{HOST_PREFIXES[p]}{n:012x}.com', c, c / total, i + 1)
+                 for i, (p, n, c) in enumerate(zip(prefixes, names, counts.tolist())))
+            )
+            conn.execute(f'CREATE INDEX {table}_domain_idx ON {table} (domain)')
+            conn.execute(f'CREATE INDEX {table}_count_idx ON {table} (count DESC)')
+            conn.execute(f'CREATE INDEX {table}_index_idx ON {table} ("index")')
+
+    params = {'ngrams': ngrams, 'lengths': lengths, 'domains': domains, 'seed': seed}
+    with open(os.path.join(data_dir, 'synthetic.json'), 'w') as f:
+        json.dump(params, f)
+    return params
@@ -0,0 +1,93 @@
+"""
+Compares the start-up cost of loading the top-k n-grams from the JSONL files against
+memory-mapping the binary files written by `app/db/topk_to_bin.py`.
+
+python -m bench.topk_startup --jsonl-dir /skiff_files/apps/wimdb/topk --bin-dir /skiff_files/apps/wimdb/topk_bin
+
+Each mode runs in a fresh process, so the numbers include the peak resident memory of
+that process. The binary files are served from the page cache after the first run, which
+is also what forked workers see in production.
+"""
+
+import argparse
+import multiprocessing
+import os
+import re
+import resource
+import time
+from glob import glob
+
+from app.api import read_topk
+from app.topk import TopKStore
+
+TOPK_FILE_RE = re.compile(r'^top-(\d+)_(.+)\.jsonl$')
+
+
+def _jsonl_files(jsonl_dir):
+    files = []
+    for filename in sorted(glob(os.path.join(jsonl_dir, 'top-*_*.jsonl'))):
+        match = TOPK_FILE_RE.match(os.path.basename(filename))
+        if match:
+            files.append((match.group(2), int(match.group(1)), filename))
+    return files
+
+
+def load_jsonl(jsonl_dir, queue):
+    start = time.perf_counter()
+    store = TopKStore()
+    files = _jsonl_files(jsonl_dir)
+    for corpus, k, filename in files:
+        store.add(corpus, k, read_topk(filename))
+    startup = time.perf_counter() - start
+
+    corpus, k, _ = files[0]
+    start = time.perf_counter()
+    store.top_with_counts(corpus, k, 1000)
+    first_request = time.perf_counter() - start
+
+    queue.put(('jsonl', startup, first_request, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def load_mmap(jsonl_dir, bin_dir, queue):
+    files = _jsonl_files(jsonl_dir)
+    corpora = {corpus: corpus for corpus, _, _ in files}
+
+    start = time.perf_counter()
+    store = TopKStore.from_binary_dir(bin_dir, corpora)
+    startup = time.perf_counter() - start
+
+    corpus, k, _ = files[0]
+    start = time.perf_counter()
+    store.top_with_counts(corpus, k, 1000)
+    first_request = time.perf_counter() - start
+
+    queue.put(('mmap', startup, first_request, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark top-k start-up time for the JSONL and mmap paths.')
+
+    parser.add_argument('--jsonl-dir', type=str, default='/skiff_files/apps/wimdb/topk',
+                        help='Directory containing the top-{k}_{corpus}.jsonl files')
+    parser.add_argument('--bin-dir', type=str, default='/skiff_files/apps/wimdb/topk_bin',
+                        help='Directory containing the {corpus}.topk files')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of runs per mode')
+
+    args = parser.parse_args()
+
+    queue = multiprocessing.Queue()
+    runs = [(load_jsonl, (args.jsonl_dir, queue)), (load_mmap, (args.jsonl_dir, args.bin_dir, queue))]
+    for _ in range(args.repeats):
+        for target, target_args in runs:
+            process = multiprocessing.Process(target=target, args=target_args)
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f'{target.__name__} failed with exit code {process.exitcode}')
+            mode, startup, first_request, max_rss = queue.get()
+            print(f'{mode:>6}: startup {startup * 1000:10.1f} ms | first request {first_request * 1000:8.2f} ms '
+                  f'| peak RSS {max_rss / 1024:8.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,20 @@
-import argparse
 import os
+
+# In the gevent transport mode the standard library is patched so that blocking socket calls
+# (e.g. requests to ES) yield to other greenlets instead of blocking the process.
+# This has to happen before anything else imports `socket`, `ssl` or `threading`.
+if os.getenv('ES_TRANSPORT', 'threaded') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import argparse
 import sys
 import logging
 from typing import Tuple
 from gevent.pywsgi import WSGIServer
 from flask import Flask, Response, request, jsonify
 from app.api import create_api
+from app.prefork import Master, NoDelayWSGIHandler
 from app.utils import StackdriverJsonFormatter
 from werkzeug.middleware.proxy_fix import ProxyFix
 
@@ -22,6 +31,18 @@ def start():
         help='The port to listen on',
         default=8000
     )
+    parser.add_argument(
+        '--prefork',
+        help='In production, load the data once and serve it from forked worker processes',
+        action='store_true',
+        default=os.getenv('PREFORK', '') == '1'
+    )
+    parser.add_argument(
+        '--workers',
+        help='The number of worker processes of --prefork, the number of CPUs by default',
+        type=int,
+        default=int(os.getenv('WORKERS', os.cpu_count()))
+    )
     args = parser.parse_args()
 
     # We change a few things about the application's behavior depending on this
@@ -59,29 +80,41 @@ def start():
     logger = logging.getLogger()
     logger.debug("AHOY! Let's get this boat out to water...")
 
-    app = Flask("app")
+    def create_app() -> Flask:
+        app = Flask("app")
 
-    # Bind the API functionality to our application. You can add additional
-    # API endpoints by editing api.py.
-    logger.debug("Starting: init API...")
-    app.register_blueprint(create_api(), url_prefix='/')
-    logger.debug("Complete: init API...")
+        # Bind the API functionality to our application. You can add additional
+        # API endpoints by editing api.py.
+        logger.debug("Starting: init API...")
+        app.register_blueprint(create_api(), url_prefix='/')
+        logger.debug("Complete: init API...")
+        return app
+
+    # In production there are two proxies -- the one that's run as a sibling of this
+    # process, and the Ingress controller that runs on the cluster.
+    # See: https://skiff.allenai.org/templates.html
+    def create_prod_app() -> ProxyFix:
+        num_proxies = 2
+        return ProxyFix(create_app(), x_for=num_proxies, x_proto=num_proxies, x_host=num_proxies,
+                        x_port=num_proxies)
+
+    # With --prefork, the master process loads the app and forks the workers serving it. Sending
+    # it a SIGHUP reloads the app (e.g. after installing a new bundle) without downtime.
+    if is_prod and args.prefork:
+        logger.debug("Starting: pre-fork master...")
+        Master(create_prod_app, int(args.port), args.workers, logger=logger).run()
 
     # In production we use a HTTP server appropriate for production.
-    if is_prod:
+    elif is_prod:
         logger.debug("Starting: gevent.WSGIServer...")
-        # There are two proxies -- the one that's run as a sibling of this process, and
-        # the Ingress controller that runs on the cluster.
-        # See: https://skiff.allenai.org/templates.html
-        num_proxies = 2
-        proxied_app = ProxyFix(app, x_for=num_proxies, x_proto=num_proxies, x_host=num_proxies,
-                               x_port=num_proxies)
-        http_server = WSGIServer(('0.0.0.0', args.port), proxied_app, log=logger,
-            error_log=logger)
-        app.logger.info(f'Server listening at http://0.0.0.0:{args.port}')
+        proxied_app = create_prod_app()
+        http_server = WSGIServer(('0.0.0.0', args.port), proxied_app, handler_class=NoDelayWSGIHandler,
+            log=logger, error_log=logger)
+        logger.info(f'Server listening at http://0.0.0.0:{args.port}')
         http_server.serve_forever()
     else:
         logger.debug("Starting: Flask development server...")
+        app = create_app()
         num_proxies = 1
         proxied_app = ProxyFix(app, x_for=num_proxies, x_proto=num_proxies, x_host=num_proxies,
                                x_port=num_proxies)